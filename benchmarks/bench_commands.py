@@ -0,0 +1,199 @@
+# Times the scan phase (planning the changes) and the commit phase (applying
+# them) of the library commands on a fresh synthetic library each, and
+# reports files/sec and the peak RSS. Every command runs in its own process,
+# so the peaks don't mix. The results are appended to a jsonl file and
+# compared with the last earlier run of the same parameters.
+#
+#   python -m benchmarks.bench_commands --albums 200 --chapters 30 --messy
+#   python -m benchmarks.bench_commands tag-to-name dirname-to-tag --jobs 4
+
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+import platform
+import resource
+import tempfile
+import subprocess
+from datetime import datetime, timezone
+from benchmarks.synthlib import make_library
+
+# the arguments of each command and the name of its album handler
+COMMANDS = {
+  "purge": (["purge"], "purge_album"),
+  "sanitize-dirnames": (["sanitize-dirnames"], "sanitize_dir_names_album"),
+  "tag-to-dirname": (["tag-to-dirname"], "tag_to_dirname_album"),
+  "dirname-to-tag": (["dirname-to-tag"], "dirname_to_tag_album"),
+  "name-to-tag": (["name-to-tag"], "name_to_tag_album"),
+  "tag-to-name": (["tag-to-name"], "tag_to_name_album"),
+  "overwrite-title-from-track": (["overwrite-title-from-track"], "overwrite_title_from_track_album"),
+  "pipeline": (["pipeline", "dirname-to-tag", "tag-to-name", "tag-to-dirname"], "pipeline_album"),
+}
+
+DEFAULT_RESULTS = os.path.join(os.path.dirname(__file__), "results.jsonl")
+
+
+def library_size(root):
+  files = 0
+  size = 0
+  for path, _, names in os.walk(root):
+    for name in names:
+      if name.endswith(".mp3"):
+        files += 1
+        size += os.path.getsize(f"{path}/{name}")
+  return files, size
+
+
+def peak_rss():
+  # kilobytes on linux, bytes on macos
+  scale = 1 if sys.platform == "darwin" else 1024
+  own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+  children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+  return own, children
+
+
+# runs in the child process: one command on the library at `root`
+def run_command(command, root, options):
+  from kaudiobooks import kaudiobooks
+  argv, handler_name = COMMANDS[command]
+  argv = argv + ["--root", root, "--no-journal", "--jobs", str(options.jobs), "--commit-jobs", str(options.commit_jobs)]
+  if options.tag_index:
+    argv += ["--tag-index", f"{root}.tags.sqlite"]
+  else:
+    argv += ["--no-tag-index"]
+  args = kaudiobooks.build_parser().parse_args(argv)
+  handler = getattr(kaudiobooks, handler_name)
+  files, size = library_size(root)
+
+  if options.tag_index:
+    # the timed scan then reads from a warm index, as repeated runs would
+    list(kaudiobooks.map_albums(args, handler))
+  start = time.perf_counter()
+  changes = [c for c in kaudiobooks.map_albums(args, handler) if c]
+  scan = time.perf_counter() - start
+  count = sum(1 for _ in kaudiobooks.iter_changes(changes))
+
+  start = time.perf_counter()
+  failures = kaudiobooks.execute_changes(changes, kaudiobooks.open_tag_index(args), args.commit_jobs)
+  commit = time.perf_counter() - start
+
+  own, children = peak_rss()
+  return {
+    "files": files,
+    "bytes": size,
+    "changes": count,
+    "failures": len(failures),
+    "scan_seconds": scan,
+    "scan_files_per_sec": files / scan if scan > 0 else None,
+    "commit_seconds": commit,
+    "commit_changes_per_sec": count / commit if commit > 0 else None,
+    "peak_rss": own,
+    "peak_rss_workers": children,
+  }
+
+
+def child(options):
+  logging.basicConfig(level=logging.WARNING)
+  logging.getLogger("eyed3").setLevel(logging.CRITICAL)
+  print(json.dumps(run_command(options.child, options.root, options)))
+
+
+def git_revision():
+  try:
+    return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True, cwd=os.path.dirname(__file__), check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def benchmark(command, options, tmp):
+  root = f"{tmp}/{command}"
+  make_library(root, options.albums, options.chapters, options.frames, options.cover_size, options.messy)
+  argv = [sys.executable, "-m", "benchmarks.bench_commands", "--child", command, "--root", root, "--jobs", str(options.jobs), "--commit-jobs", str(options.commit_jobs)]
+  if options.tag_index:
+    argv.append("--tag-index")
+  result = subprocess.run(argv, capture_output=True, text=True)
+  if result.returncode != 0:
+    raise RuntimeError(f"{command} failed:\n{result.stderr}")
+  return json.loads(result.stdout.splitlines()[-1])
+
+
+def parameters(options):
+  return {name: getattr(options, name) for name in ("albums", "chapters", "frames", "cover_size", "messy", "jobs", "commit_jobs", "tag_index")}
+
+
+def previous_run(path, params):
+  previous = None
+  try:
+    with open(path) as f:
+      for line in f:
+        run = json.loads(line)
+        if run["parameters"] == params:
+          previous = run
+  except FileNotFoundError:
+    pass
+  return previous
+
+
+def ratio(new, old):
+  if not new or not old:
+    return ""
+  return f" ({new / old:.2f}x)"
+
+
+def report(command, result, previous):
+  old = (previous or {}).get("commands", {}).get(command, {})
+  print(f"{command:>27}: scan {result['scan_files_per_sec'] or 0:9.0f} files/sec{ratio(result['scan_files_per_sec'], old.get('scan_files_per_sec'))}"
+        f"  commit {result['changes']:6} changes {result['commit_changes_per_sec'] or 0:8.0f}/sec{ratio(result['commit_changes_per_sec'], old.get('commit_changes_per_sec'))}"
+        f"  peak rss {result['peak_rss'] / 2**20:6.1f} MiB (workers {result['peak_rss_workers'] / 2**20:.1f} MiB)")
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("commands", nargs="*", help=f"the commands to benchmark, all by default ({', '.join(COMMANDS)})")
+  parser.add_argument("--albums", type=int, default=100)
+  parser.add_argument("--chapters", type=int, default=30)
+  parser.add_argument("--frames", type=int, default=8, help="mpeg frames per chapter")
+  parser.add_argument("--cover-size", type=int, default=0, help="size of an embedded APIC frame per chapter")
+  parser.add_argument("--messy", action='store_true', help="generate unsanitized names and tags that disagree with them, so every command has work")
+  parser.add_argument("--jobs", type=int, default=1, help="the scan processes")
+  parser.add_argument("--commit-jobs", type=int, default=1, help="the commit threads")
+  parser.add_argument("--tag-index", action='store_true', help="time the scan with a warm tag index")
+  parser.add_argument("--results", type=str, default=DEFAULT_RESULTS, help="the jsonl file the results are appended to")
+  parser.add_argument("--no-save", action='store_true', help="only print the results")
+  parser.add_argument("--child", type=str, help=argparse.SUPPRESS)
+  parser.add_argument("--root", type=str, help=argparse.SUPPRESS)
+  options = parser.parse_args()
+
+  if options.child:
+    return child(options)
+  unknown = [command for command in options.commands if command not in COMMANDS]
+  if unknown:
+    parser.error(f"unknown commands: {', '.join(unknown)}")
+
+  params = parameters(options)
+  previous = previous_run(options.results, params)
+  if previous is not None:
+    print(f"comparing with {previous['revision']} from {previous['date']}")
+  results = {}
+  with tempfile.TemporaryDirectory() as tmp:
+    for command in options.commands or list(COMMANDS):
+      results[command] = benchmark(command, options, tmp)
+      report(command, results[command], previous)
+
+  if not options.no_save:
+    run = {
+      "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+      "revision": git_revision(),
+      "python": platform.python_version(),
+      "parameters": params,
+      "commands": results,
+    }
+    with open(options.results, "a") as f:
+      f.write(json.dumps(run) + "\n")
+    print(f"saved to {options.results}")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,63 @@
+
+# Measures the memory held by the planned changes of a tag-to-name --renumber
+# preview, comparing the change records with closures over eyed3 objects (how
+# changes used to be kept until confirmation).
+#
+#   python -m benchmarks.bench_preview_memory --albums 50 --chapters 40
+
+import argparse
+import logging
+import tempfile
+import time
+import tracemalloc
+import eyed3
+from kaudiobooks import id3
+from kaudiobooks.kaudiobooks import map_albums, tag_to_name_album, iter_changes
+from kaudiobooks.walk import walk_albums
+from benchmarks.synthlib import make_library
+
+
+def plan_records(root):
+  args = argparse.Namespace(root=root, jobs=1, renumber=True, padding=id3.DEFAULT_PADDING, tag_index=None)
+  return [c for c in map_albums(args, tag_to_name_album) if c]
+
+
+def plan_closures(root):
+  changes = []
+  for album in walk_albums(root):
+    for f in album.chapters:
+      audio_file = eyed3.load(f"{album.path}/{f}")
+      def commit():
+        audio_file.tag.save()
+      changes.append(commit)
+  return changes
+
+
+def bench(name, plan, root):
+  tracemalloc.start()
+  start = time.perf_counter()
+  changes = plan(root)
+  elapsed = time.perf_counter() - start
+  retained, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  count = len(list(iter_changes(changes)))
+  print(f"{name:>9}: {count} changes, retained {retained / 2**20:8.2f} MiB ({retained / count:7.0f} B/change), peak {peak / 2**20:8.2f} MiB, {elapsed:.2f}s")
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--albums", type=int, default=50)
+  parser.add_argument("--chapters", type=int, default=40)
+  parser.add_argument("--cover-size", type=int, default=0, help="size of an embedded APIC frame per chapter")
+  args = parser.parse_args()
+
+  logging.getLogger("eyed3").setLevel(logging.CRITICAL)
+  logging.getLogger("kaudiobooks").setLevel(logging.WARNING)
+  with tempfile.TemporaryDirectory() as root:
+    make_library(root, args.albums, args.chapters, cover_size=args.cover_size)
+    bench("records", plan_records, root)
+    bench("closures", plan_closures, root)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,123 @@
+# Measures the startup of the cli: the import time (from -X importtime) and
+# the wall time of commands run on an empty library. Fails if a command spends
+# more than --budget milliseconds importing or imports one of the modules only
+# download and convert need, so slow imports don't creep back in.
+#
+#   python -m benchmarks.bench_startup
+#   python -m benchmarks.bench_startup purge verify --runs 20 --budget 80
+
+import os
+import sys
+import argparse
+import statistics
+import subprocess
+import tempfile
+import time
+
+MAIN = 'import sys; from kaudiobooks.kaudiobooks import main; sys.argv[0] = "kaudiobooks"; main()'
+
+# the arguments of each command, run on an empty library
+COMMANDS = {
+  "purge": ["purge"],
+  "sanitize-dirnames": ["sanitize-dirnames"],
+  "tag-to-dirname": ["tag-to-dirname"],
+  "dirname-to-tag": ["dirname-to-tag"],
+  "tag-to-name": ["tag-to-name"],
+  "pipeline": ["pipeline", "dirname-to-tag", "tag-to-name", "tag-to-dirname"],
+  "verify": ["verify", "--no-file-cache"],
+  "catalog": ["catalog", "--no-file-cache"],
+  "dedupe": ["dedupe", "--no-file-cache"],
+}
+
+# modules none of the commands above may import, with their submodules
+FORBIDDEN = ["audible", "audible_cli", "httpx", "asyncio", "eyed3", "numpy", "cProfile", "ctypes", "subprocess", "kaudiobooks.splitter", "kaudiobooks.transcoder", "kaudiobooks.snapshot", "kaudiobooks.plan"]
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# the total import time in ms and {module: (self ms, cumulative ms)}
+def parse_importtime(stderr):
+  total = 0
+  modules = {}
+  for line in stderr.splitlines():
+    if not line.startswith("import time:") or "|" not in line:
+      continue
+    fields = line[len("import time:"):].split("|")
+    if not fields[0].strip().isdigit():
+      # the header line
+      continue
+    # nested imports are indented by two more spaces
+    name = fields[2][1:].rstrip()
+    self_us, cumulative_us = int(fields[0]), int(fields[1])
+    if not name.startswith(" "):
+      total += cumulative_us
+    modules[name.strip()] = (self_us / 1000, cumulative_us / 1000)
+  return total / 1000, modules
+
+
+def run(argv, env, importtime):
+  command = [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-c", MAIN] + argv
+  start = time.perf_counter()
+  result = subprocess.run(command, capture_output=True, text=True, env=env, cwd=PACKAGE_DIR)
+  elapsed = (time.perf_counter() - start) * 1000
+  if result.returncode != 0:
+    raise RuntimeError(f"{' '.join(argv)} failed:\n{result.stderr}")
+  return elapsed, result.stderr
+
+
+def interpreter_startup(runs):
+  times = []
+  for _ in range(runs):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "pass"], check=True)
+    times.append((time.perf_counter() - start) * 1000)
+  return statistics.median(times)
+
+
+def benchmark(command, options, env, root):
+  argv = COMMANDS[command] + ["--root", root, "--no-journal", "--no-tag-index"]
+  walls = [run(argv, env, False)[0] for _ in range(options.runs)]
+  imports = []
+  modules = {}
+  for _ in range(options.runs):
+    total, modules = parse_importtime(run(argv, env, True)[1])
+    imports.append(total)
+  forbidden = [name for name in FORBIDDEN if any(module == name or module.startswith(f"{name}.") for module in modules)]
+  slowest = sorted(modules.items(), key=lambda entry: entry[1][0], reverse=True)[:options.top]
+  return statistics.median(walls), statistics.median(imports), forbidden, slowest
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("commands", nargs="*", help=f"the commands to measure, all by default ({', '.join(COMMANDS)})")
+  parser.add_argument("--runs", type=int, default=10, help="runs per command, the median is reported")
+  parser.add_argument("--budget", type=float, default=150, help="the milliseconds a command may spend importing")
+  parser.add_argument("--top", type=int, default=5, help="how many of the slowest imports (by own time) to show")
+  options = parser.parse_args()
+  unknown = [command for command in options.commands if command not in COMMANDS]
+  if unknown:
+    parser.error(f"unknown commands: {', '.join(unknown)}")
+
+  print(f"interpreter startup: {interpreter_startup(options.runs):.1f}ms")
+  failed = False
+  with tempfile.TemporaryDirectory() as tmp:
+    root = f"{tmp}/library"
+    os.mkdir(root)
+    # keep the caches and state of the runs out of the home directory
+    env = dict(os.environ, XDG_CACHE_HOME=f"{tmp}/cache", XDG_STATE_HOME=f"{tmp}/state")
+    for command in options.commands or list(COMMANDS):
+      wall, imports, forbidden, slowest = benchmark(command, options, env, root)
+      over = imports > options.budget
+      print(f"{command:>20}: {wall:7.1f}ms wall, {imports:7.1f}ms importing{' (over budget)' if over else ''}")
+      for name, (self_ms, cumulative_ms) in slowest:
+        print(f"{'':>22}{self_ms:7.1f}ms {name} ({cumulative_ms:.1f}ms with its imports)")
+      if forbidden:
+        print(f"{'':>22}imports {', '.join(forbidden)}")
+      failed = failed or over or bool(forbidden)
+  if failed:
+    print(f"startup regressed (budget {options.budget:.0f}ms, forbidden modules: {', '.join(FORBIDDEN)})")
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
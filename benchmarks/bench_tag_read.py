@@ -0,0 +1,41 @@
+
+# Compares the header-only id3 reader with eyed3.load on a synthetic library.
+#
+#   python -m benchmarks.bench_tag_read --albums 20 --chapters 50
+
+import argparse
+import logging
+import tempfile
+import time
+import eyed3
+from kaudiobooks import id3
+from benchmarks.synthlib import make_library
+
+
+def bench(name, load, paths):
+  start = time.perf_counter()
+  for path in paths:
+    tag = load(path)
+    tag.title, tag.album, tag.artist, tag.track_num
+  elapsed = time.perf_counter() - start
+  print(f"{name:>10}: {len(paths) / elapsed:10.0f} files/sec ({elapsed:.3f}s)")
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--albums", type=int, default=20)
+  parser.add_argument("--chapters", type=int, default=50)
+  parser.add_argument("--frames", type=int, default=64, help="mpeg frames per chapter")
+  parser.add_argument("--cover-size", type=int, default=0, help="size of an embedded APIC frame per chapter")
+  args = parser.parse_args()
+
+  logging.getLogger("eyed3").setLevel(logging.CRITICAL)
+  with tempfile.TemporaryDirectory() as root:
+    paths = make_library(root, args.albums, args.chapters, args.frames, args.cover_size)
+    print(f"{len(paths)} files")
+    bench("eyed3", lambda path: eyed3.load(path).tag, paths)
+    bench("id3", id3.load, paths)
+
+
+if __name__ == "__main__":
+  main()
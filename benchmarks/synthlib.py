@@ -0,0 +1,98 @@
+
+# Generates synthetic audiobook libraries: directories of tiny but valid mp3
+# files (silent MPEG-1 layer III frames) carrying id3v2.4 tags.
+#
+#   python -m benchmarks.synthlib /tmp/library --albums 200 --chapters 30 --messy
+
+import os
+import argparse
+
+# MPEG-1 layer III, 128 kbit/s, 44.1 kHz, no padding: 417 bytes per frame
+FRAME_HEADER = b"\xff\xfb\x90\x64"
+FRAME = FRAME_HEADER + b"\0" * (417 - len(FRAME_HEADER))
+
+
+def synchsafe(n):
+  return bytes([(n >> 21) & 0x7f, (n >> 14) & 0x7f, (n >> 7) & 0x7f, n & 0x7f])
+
+
+def text_frame(frame_id, text):
+  body = b"\x03" + text.encode("utf-8")
+  return frame_id + synchsafe(len(body)) + b"\0\0" + body
+
+
+def id3v2_tag(title, album, artist, track_num, cover_size=0, padding=256):
+  frames = b"".join([
+    text_frame(b"TIT2", title),
+    text_frame(b"TALB", album),
+    text_frame(b"TPE1", artist),
+    text_frame(b"TRCK", str(track_num[0]) if track_num[1] is None else f"{track_num[0]}/{track_num[1]}"),
+  ])
+  if cover_size:
+    body = b"\0image/jpeg\0\x03\0" + b"\xaa" * cover_size
+    frames += b"APIC" + synchsafe(len(body)) + b"\0\0" + body
+  frames += b"\0" * padding
+  return b"ID3\x04\0\0" + synchsafe(len(frames)) + frames
+
+
+def make_chapter(path, title, album, artist, track_num, frames=8, cover_size=0):
+  with open(path, "wb") as f:
+    f.write(id3v2_tag(title, album, artist, track_num, cover_size))
+    f.write(FRAME * frames)
+
+
+# names as downloads tend to have them: characters kaudiobooks sanitizes,
+# non-ascii letters and titles that differ between tags and file names
+MESSY_ALBUMS = ['Book {}: The "Return"?', "Böok {} | Part <1>", "Book {}*", "Büch {} – Teil 1"]
+MESSY_ARTISTS = ["Author {}", "A. Author {}: Jr.", "Åuthor {} & Co?"]
+
+
+def album_names(a, messy):
+  if not messy:
+    return f"Book {a}", f"Author {a}"
+  return MESSY_ALBUMS[a % len(MESSY_ALBUMS)].format(a), MESSY_ARTISTS[a % len(MESSY_ARTISTS)].format(a)
+
+
+# clean libraries are already in kaudiobooks' layout except for the chapter
+# file names. Messy ones need work from every command: unsanitized directory
+# and file names, tags disagreeing with the names, missing track totals, and
+# cover images and playlists next to the chapters.
+def make_library(root, albums, chapters, frames=8, cover_size=0, messy=False):
+  paths = []
+  for a in range(albums):
+    album, artist = album_names(a, messy)
+    album_path = f"{root}/{album} -- {artist}"
+    os.makedirs(album_path, exist_ok=True)
+    for c in range(chapters):
+      if messy:
+        path = f"{album_path}/{album} -- {c + 1} -- Chapter {c + 1}?.mp3"
+        track_num = (c + 1, None if a % 2 else chapters)
+        make_chapter(path, f"Chapter {c + 1}: Part/{c + 1}", album.upper(), artist, track_num, frames, cover_size)
+      else:
+        path = f"{album_path}/chapter {c + 1}.mp3"
+        make_chapter(path, f"Chapter {c + 1}", album, artist, (c + 1, chapters), frames, cover_size)
+      paths.append(path)
+    if messy:
+      with open(f"{album_path}/cover.jpg", "wb") as f:
+        f.write(b"\xff\xd8\xff\xe0" + b"\0" * 1024)
+      with open(f"{album_path}/{album}.m3u", "w") as f:
+        f.write("".join(f"{os.path.basename(p)}\n" for p in paths[-chapters:]))
+  return paths
+
+
+def main():
+  parser = argparse.ArgumentParser(description="generates a synthetic audiobook library")
+  parser.add_argument("root", type=str, help="the directory the albums are created in")
+  parser.add_argument("--albums", type=int, default=20)
+  parser.add_argument("--chapters", type=int, default=50)
+  parser.add_argument("--frames", type=int, default=8, help="mpeg frames per chapter")
+  parser.add_argument("--cover-size", type=int, default=0, help="size of an embedded APIC frame per chapter")
+  parser.add_argument("--messy", action='store_true', help="use unsanitized names and tags that disagree with them")
+  args = parser.parse_args()
+
+  paths = make_library(args.root, args.albums, args.chapters, args.frames, args.cover_size, args.messy)
+  print(f"{len(paths)} chapters in {args.albums} albums")
+
+
+if __name__ == "__main__":
+  main()
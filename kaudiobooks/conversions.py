@@ -0,0 +1,113 @@
+
+# Remembers which library items were converted into which output directory,
+# so `convert` can skip them. Each converted directory also gets a marker file
+# holding the asin, so entries can be found again after the directory was
+# renamed (e.g. by tag-to-dirname). An entry counts as complete while its
+# directory holds the recorded number of chapters. The size is not compared,
+# as later tag changes may legitimately change it.
+
+import os
+import json
+import logging
+import tempfile
+
+log = logging.getLogger(__name__)
+
+INDEX_NAME = ".kaudiobooks-converted.json"
+MARKER_NAME = ".kaudiobooks-asin"
+
+
+def output_stats(path):
+  chapters = 0
+  size = 0
+  with os.scandir(path) as it:
+    for entry in it:
+      if entry.is_file() and entry.name.endswith(".mp3"):
+        chapters += 1
+        size += entry.stat().st_size
+  return chapters, size
+
+
+# the number of chapters `audible download --chapter` recorded for a source
+def expected_chapters(source_path, base_filename):
+  path = f"{os.path.dirname(source_path)}/{base_filename}-chapters.json"
+  try:
+    with open(path) as f:
+      chapter_info = json.load(f)["content_metadata"]["chapter_info"]
+  except (OSError, ValueError, KeyError):
+    return None
+  return count_chapters(chapter_info["chapters"])
+
+
+# chapters files written with the tree chapter type nest the sub chapters
+def count_chapters(chapters):
+  return sum(1 + count_chapters(chapter.get("chapters", [])) for chapter in chapters)
+
+
+class ConversionIndex:
+
+  def __init__(self, output_dir):
+    self.output_dir = output_dir
+    self.path = f"{output_dir}/{INDEX_NAME}"
+    try:
+      with open(self.path) as f:
+        self.entries = json.load(f)
+    except FileNotFoundError:
+      self.entries = {}
+    self.rescanned = False
+
+  def read_marker(self, name):
+    try:
+      with open(f"{self.output_dir}/{name}/{MARKER_NAME}") as f:
+        return f.read().strip()
+    except OSError:
+      return None
+
+  # finds renamed output directories by their markers
+  def rescan(self):
+    if self.rescanned:
+      return
+    self.rescanned = True
+    with os.scandir(self.output_dir) as it:
+      for entry in it:
+        if entry.is_dir():
+          asin = self.read_marker(entry.name)
+          if asin in self.entries and self.entries[asin]["dir"] != entry.name:
+            log.debug(f"converted `{asin}` was moved to `{entry.name}`")
+            self.entries[asin]["dir"] = entry.name
+
+  def dir(self, asin):
+    entry = self.entries.get(asin)
+    if entry is None:
+      return None
+    if self.read_marker(entry["dir"]) != asin:
+      self.rescan()
+    if self.read_marker(entry["dir"]) == asin:
+      return entry["dir"]
+
+  def save(self):
+    fd, tmp_path = tempfile.mkstemp(dir=self.output_dir, prefix=".kaudiobooks-")
+    with os.fdopen(fd, "w") as f:
+      json.dump(self.entries, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, self.path)
+
+  # returns "complete", "partial" or "missing"
+  def status(self, asin):
+    name = self.dir(asin)
+    if name is None:
+      return "missing"
+    entry = self.entries[asin]
+    if entry["expected_chapters"] is not None and entry["chapters"] < entry["expected_chapters"]:
+      return "partial"
+    chapters, _ = output_stats(f"{self.output_dir}/{name}")
+    if chapters != entry["chapters"]:
+      return "partial"
+    return "complete"
+
+  def record(self, asin, name, source, expected=None):
+    with open(f"{self.output_dir}/{name}/{MARKER_NAME}", "w") as f:
+      f.write(asin + "\n")
+    chapters, size = output_stats(f"{self.output_dir}/{name}")
+    self.entries[asin] = {"dir": name, "chapters": chapters, "size": size, "expected_chapters": expected, "source": os.path.basename(source)}
+    self.save()
+    return chapters, size
@@ -0,0 +1,131 @@
+
+# Downloads files over http into `<path>.part` and only moves them to `path`
+# once their size (and checksum, if one is known) was verified. Interrupted
+# transfers are resumed with range requests from where the part file ends,
+# also across runs.
+
+import os
+import re
+import time
+import hashlib
+import logging
+import shutil
+import http.client
+import urllib.error
+import urllib.request
+
+log = logging.getLogger(__name__)
+
+PART_SUFFIX = ".part"
+CHUNK_SIZE = 1 << 20
+RETRIES = 3
+RETRY_DELAY = 2
+TIMEOUT = 60
+
+
+class DownloadError(Exception):
+  pass
+
+
+def part_size(part):
+  try:
+    return os.path.getsize(part)
+  except FileNotFoundError:
+    return 0
+
+
+# "bytes 100-199/200" -> (100, 200), the total may be unknown ("*")
+def parse_content_range(value):
+  match = re.fullmatch(r"bytes (?:(\d+)-\d+|\*)/(\d+|\*)", (value or "").strip())
+  if match is None:
+    return None, None
+  start, total = match.groups()
+  return (None if start is None else int(start)), (None if total == "*" else int(total))
+
+
+# one request appending to the part file, returns the total size the server
+# announced (or None)
+def transfer(url, part, headers, timeout):
+  offset = part_size(part)
+  request = urllib.request.Request(url, headers=headers or {})
+  if offset:
+    request.add_header("Range", f"bytes={offset}-")
+  try:
+    response = urllib.request.urlopen(request, timeout=timeout)
+  except urllib.error.HTTPError as e:
+    if e.code == 416 and offset:
+      # the part file is complete (or too large, which verify will tell)
+      _, total = parse_content_range(e.headers.get("Content-Range"))
+      return total
+    raise
+  with response:
+    if response.status == 206:
+      start, total = parse_content_range(response.headers.get("Content-Range"))
+      if start != offset:
+        raise DownloadError(f"asked for bytes from {offset}, got them from {start}")
+      mode = "ab"
+    else:
+      # the server ignored the range, start over
+      if offset:
+        log.debug(f"server does not resume, downloading `{url}` again")
+      length = response.headers.get("Content-Length")
+      total = int(length) if length is not None else None
+      mode = "wb"
+    with open(part, mode) as f:
+      shutil.copyfileobj(response, f, CHUNK_SIZE)
+  return total
+
+
+def file_checksum(path, algorithm):
+  digest = hashlib.new(algorithm)
+  with open(path, "rb") as f:
+    while chunk := f.read(CHUNK_SIZE):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+
+def verify(part, size, checksum):
+  actual = part_size(part)
+  if size is not None and actual != size:
+    raise DownloadError(f"got {actual} of {size} bytes")
+  if checksum is not None:
+    algorithm, expected = checksum.split(":", 1)
+    actual = file_checksum(part, algorithm)
+    if actual != expected.lower():
+      raise DownloadError(f"{algorithm} checksum is {actual} instead of {expected}")
+
+
+# downloads `url` to `path`. `size` is the expected size in bytes and
+# `checksum` is "<hashlib algorithm>:<hexdigest>", both are optional. Blocks,
+# so run it in a thread from async code.
+def fetch(url, path, size=None, checksum=None, headers=None, retries=RETRIES, timeout=TIMEOUT):
+  part = path + PART_SUFFIX
+  if part_size(part):
+    log.info(f"resuming `{os.path.basename(path)}` at {part_size(part)} bytes")
+  attempt = 0
+  while True:
+    try:
+      total = transfer(url, part, headers, timeout)
+      # without a length from the server only the expected size tells whether
+      # the connection was closed early
+      expected = total if total is not None else size
+      if expected is None or part_size(part) >= expected:
+        break
+      raise DownloadError(f"connection closed after {part_size(part)} of {expected} bytes")
+    except (OSError, http.client.HTTPException, DownloadError) as e:
+      if isinstance(e, urllib.error.HTTPError) and e.code < 500:
+        raise DownloadError(f"{e.code} {e.reason}") from e
+      attempt += 1
+      if attempt > retries:
+        raise DownloadError(f"giving up after {retries} retries: {e}") from e
+      log.warning(f"download of `{os.path.basename(path)}` interrupted ({e}), resuming")
+      time.sleep(RETRY_DELAY * attempt)
+  try:
+    verify(part, size if size is not None else total, checksum)
+  except DownloadError:
+    # a short part is kept by the loop above, one failing here is broken and
+    # can't be resumed, the next run starts over
+    os.remove(part)
+    raise
+  os.replace(part, path)
+  return path
@@ -0,0 +1,67 @@
+
+# An on-disk cache of results computed from whole files (audio hashes,
+# verification results, ...). Entries are keyed by the kind of result and the
+# absolute path and only used while size and mtime of the file still match.
+
+import os
+import json
+import sqlite3
+import logging
+from .tagindex import set_wal
+
+log = logging.getLogger(__name__)
+
+SCHEMA_VERSION = 1
+
+
+class FileCache:
+
+  def __init__(self, path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    self.db = sqlite3.connect(path, timeout=60)
+    set_wal(self.db)
+    self.db.execute("pragma synchronous=normal")
+    self.db.execute("begin immediate")
+    version = self.db.execute("pragma user_version").fetchone()[0]
+    if version != SCHEMA_VERSION:
+      log.debug(f"recreating file cache {path} (schema {version})")
+      self.db.execute("drop table if exists results")
+      self.db.execute('''create table results (
+        kind text not null,
+        path text not null,
+        size integer not null,
+        mtime integer not null,
+        value text not null,
+        primary key (kind, path)
+      )''')
+      self.db.execute(f"pragma user_version={SCHEMA_VERSION}")
+    self.db.commit()
+
+  # the cached value, None if there is none for this size and mtime
+  def get(self, kind, path, st):
+    row = self.db.execute(
+      "select value from results where kind = ? and path = ? and size = ? and mtime = ?",
+      (kind, os.path.abspath(path), st.st_size, st.st_mtime_ns)).fetchone()
+    if row is not None:
+      return json.loads(row[0])
+
+  def put(self, kind, path, st, value):
+    self.db.execute(
+      "insert or replace into results values (?, ?, ?, ?, ?)",
+      (kind, os.path.abspath(path), st.st_size, st.st_mtime_ns, json.dumps(value)))
+
+  def commit(self):
+    self.db.commit()
+
+
+# one connection per process and database, like the tag index
+connections = {}
+
+
+def open_cache(path):
+  key = (os.getpid(), path)
+  cache = connections.get(key)
+  if cache is None:
+    cache = FileCache(path)
+    connections[key] = cache
+  return cache
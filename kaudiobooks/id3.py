@@ -0,0 +1,325 @@
+
+# A minimal ID3v2.3/2.4 reader and writer for the few text frames kaudiobooks
+# touches. It only reads the tag at the start of the file (never the audio) and
+# skips the bodies of frames it doesn't need. Anything unusual is left to eyed3.
+
+import os
+import logging
+import struct
+from . import stats
+
+log = logging.getLogger(__name__)
+
+HEADER_SIZE = 10
+READ_SIZE = 16 * 1024
+COPY_SIZE = 1024 * 1024
+DEFAULT_PADDING = 4096
+CTOC_ENTRIES = 255
+
+TEXT_FRAMES = {
+  b"TIT2": "title",
+  b"TALB": "album",
+  b"TPE1": "artist",
+  b"TRCK": "track_num",
+}
+
+ENCODINGS = {
+  0: "latin-1",
+  1: "utf-16",
+  2: "utf-16-be",
+  3: "utf-8",
+}
+
+# frame format flags we cannot handle without decoding the frame body
+UNSUPPORTED_FRAME_FLAGS = {
+  3: 0x00c0, # compression, encryption
+  4: 0x000f, # compression, encryption, unsynchronisation, data length indicator
+}
+GROUPING_FRAME_FLAG = {
+  3: 0x0020,
+  4: 0x0040,
+}
+
+
+class UnsupportedTag(Exception):
+  pass
+
+
+class Tag:
+  # `size` is the space of the tag without its header, `other_size` the part
+  # of it used by frames other than TEXT_FRAMES
+  __slots__ = ("title", "album", "artist", "track_num", "version", "size", "other_size")
+
+  def __init__(self, version, size=None, other_size=None):
+    self.title = None
+    self.album = None
+    self.artist = None
+    self.track_num = (None, None)
+    self.version = version
+    self.size = size
+    self.other_size = other_size
+
+
+def synchsafe(data):
+  return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+
+def decode_text(body):
+  if len(body) == 0:
+    return None
+  encoding = ENCODINGS.get(body[0])
+  if encoding is None:
+    raise UnsupportedTag(f"unknown text encoding: {body[0]}")
+  return body[1:].decode(encoding).rstrip("\0")
+
+
+def parse_track_num(text):
+  if not text:
+    return (None, None)
+  num, _, total = text.partition("/")
+  try:
+    return (int(num), int(total) if total else None)
+  except ValueError:
+    raise UnsupportedTag(f"unparsable track number: {text}")
+
+
+class Reader:
+
+  def __init__(self, f):
+    self.f = f
+    self.offset = 0
+    self.buffer = f.read(READ_SIZE)
+
+  # returns `size` bytes at `offset`, reading past the buffer only if needed
+  def get(self, offset, size):
+    start = offset - self.offset
+    if start < 0 or start + size > len(self.buffer):
+      self.f.seek(offset)
+      self.offset = offset
+      self.buffer = self.f.read(max(size, READ_SIZE))
+      start = 0
+    return self.buffer[start:start + size]
+
+
+# returns the version, the end of the tag and the position of the first frame
+def read_header(reader):
+  header = reader.get(0, HEADER_SIZE)
+  if len(header) < HEADER_SIZE or header[:3] != b"ID3":
+    raise UnsupportedTag("no id3v2 tag")
+  version = header[3]
+  flags = header[5]
+  if version not in (3, 4):
+    raise UnsupportedTag(f"id3v2.{version}")
+  if flags & 0x80:
+    raise UnsupportedTag("unsynchronised tag")
+  if flags & 0x10:
+    raise UnsupportedTag("tag with footer")
+  end = HEADER_SIZE + synchsafe(header[6:10])
+
+  pos = HEADER_SIZE
+  if flags & 0x40:
+    ext = reader.get(pos, 4)
+    if version == 3:
+      pos += 4 + struct.unpack(">I", ext)[0]
+    else:
+      pos += synchsafe(ext)
+  return version, end, pos
+
+
+# yields (frame id, flags, position, size of the body) of all frames
+def iter_frames(reader, version, pos, end):
+  while pos + HEADER_SIZE <= end:
+    frame_header = reader.get(pos, HEADER_SIZE)
+    if len(frame_header) < HEADER_SIZE:
+      raise UnsupportedTag("truncated tag")
+    frame_id = frame_header[:4]
+    if frame_id[0] == 0:
+      break
+    if version == 4:
+      size = synchsafe(frame_header[4:8])
+    else:
+      size = struct.unpack(">I", frame_header[4:8])[0]
+    frame_flags = struct.unpack(">H", frame_header[8:10])[0]
+    if pos + HEADER_SIZE + size > end:
+      raise UnsupportedTag(f"frame {frame_id} exceeds tag size")
+    yield frame_id, frame_flags, pos, size
+    pos += HEADER_SIZE + size
+
+
+def read_text_frame(reader, tag, frame_id, frame_flags, pos, size):
+  if frame_flags & UNSUPPORTED_FRAME_FLAGS[tag.version]:
+    raise UnsupportedTag(f"frame {frame_id} has flags {frame_flags:#06x}")
+  body = reader.get(pos + HEADER_SIZE, size)
+  if frame_flags & GROUPING_FRAME_FLAG[tag.version]:
+    body = body[1:]
+  text = decode_text(body)
+  name = TEXT_FRAMES[frame_id]
+  if name == "track_num":
+    tag.track_num = parse_track_num(text)
+  else:
+    setattr(tag, name, text)
+
+
+def read(f):
+  reader = Reader(f)
+  version, end, pos = read_header(reader)
+  tag = Tag(version, end - HEADER_SIZE, 0)
+  for frame_id, frame_flags, pos, size in iter_frames(reader, version, pos, end):
+    if frame_id in TEXT_FRAMES:
+      read_text_frame(reader, tag, frame_id, frame_flags, pos, size)
+    else:
+      tag.other_size += HEADER_SIZE + size
+  return tag
+
+
+def load(path):
+  try:
+    with stats.phase("tag-parse", path), open(path, "rb") as f:
+      tag = read(f)
+      stats.add_bytes("tag-parse", read=f.tell())
+      return tag
+  except (UnsupportedTag, UnicodeDecodeError) as e:
+    log.debug(f"falling back to eyed3 for `{path}`: {e}")
+    # imported on demand, it is slow to import and rarely needed
+    import eyed3
+    return eyed3.load(path).tag
+
+
+def render_synchsafe(n):
+  return bytes([(n >> 21) & 0x7f, (n >> 14) & 0x7f, (n >> 7) & 0x7f, n & 0x7f])
+
+
+def render_header(version, size):
+  return b"ID3" + bytes([version, 0, 0]) + render_synchsafe(size)
+
+
+def render_frame(version, frame_id, body):
+  size = render_synchsafe(len(body)) if version == 4 else struct.pack(">I", len(body))
+  return frame_id + size + b"\0\0" + body
+
+
+def render_text_frame(version, frame_id, text):
+  if version == 4:
+    body = b"\x03" + text.encode("utf-8")
+  else:
+    try:
+      body = b"\x00" + text.encode("latin-1")
+    except UnicodeEncodeError:
+      body = b"\x01" + text.encode("utf-16")
+  return render_frame(version, frame_id, body)
+
+
+# the text frames of `tag` after applying `fields`
+def render_text_frames(tag, fields):
+  frames = []
+  for frame_id, name in TEXT_FRAMES.items():
+    value = fields.get(name, getattr(tag, name))
+    if name == "track_num":
+      num, total = value
+      if num is None:
+        continue
+      value = str(num) if total is None else f"{num}/{total}"
+    if value is not None:
+      frames.append(render_text_frame(tag.version, frame_id, value))
+  return b"".join(frames)
+
+
+# CHAP frames for `chapters`, a list of (title, start ms, end ms), and the
+# CTOC frames listing them in order. A CTOC holds at most 255 entries, longer
+# books get a top level CTOC of several CTOCs.
+def render_chapter_frames(chapters, version=4):
+  frames = []
+  ids = []
+  for i, (title, start, end) in enumerate(chapters):
+    element_id = f"chp{i}".encode("latin-1")
+    ids.append(element_id)
+    body = element_id + b"\0" + struct.pack(">IIII", start, end, 0xffffffff, 0xffffffff)
+    frames.append(render_frame(version, b"CHAP", body + render_text_frame(version, b"TIT2", title)))
+
+  def toc(element_id, children, top_level):
+    flags = 0x03 if top_level else 0x01
+    body = element_id + b"\0" + bytes([flags, len(children)]) + b"".join(child + b"\0" for child in children)
+    frames.append(render_frame(version, b"CTOC", body))
+
+  if len(ids) <= CTOC_ENTRIES:
+    toc(b"toc", ids, True)
+  else:
+    groups = [ids[i:i + CTOC_ENTRIES] for i in range(0, len(ids), CTOC_ENTRIES)]
+    toc(b"toc", [f"toc{i}".encode("latin-1") for i in range(len(groups))], True)
+    for i, group in enumerate(groups):
+      toc(f"toc{i}".encode("latin-1"), group, False)
+  return b"".join(frames)
+
+
+# a complete tag holding `fields` and the already rendered `frames`
+def render_tag(fields, frames=b"", padding=DEFAULT_PADDING, version=4):
+  frames = render_text_frames(Tag(version), fields) + frames
+  return render_header(version, len(frames) + padding) + frames + b"\0" * padding
+
+
+# whether saving `fields` outgrows the tag and requires rewriting the whole
+# file, None if that is unknown (the tag is handled by eyed3)
+def rewrite_required(tag, fields):
+  if not isinstance(tag, Tag) or tag.size is None:
+    return None
+  return tag.other_size + len(render_text_frames(tag, fields)) > tag.size
+
+
+def rewrite(path, version, frames, padding, audio_pos):
+  # only needed by the few saves that do not fit, kept off the start
+  import shutil
+  import tempfile
+  fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".kaudiobooks-", suffix=".mp3")
+  try:
+    with os.fdopen(fd, "wb") as out, open(path, "rb") as f:
+      out.write(render_header(version, len(frames) + padding))
+      out.write(frames)
+      out.write(b"\0" * padding)
+      f.seek(audio_pos)
+      shutil.copyfileobj(f, out, COPY_SIZE)
+    shutil.copymode(path, tmp_path)
+    os.replace(tmp_path, path)
+  except:
+    os.remove(tmp_path)
+    raise
+
+
+# prepends a new tag holding `fields` to the untagged file `path`
+def create(path, fields, padding=DEFAULT_PADDING, version=4):
+  rewrite(path, version, render_text_frames(Tag(version), fields), padding, 0)
+
+
+# writes `fields` into the tag of `path`. The tag is overwritten in place if the
+# new frames fit into it, otherwise the file is rewritten with `padding` bytes
+# reserved for later changes. Returns whether the file was rewritten.
+def save(path, fields, padding=DEFAULT_PADDING):
+  try:
+    with open(path, "r+b") as f:
+      reader = Reader(f)
+      version, end, pos = read_header(reader)
+      tag = Tag(version)
+      other = []
+      for frame_id, frame_flags, pos, size in iter_frames(reader, version, pos, end):
+        if frame_id in TEXT_FRAMES:
+          read_text_frame(reader, tag, frame_id, frame_flags, pos, size)
+        else:
+          other.append(reader.get(pos, HEADER_SIZE + size))
+      frames = b"".join(other) + render_text_frames(tag, fields)
+      space = end - HEADER_SIZE
+      if len(frames) <= space:
+        f.seek(0)
+        f.write(render_header(version, space) + frames + b"\0" * (space - len(frames)))
+        stats.add_bytes("tag-save", written=end)
+        return False
+  except (UnsupportedTag, UnicodeDecodeError) as e:
+    log.debug(f"saving with eyed3 for `{path}`: {e}")
+    import eyed3
+    tag = eyed3.load(path).tag
+    for name, value in fields.items():
+      setattr(tag, name, value)
+    tag.save()
+    return None
+  log.debug(f"rewriting `{path}`: tag grows to {len(frames)} bytes")
+  rewrite(path, version, frames, padding, end)
+  stats.add_bytes("tag-save", written=os.path.getsize(path))
+  return True
@@ -0,0 +1,101 @@
+
+# A minimal ctypes binding of the linux inotify api, just what `watch` needs.
+
+import os
+import errno
+import ctypes
+import ctypes.util
+import select
+import struct
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+EVENT_HEADER = struct.Struct("iIII")
+READ_SIZE = 64 * 1024
+
+_libc = None
+
+
+def libc():
+  global _libc
+  if _libc is None:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    _libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    _libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+  return _libc
+
+
+def check(result, what):
+  if result < 0:
+    error = ctypes.get_errno()
+    raise OSError(error, f"{what}: {os.strerror(error)}")
+  return result
+
+
+class Event:
+  __slots__ = ("wd", "mask", "cookie", "name")
+
+  def __init__(self, wd, mask, cookie, name):
+    self.wd = wd
+    self.mask = mask
+    self.cookie = cookie
+    self.name = name
+
+  @property
+  def is_dir(self):
+    return bool(self.mask & IN_ISDIR)
+
+
+class Inotify:
+
+  def __init__(self):
+    self.fd = check(libc().inotify_init1(IN_NONBLOCK | IN_CLOEXEC), "inotify_init1")
+
+  def fileno(self):
+    return self.fd
+
+  # returns the watch descriptor, the existing one if `path` is watched already
+  def add_watch(self, path, mask):
+    return check(libc().inotify_add_watch(self.fd, os.fsencode(path), mask), f"inotify_add_watch `{path}`")
+
+  def rm_watch(self, wd):
+    if libc().inotify_rm_watch(self.fd, wd) < 0 and ctypes.get_errno() != errno.EINVAL:
+      check(-1, "inotify_rm_watch")
+
+  # the pending events, waiting up to `timeout` seconds (forever if None) for
+  # the first one
+  def read(self, timeout=0):
+    if timeout != 0:
+      poll = select.poll()
+      poll.register(self.fd, select.POLLIN)
+      if not poll.poll(None if timeout is None else max(0, int(timeout * 1000))):
+        return []
+    events = []
+    while True:
+      try:
+        data = os.read(self.fd, READ_SIZE)
+      except BlockingIOError:
+        return events
+      pos = 0
+      while pos < len(data):
+        wd, mask, cookie, size = EVENT_HEADER.unpack_from(data, pos)
+        pos += EVENT_HEADER.size
+        name = os.fsdecode(data[pos:pos + size].rstrip(b"\0"))
+        pos += size
+        events.append(Event(wd, mask, cookie, name))
+
+  def close(self):
+    os.close(self.fd)
@@ -0,0 +1,106 @@
+
+# An append-only journal of the changes of a commit. Every change is written as
+# planned before anything is applied and marked done once it was applied, so an
+# interrupted commit can be resumed from the journal without rescanning. Paths
+# are journaled absolute, so resuming works from any directory. A journal with
+# changes left is never overwritten by another commit, only by resuming it.
+#
+#   {"op": "plan", "id": 0, "album": 0, "change": {...}}
+#   {"op": "done", "id": 0}
+#   {"op": "failed", "id": 1, "error": "..."}
+#   {"op": "end"}
+
+import os
+import json
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class UnfinishedJournal(Exception):
+  pass
+
+
+class Journal:
+
+  def __init__(self, path, replace=False):
+    if not replace and unfinished(path):
+      raise UnfinishedJournal(f"`{path}` holds changes of an interrupted commit")
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    self.f = open(path, "w", encoding="utf-8")
+    self.ids = {}
+
+  def write(self, entry):
+    self.f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+  def plan(self, albums):
+    for album_id, album in enumerate(albums):
+      for change in album:
+        self.ids[id(change)] = len(self.ids)
+        self.write({"op": "plan", "id": self.ids[id(change)], "album": album_id, "change": absolute(change.to_json())})
+    self.sync()
+
+  def done(self, change, error=None):
+    if error is None:
+      self.write({"op": "done", "id": self.ids[id(change)]})
+    else:
+      self.write({"op": "failed", "id": self.ids[id(change)], "error": repr(error)})
+
+  # done changes are only flushed per album, a crash in between applies the
+  # changes of the album again on resume, which skips what is already done
+  def flush(self):
+    self.f.flush()
+
+  def end(self):
+    self.write({"op": "end"})
+    self.close()
+
+  def sync(self):
+    self.f.flush()
+    os.fsync(self.f.fileno())
+
+  def close(self):
+    self.sync()
+    self.f.close()
+
+
+def absolute(change):
+  return {key: os.path.abspath(value) if key in ("path", "new_path") and value is not None else value for key, value in change.items()}
+
+
+# marks a journal whose remaining changes turned out to be applied as finished
+def finish(path):
+  with open(path, "a", encoding="utf-8") as f:
+    f.write(json.dumps({"op": "end"}) + "\n")
+
+
+def unfinished(path):
+  return os.path.exists(path) and bool(read_remaining(path))
+
+
+# returns the changes (as json) of a journal that were not applied, grouped by
+# album. Failed changes count as not applied.
+def read_remaining(path):
+  planned = {}
+  albums = {}
+  done = set()
+  with open(path, encoding="utf-8") as f:
+    for line in f:
+      try:
+        entry = json.loads(line)
+      except json.JSONDecodeError:
+        # the last line may be cut off by a crash
+        log.debug(f"ignoring broken journal line: {line!r}")
+        continue
+      if entry["op"] == "plan":
+        planned[entry["id"]] = entry["change"]
+        albums[entry["id"]] = entry["album"]
+      elif entry["op"] == "done":
+        done.add(entry["id"])
+      elif entry["op"] == "end":
+        return []
+  remaining = {}
+  for change_id, change in planned.items():
+    if change_id not in done:
+      remaining.setdefault(albums[change_id], []).append(change)
+  return list(remaining.values())
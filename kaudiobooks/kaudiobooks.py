@@ -1,43 +1,29 @@
 
-import traceback
 import os
 import sys
 import argparse
-import asyncio
-from kpyutils.tree import *
-from kpyutils.cli import *
-import subprocess
-from datetime import datetime
-from audible_cli.models import Library
-from audible_cli.config import Session
+import importlib
 import logging
-import concurrent
-import eyed3
-from natsort import natsorted
+import functools
+import contextlib
+import collections
+import itertools
+from . import id3
+from . import journal
+from . import paths
+from . import renames
+from . import stats
+from . import mpeg
+from .walk import walk_albums, scan
 import re
+import time
+import json
+import unicodedata
 
-log = logging.getLogger(__name__)
-
-def ensure_audible_dir(args):
-   if args.audible_dir is None:
-      raise ValueError("either --audible-dir or KAUDIOBOOKS_AUDIBLE_DIR must be set")
-
-def make_date_args(args):
-   
-  start = ""
-  end = ""
-  if args.start_date is not None:
-    start = f'--start-date "{args.start_date}"'
-  if args.end_date is not None:
-    end = f'--end-date "{args.start_end}"'
-  return f' {start} {end}'
-
-def download(args):
-  ensure_audible_dir(args)
-  date_args = make_date_args(args)
-  
-  subprocess.run(f"audible download --output-dir '{args.audible_dir}' --pdf --cover --annotation --chapter --chapter-type Flat --quality best --aaxc --all {date_args}", shell=True)
+# commands import what only they need (sqlite3, mmap, hashlib, csv, the
+# converters, ...) when they run, so that every start stays fast
 
+log = logging.getLogger(__name__)
 
 def sanitize_filename(filename):
     replacements = {
@@ -73,9 +59,10 @@ def unsanitize_filename(sanitized_filename):
 # sanitized = sanitize_filename('example:filename?.txt')
 
 
-def is_chapter_file(path):
-  return path.endswith(".mp3")
 
+# names that are equal by this key collide, see renames.py
+def name_key(name):
+  return unicodedata.normalize("NFC", sanitize_filename(name))
 
 
 def show_string_diff(str1, str2):
@@ -94,309 +81,472 @@ dir_pattern = r"^(.+) -- (.+)$"
 
 
 
+# a pending change of a single chapter file. Unlike a closure it can be sent
+# back from a worker process and it holds no tag object: it only keeps the
+# changed fields and re-opens the file when it is applied. Changes of a whole
+# library are kept until confirmation, so all change records use __slots__.
+class ChapterChange:
+  __slots__ = ("path", "fields", "new_path", "rewrite", "padding")
 
-def purge(args):
-  def handle_album(album_path):
-    log.debug(f"handling album {album_path}")
-    is_audiobook = False
-    files = list(natsorted(os.listdir(album_path)))
-    for f in files:
-      if f.endswith(".mp3"):
-        is_audiobook = True
-        break
-    r = []
-
-    def handle_file(f):
-      log.debug(f"handling file {f}")
-      if f.endswith(".jpg") or f.endswith(".m3u"):
-        path = album_path + "/" + f
-        def remove():
-          os.remove(path)
-        log.info(f"deleting file: {path}")
-        r.append(remove)
-
-    if is_audiobook:
-      log.debug("it is an audiobook")
-      for f in files:
-        handle_file(f)
-    return r
-  changes = map_file_tree(args.root, handle_branch=handle_album)
-  execute_confirmed_changes(changes)
+  def __init__(self, path, fields=None, new_path=None, rewrite=False, padding=id3.DEFAULT_PADDING):
+    self.path = path
+    self.fields = fields or None
+    self.new_path = new_path
+    # whether saving the fields rewrites the whole file (None if unknown)
+    self.rewrite = rewrite
+    self.padding = padding
 
+  def __call__(self):
+    if self.fields:
+      with stats.phase("tag-save", self.path):
+        id3.save(self.path, self.fields, self.padding)
+    if self.new_path is not None:
+      with stats.phase("rename", self.path):
+        os.rename(self.path, self.new_path)
 
-def name_to_tag(args):
+  def update_index(self, index):
+    index.refresh(self.path, self.new_path or self.path)
 
+  def to_json(self):
+    return {"type": "chapter", "path": self.path, "fields": self.fields, "new_path": self.new_path, "rewrite": self.rewrite, "padding": self.padding}
 
-  def handle_album(album_path):
-    log.debug(f"handling album: {album_path}")
+  # the part of this change that is not yet applied, None if nothing is left
+  def resumed(self):
+    path = self.path
+    new_path = self.new_path
+    if not os.path.exists(path) and new_path is not None and os.path.exists(new_path):
+      path = new_path
+      new_path = None
+    fields = self.fields
+    if fields and os.path.exists(path):
+      tag = id3.load(path)
+      fields = {name: value for name, value in fields.items() if tag_value(tag, name) != value}
+    if fields or new_path is not None:
+      return ChapterChange(path, fields, new_path, self.rewrite if fields else False, self.padding)
 
-    files = list(filter(is_chapter_file, natsorted(os.listdir(album_path))))
-    
-    num_files = len(files)
 
-    digits = len(str(num_files))
-    log.debug(f"digits: {digits}")
-    index = 0
+# renaming of an album directory
+class Rename:
+  __slots__ = ("path", "new_path")
 
-    album_path = album_path.rstrip("/")
+  def __init__(self, path, new_path):
+    self.path = path
+    self.new_path = new_path
 
+  def __call__(self):
+    with stats.phase("rename", self.path):
+      os.rename(self.path, self.new_path)
 
-    def handle_chapter(child):
-      path = f"{album_path}/{child}"
-      nonlocal index
-      index += 1
-      log.debug(f"handling chapter ({index}): {path}")
-        
-      name = os.path.basename(path)
+  def update_index(self, index):
+    index.rename_tree(self.path, self.new_path)
 
+  def to_json(self):
+    return {"type": "rename", "path": self.path, "new_path": self.new_path}
 
+  def resumed(self):
+    if os.path.exists(self.path) or not os.path.exists(self.new_path):
+      return self
 
-      match = re.match(args.pattern, name)
-      if match:
-        try:
-          album = match.group("book")
-        except:
-          album = None
-        try:
-          track = match.group("track")
-        except:
-          track = None
-        try:
-          title = match.group("chapter")
-        except:
-          title = None
 
+class Removal:
+  __slots__ = ("path",)
 
+  def __init__(self, path):
+    self.path = path
 
-        change = False
+  def __call__(self):
+    with stats.phase("remove", self.path):
+      os.remove(self.path)
 
+  def update_index(self, index):
+    index.forget(self.path)
 
-        tag = eyed3.load(path).tag
-        
+  def to_json(self):
+    return {"type": "removal", "path": self.path}
 
-        if args.renumber:
-          if tag.track_num[1] != num_files:
-            tag.track_num = (tag.track_num[0], num_files)
-            log.info(f"`{child}`: updating track total: {num_files}")
-            change = True
-          if tag.track_num[0] != index:
-            log.info(f"`{child}`: updating track number to: {index}")
-            tag.track_num = (index, tag.track_num[1])
-            change = True
-        elif track is not None:
-            tracknum = int(track)
-            log.info(f"`{child}`: updating track number to: {tracknum}")
-            tag.track_num = (tracknum, tag.track_num[1])
-            change = True
-
-
-
-        if title is not None and tag.title != unsanitize_filename(title):
-          log.info(f"`{child}`: updating title: `{tag.title}`\n--> `{title}`")
-          tag.title = unsanitize_filename(title)
-          change = True
-
-        if album is not None and tag.album != unsanitize_filename(album):
-          log.info(f"`{child}`: updating album: `{tag.album}`\n--> `{album}`")
-          tag.album = unsanitize_filename(album)
-          change = True
-
-        def commit():
-          tag.save()
-        if change:
-          return commit
-      else:
-        log.info("filename does not match pattern")
-      
-    return list(map(handle_chapter, files))
-  changes = map_file_tree(args.root, handle_branch=handle_album)
-  execute_confirmed_changes(changes)
+  def resumed(self):
+    if os.path.exists(self.path):
+      return self
 
 
-def tag_to_dirname(args):
+# removal of an emptied album directory, after the removals of its files
+class DirectoryRemoval:
+  __slots__ = ("path",)
 
-  def handle_album(album_path):
-    log.info(f"handling directory: {album_path}")
-    is_audiobook = False
-    sample = None
-    files = list(natsorted(os.listdir(album_path)))
-    for f in files:
-      if f.endswith(".mp3"):
-        sample = f
-        is_audiobook = True
-        break
-    if is_audiobook:
-      tag = eyed3.load(f"{album_path}/{sample}").tag
-      old_name = os.path.basename(album_path)
-      new_name = sanitize_filename(f"{tag.album} -- {tag.artist}")
-      if old_name != new_name:
-        log.info(f"renaming directory: `{album_path}` --> {new_name}")
-        new_path = f"{os.path.dirname(old_name)}/{new_name}"
-        if os.path.exists(new_path):
-          raise ValueError(f"path already exists: {new_path}")
-        def rename():
-          os.rename(album_path, new_path)
-        return rename
-
-  changes = map_file_tree(args.root, handle_branch=handle_album)
-  execute_confirmed_changes(changes)
+  def __init__(self, path):
+    self.path = path
 
+  def __call__(self):
+    with stats.phase("remove", self.path):
+      os.rmdir(self.path)
 
-def sanitize_dir_names(args):
-  
-  def handle_album(album_path):  
-    log.debug(f"handling album {album_path}")
-    is_audiobook = False
-    files = list(natsorted(os.listdir(album_path)))
-    for f in files:
-      if f.endswith(".mp3"):
-        is_audiobook = True
-        break
-    if not is_audiobook:
+  def update_index(self, index):
+    pass
+
+  def to_json(self):
+    return {"type": "directory-removal", "path": self.path}
+
+  def resumed(self):
+    if os.path.exists(self.path):
+      return self
+
+
+CHANGE_TYPES = {
+  "chapter": ChapterChange,
+  "rename": Rename,
+  "removal": Removal,
+  "directory-removal": DirectoryRemoval,
+}
+
+
+def change_from_json(data):
+  data = dict(data)
+  change_type = CHANGE_TYPES[data.pop("type")]
+  if "track_num" in (data.get("fields") or {}):
+    data["fields"]["track_num"] = tuple(data["fields"]["track_num"])
+  return change_type(**data)
+
+
+def tag_value(tag, name):
+  if name == "track_num":
+    return tuple(tag.track_num)
+  return getattr(tag, name)
+
+
+def chapter_change(args, path, tag, fields, new_path=None):
+  rewrite = id3.rewrite_required(tag, fields) if fields else False
+  return ChapterChange(path, fields, new_path, rewrite, args.padding)
+
+
+def open_tag_index(args):
+  from . import tagindex
+  if args.tag_index is not None:
+    return tagindex.open_index(args.tag_index)
+
+
+def load_tag(args, album, name):
+  path = f"{album.path}/{name}"
+  with stats.phase("tag-read", path):
+    index = open_tag_index(args)
+    if index is None:
+      return id3.load(path)
+    return index.load(path, album.stat(name))
+
+
+def handle_indexed_album(handle_album, args, album):
+  with stats.phase("plan", album.path):
+    r = handle_album(args, album)
+  index = open_tag_index(args)
+  if index is not None:
+    with stats.phase("index-commit"):
+      index.commit()
+  return r
+
+
+# like executor.map, but only keeps a bounded number of albums in flight
+def bounded_map(executor, fn, iterable, window):
+  pending = collections.deque()
+  for item in iterable:
+    pending.append(executor.submit(fn, item))
+    if len(pending) >= window:
+      yield pending.popleft().result()
+  while pending:
+    yield pending.popleft().result()
+
+
+# the albums under args.root, their entries are added to `names` on the way
+def listed_albums(args, names):
+  for album in walk_albums(args.root):
+    names.add_listing(album.path, album.files + album.dirs)
+    yield album
+
+
+# lazily yields the changes of every album under args.root (or of `albums`)
+def map_albums(args, handle_album, albums=None):
+  handle_album = functools.partial(handle_indexed_album, handle_album, args)
+  if albums is None:
+    albums = walk_albums(args.root)
+  if args.jobs <= 1:
+    yield from map(handle_album, albums)
+    return
+  import concurrent.futures
+  with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+    if not stats.enabled:
+      yield from bounded_map(executor, handle_album, albums, args.jobs * 4)
       return
-    album_path = album_path.rstrip("/")
-    album_name = os.path.basename(album_path)
-    album = sanitize_filename(album_name)
-    if album_name != album:
-      log.info(f"renaming: `{album_name}`\n--> {album}")
-      def rename():
-        os.rename(album_path, f"{os.path.dirname(album_path)}/{album}")
-      return rename
-  changes = map_file_tree(args.root, handle_branch=handle_album)
-  execute_confirmed_changes(changes)
+    for r, worker_stats in bounded_map(executor, functools.partial(stats.collect, handle_album), albums, args.jobs * 4):
+      stats.merge(worker_stats)
+      yield r
 
 
-def overwrite_title_from_track(args):
+def purge_album(args, album):
+  log.debug(f"handling album {album.path}")
+  r = []
 
-  def handle_album(album_path):
-    log.debug(f"handling album: {album_path}")
+  def handle_file(f):
+    log.debug(f"handling file {f}")
+    if f.endswith(".jpg") or f.endswith(".m3u"):
+      path = album.path + "/" + f
+      log.info(f"deleting file: {path}")
+      r.append(Removal(path))
 
-    files = list(filter(is_chapter_file, natsorted(os.listdir(album_path))))
-    
-    num_files = len(files)
+  if album.is_audiobook:
+    log.debug("it is an audiobook")
+    for f in album.files:
+      handle_file(f)
+  return r
 
-    digits = len(str(num_files))
-    log.info(f"digits: {digits}")
-    index = 0
 
+def purge(args):
+  changes = map_albums(args, purge_album)
+  execute_confirmed_changes(changes, args)
 
-    def handle_file(child):
-      path = f"{album_path}/{child}"
-      nonlocal index
-      index += 1
-      log.debug(f"handling chapter: {path}")
+
+def name_to_tag_album(args, album):
+  log.debug(f"handling album: {album.path}")
+
+  files = album.chapters
+  
+  num_files = len(files)
+
+  digits = len(str(num_files))
+  log.debug(f"digits: {digits}")
+  index = 0
+
+
+  def handle_chapter(child):
+    path = f"{album.path}/{child}"
+    nonlocal index
+    index += 1
+    log.debug(f"handling chapter ({index}): {path}")
       
+    name = os.path.basename(path)
 
-      tag = eyed3.load(path).tag
 
-      if args.intro is not None:
-        if index == 1:
-          tag.title = args.intro
-        else:
-          tag.title = f"[ {index - 1} ]"
-      else:
-        tag.title = f"[ {index} ]"
 
-      if args.renumber:
-        tag.track_num = (index, num_files)
+    match = re.match(args.pattern, name)
+    if match:
+      try:
+        book = match.group("book")
+      except:
+        book = None
+      try:
+        track = match.group("track")
+      except:
+        track = None
+      try:
+        title = match.group("chapter")
+      except:
+        title = None
+
+
 
-      chg = name_change_from_tag(digits, path, tag)
-      if chg is not None:
-        def rename():
+      fields = {}
 
 
-          if args.renumber:
-            tag.save()
-          chg()
-        return rename
+      tag = load_tag(args, album, child)
+      track_num = tuple(tag.track_num)
+      
 
+      if args.renumber:
+        if track_num[1] != num_files:
+          track_num = (track_num[0], num_files)
+          log.info(f"`{child}`: updating track total: {num_files}")
+          fields["track_num"] = track_num
+        if track_num[0] != index:
+          log.info(f"`{child}`: updating track number to: {index}")
+          track_num = (index, track_num[1])
+          fields["track_num"] = track_num
+      elif track is not None:
+          tracknum = int(track)
+          log.info(f"`{child}`: updating track number to: {tracknum}")
+          fields["track_num"] = (tracknum, track_num[1])
+
+
+
+      if title is not None and tag.title != unsanitize_filename(title):
+        log.info(f"`{child}`: updating title: `{tag.title}`\n--> `{title}`")
+        fields["title"] = unsanitize_filename(title)
+
+      if book is not None and tag.album != unsanitize_filename(book):
+        log.info(f"`{child}`: updating album: `{tag.album}`\n--> `{book}`")
+        fields["album"] = unsanitize_filename(book)
+
+      if fields:
+        return chapter_change(args, path, tag, fields)
+    else:
+      log.info("filename does not match pattern")
     
-    return list(map(handle_file, files))
-  changes = map_file_tree(args.root, handle_branch=handle_album)
-  execute_confirmed_changes(changes)
+  return list(map(handle_chapter, files))
 
 
-def dirname_to_tag(args):
+def name_to_tag(args):
+  changes = map_albums(args, name_to_tag_album)
+  execute_confirmed_changes(changes, args)
+
+
+def tag_to_dirname_album(args, album):
+  log.info(f"handling directory: {album.path}")
+  if album.is_audiobook:
+    album_path = album.path
+    tag = load_tag(args, album, album.chapters[0])
+    old_name = album.name
+    new_name = sanitize_filename(f"{tag.album} -- {tag.artist}")
+    if old_name != new_name:
+      log.info(f"renaming directory: `{album_path}` --> {new_name}")
+      return Rename(album_path, f"{os.path.dirname(album_path)}/{new_name}")
+
+
+def tag_to_dirname(args):
+  names = renames.NameIndex(name_key)
+  changes = map_albums(args, tag_to_dirname_album, listed_albums(args, names))
+  execute_confirmed_changes(changes, args, names)
+
+
+def sanitize_dir_names_album(args, album):
+  log.debug(f"handling album {album.path}")
+  if not album.is_audiobook:
+    return
+  album_name = album.name
+  new_name = sanitize_filename(album_name)
+  if album_name != new_name:
+    log.info(f"renaming: `{album_name}`\n--> {new_name}")
+    return Rename(album.path, f"{os.path.dirname(album.path)}/{new_name}")
+
+
+def sanitize_dir_names(args):
+  names = renames.NameIndex(name_key)
+  changes = map_albums(args, sanitize_dir_names_album, listed_albums(args, names))
+  execute_confirmed_changes(changes, args, names)
+
+
+def overwrite_title_from_track_album(args, album):
+  log.debug(f"handling album: {album.path}")
+
+  files = album.chapters
   
-  def handle_album(album_path):
-    log.debug(f"handling album {album_path}")
-    is_audiobook = False
-    files = list(natsorted(os.listdir(album_path)))
-    num_files = 0
-    for f in files:
-      if f.endswith(".mp3"):
-        is_audiobook = True
-        num_files += 1
-    r = []
-    album_path = album_path.rstrip("/")
-    album_name = os.path.basename(album_path)
-
-    digits = len(str(num_files))
-
-    index = 0
-
-    match = re.match(dir_pattern, album_name)
-    if match:
-      album = unsanitize_filename(match.group(1))
-      author = unsanitize_filename(match.group(2))
+  num_files = len(files)
+
+  digits = len(str(num_files))
+  log.info(f"digits: {digits}")
+  index = 0
+
+
+  def handle_file(child):
+    path = f"{album.path}/{child}"
+    nonlocal index
+    index += 1
+    log.debug(f"handling chapter: {path}")
+    
+
+    tag = load_tag(args, album, child)
+
+    if args.intro is not None:
+      if index == 1:
+        tag.title = args.intro
+      else:
+        tag.title = f"[ {index - 1} ]"
     else:
-      log.info(f"directory name does not match pattern: {album_name}")
-      return
+      tag.title = f"[ {index} ]"
+
+    if args.renumber:
+      tag.track_num = (index, num_files)
+
+    new_path = name_change_from_tag(digits, path, tag)
+    if new_path is not None:
+      fields = {}
+      if args.renumber:
+        fields = {"title": tag.title, "track_num": (index, num_files)}
+      return chapter_change(args, path, tag, fields, new_path)
+
+  
+  return list(map(handle_file, files))
+
+
+def overwrite_title_from_track(args):
+  names = renames.NameIndex(name_key)
+  changes = map_albums(args, overwrite_title_from_track_album, listed_albums(args, names))
+  execute_confirmed_changes(changes, args, names)
+
+
+def dirname_to_tag_album(args, album):
+  log.debug(f"handling album {album.path}")
+  num_files = len(album.chapters)
+  r = []
+  album_path = album.path
+  album_name = album.name
 
-    def handle_file(f):
+  digits = len(str(num_files))
 
-      nonlocal index
-      log.debug(f"handling file {f}")
-      if f.endswith(".mp3"):
-        path = album_path + "/" + f
-        tag = eyed3.load(path).tag
+  index = 0
 
-        index += 1
+  match = re.match(dir_pattern, album_name)
+  if match:
+    book = unsanitize_filename(match.group(1))
+    author = unsanitize_filename(match.group(2))
+  else:
+    log.info(f"directory name does not match pattern: {album_name}")
+    return
+
+  def handle_file(f):
+
+    nonlocal index
+    log.debug(f"handling file {f}")
+    if f.endswith(".mp3"):
+      path = album_path + "/" + f
+      tag = load_tag(args, album, f)
+
+      index += 1
+
+      fields = {}
+      
+      if tag.album != book:
+        log.info(f"updating album: `{tag.album}`\n--> `{book}`")
+        tag.album = book
+        fields["album"] = book
+
+      if tag.artist != author:
+        log.info(f"updating artist/author: `{tag.artist}`\n--> `{author}`")
+        tag.artist = author
+        fields["artist"] = author
 
-        change = False
-        
-        if tag.album != album:
-          log.info(f"updating album: `{tag.album}`\n--> `{album}`")
-          tag.album = album
-          change = True
+      if args.renumber:
+        tag.track_num = (index, num_files)
 
-        if tag.artist != author:
-          log.info(f"updating artist/author: `{tag.artist}`\n--> `{author}`")
-          tag.artist = author
-          change = True
+      new_path = None
+      if args.rename:
+        new_path = name_change_from_tag(digits, path, tag)
 
+      if fields:
         if args.renumber:
-          tag.track_num = (index, num_files)
-
-        name_change = None
-        if args.rename:
-          name_change = name_change_from_tag(digits, path, tag)
-
-        def commit():
-          tag.save()
-          if name_change is not None:
-            name_change()
-        if change:
-          r.append(commit)
-        elif name_change is not None:
-          r.append(name_change)
-
-    if is_audiobook:
-      log.debug("it is an audiobook")
-      for f in files:
-        handle_file(f)
-    return r
-  changes = map_file_tree(args.root, handle_branch=handle_album)
-  execute_confirmed_changes(changes)
+          fields["track_num"] = (index, num_files)
+        r.append(chapter_change(args, path, tag, fields, new_path))
+      elif new_path is not None:
+        r.append(ChapterChange(path, new_path=new_path))
 
+  if album.is_audiobook:
+    log.debug("it is an audiobook")
+    for f in album.files:
+      handle_file(f)
+  return r
 
-def name_change_from_tag(digits, path, tag):
 
-  title = sanitize_filename(tag.title)
-  album = sanitize_filename(tag.album)
-  track = str(tag.track_num[0]).zfill(digits)
+def dirname_to_tag(args):
+  names = renames.NameIndex(name_key)
+  changes = map_albums(args, dirname_to_tag_album, listed_albums(args, names))
+  execute_confirmed_changes(changes, args, names)
+
+
+def chapter_filename(digits, title, album, track_num):
+  title = sanitize_filename(title)
+  album = sanitize_filename(album)
+  track = str(track_num[0]).zfill(digits)
+  return f"{album} -- {track} -- {title}.mp3"
+
 
-  new_name = f"{album} -- {track} -- {title}.mp3"
+def name_change_from_tag(digits, path, tag):
+
+  new_name = chapter_filename(digits, tag.title, tag.album, tag.track_num)
   old_name = os.path.basename(path)
   new_path = f"{os.path.dirname(path)}/{new_name}"
 
@@ -405,136 +555,968 @@ def name_change_from_tag(digits, path, tag):
 
     # show_string_diff(path, new_path)
     log.info(f"rename: `{old_name}`\n--> `{new_name}")
-    def rename():
-      # rename file path to x
-      os.rename(path, new_path)
-    return rename
+    return new_path
 
 
-def tag_to_name(args):
+def tag_to_name_album(args, album):
+  log.debug(f"handling album: {album.path}")
 
-  def handle_album(album_path):
-    log.debug(f"handling album: {album_path}")
+  files = album.chapters
+  
+  num_files = len(files)
 
-    files = list(filter(is_chapter_file, natsorted(os.listdir(album_path))))
-    
-    num_files = len(files)
+  digits = len(str(num_files))
+  log.info(f"digits: {digits}")
+  index = 0
 
-    digits = len(str(num_files))
-    log.info(f"digits: {digits}")
-    index = 0
 
+  def handle_file(child):
+    path = f"{album.path}/{child}"
+    nonlocal index
+    index += 1
+    log.debug(f"handling chapter: {path}")
+    
 
-    def handle_file(child):
-      path = f"{album_path}/{child}"
-      nonlocal index
-      index += 1
-      log.debug(f"handling chapter: {path}")
-      
+    tag = load_tag(args, album, child)
 
-      tag = eyed3.load(path).tag
+    if args.renumber:
+      tag.track_num = (index, num_files)
 
+    new_path = name_change_from_tag(digits, path, tag)
+    if new_path is not None:
+      fields = {}
       if args.renumber:
-        tag.track_num = (index, num_files)
-
-      chg = name_change_from_tag(digits, path, tag)
-      if chg is not None:
-        def rename():
+        fields["track_num"] = (index, num_files)
+      return chapter_change(args, path, tag, fields, new_path)
 
+  
+  return list(map(handle_file, files))
 
-          if args.renumber:
-            tag.save()
-          chg()
-        return rename
 
-    
-    return list(map(handle_file, files))
-  changes = map_file_tree(args.root, handle_branch=handle_album)
-  execute_confirmed_changes(changes)
+def tag_to_name(args):
+  names = renames.NameIndex(name_key)
+  changes = map_albums(args, tag_to_name_album, listed_albums(args, names))
+  execute_confirmed_changes(changes, args, names)
 
-def execute_confirmed_changes(changes):
 
-  count = 0
+def iter_changes(changes):
   for c in changes:
     if c is not None:
       if isinstance(c, list):
         for e in c:
           if e is not None:
-            count += 1
+            yield e
       else:
-        count += 1
-  if count > 0:
-    if confirm("if these changes should be commited type yes: "):
-      for c in changes:
-        if c is not None:
-          if isinstance(c, list):
-              for e in c:
-                if e is not None:
-                  log.info("applying change")
-                  e()
-          else:
-            log.info("applying change")
-            c()
-  else:
-    log.info("nothing to change")
+        yield c
+
+
+class Progress:
+
+  def __init__(self, total, interval=1, what="changes"):
+    self.total = total
+    self.what = what
+    self.done = 0
+    self.interval = interval
+    self.start = time.monotonic()
+    self.last = self.start
+
+  def rate(self):
+    elapsed = time.monotonic() - self.start
+    return self.done / elapsed if elapsed > 0 else 0
 
+  def advance(self, n=1):
+    self.done += n
+    now = time.monotonic()
+    if now - self.last >= self.interval or self.done == self.total:
+      self.last = now
+      log.info(f"processed {self.done}/{self.total} {self.what} ({self.rate():.1f}/s)")
 
-def convert(args):
-  return asyncio.run(do_convert(args))
 
-async def do_convert(args):
-  ensure_audible_dir(args)
-  log.info("loading library")
-  lib = await Library.from_api(Session().get_client(), start_date = args.start_date, end_date= args.end_date)
-  log.info("items to convert:")
-  for item in lib:
-     log.info(f"{item.create_base_filename("ascii")}")
-  log.info("starting conversion")
+class SkippedRename(Exception):
+  pass
 
-  def execute_wrapper(args):
-     execute_conversion(*args)
 
-  def execute_conversion(index, item):
-    base_filename = item.create_base_filename("ascii")  
+# whether a change below the directory `path` failed
+def failed_inside(path, failures):
+  prefix = path.rstrip("/") + "/"
+  return any(c.path.startswith(prefix) for c, _ in failures)
+
+
+def apply_changes(changes):
+  results = []
+  for c in changes:
+    log.debug(f"applying change to `{c.path}`")
     try:
-      _, aaxcodec = asyncio.run(item.get_aax_url_old("best"))
-    except:
-      aaxcodec = ""
-    aaxccodec, _ = item._get_codec("best")
-    log.info(f"converting {index}: {base_filename}")
-
-    aaxcpath = f"{args.audible_dir}/{base_filename}-{aaxccodec}.aax"
-    aaxpath = f"{args.audible_dir}/{base_filename}-{aaxcodec}.aaxc"
-    if os.path.isfile(aaxcpath):
-      path = aaxcpath
-    elif os.path.isfile(aaxpath):
-      path = aaxpath
-    else:
-       raise ValueError(f"audiobook `{base_filename}` does not exist. Download it first.")
+      c()
+      results.append((c, None))
+    except Exception as e:
+      results.append((c, e))
+  return results
+
+
+# applies the changes of different albums concurrently. The changes of an album
+# are applied in order, directory renames happen after all file changes, the
+# deepest directories first so that the paths of the others stay valid. A
+# directory with a failed change inside keeps its name, so that the journal
+# still points at the failed change.
+def execute_changes(changes, index=None, jobs=1, journal=None):
+  import concurrent.futures
+  albums = []
+  renames = []
+  for c in changes:
+    if c is None:
+      continue
+    album = [e for e in (c if isinstance(c, list) else [c]) if e is not None]
+    renames += [e for e in album if isinstance(e, Rename)]
+    album = [e for e in album if not isinstance(e, Rename)]
+    if album:
+      albums.append(album)
+
+  batches = [albums]
+  depths = sorted({e.path.rstrip("/").count("/") for e in renames}, reverse=True)
+  for depth in depths:
+    batches.append([[e] for e in renames if e.path.rstrip("/").count("/") == depth])
+
+  if journal is not None:
+    journal.plan(albums + [[e] for e in renames])
+
+  progress = Progress(sum(map(len, albums)) + len(renames))
+  failures = []
+  try:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+      for batch in batches:
+        skipped = [[(album[0], SkippedRename("a change inside the directory failed"))] for album in batch if isinstance(album[0], Rename) and failed_inside(album[0].path, failures)]
+        if skipped:
+          batch = [album for album in batch if not (isinstance(album[0], Rename) and failed_inside(album[0].path, failures))]
+        # the index and the journal are only touched from this thread
+        for results in itertools.chain(skipped, executor.map(apply_changes, batch)):
+          for c, error in results:
+            if error is None:
+              if index is not None:
+                with stats.phase("index-update"):
+                  c.update_index(index)
+            else:
+              failures.append((c, error))
+            if journal is not None:
+              with stats.phase("journal"):
+                journal.done(c, error)
+          if journal is not None:
+            journal.flush()
+          progress.advance(len(results))
+  finally:
+    if index is not None:
+      index.commit()
+    if journal is not None:
+      if failures or progress.done < progress.total:
+        journal.close()
+      else:
+        journal.end()
 
-    subprocess.run(["aaxtomp3", "--dir-naming-scheme", "$title -- $artist", path])
-    # subprocess.run("echo sleeping; sleep 1; echo done;", shell=True)
-    log.info(f"conversion {index} finished: {base_filename}")
+  log.info(f"applied {progress.done - len(failures)} changes in {time.monotonic() - progress.start:.1f}s ({progress.rate():.1f}/s)")
+  if failures:
+    log.error(f"{len(failures)} changes failed:")
+    for c, error in failures:
+      log.error(f"`{c.path}`: {error!r}")
+  return failures
 
-  with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
-    results = list(executor.map(execute_wrapper, enumerate(lib)))
 
+# the old and new value of every tag field a chapter change sets
+def change_diff(index, c):
+  if not isinstance(c, ChapterChange) or not c.fields:
+    return None
+  tag = index.load(c.path, os.stat(c.path)) if index is not None else id3.load(c.path)
+  return {name: [tag_value(tag, name) if tag is not None else None, value] for name, value in c.fields.items()}
 
 
+def write_plan(args, changes):
+  from . import plan
+  index = open_tag_index(args)
+  albums = []
+  for c in changes:
+    album = [e for e in (c if isinstance(c, list) else [c]) if e is not None]
+    if album:
+      # absolute, so that the plan can be applied from anywhere
+      albums.append([(journal.absolute(e.to_json()), change_diff(index, e)) for e in album])
+  plan.write(args.plan_out, sys.argv[1:], albums)
+
+
+# the renames and removals of `albums` as moves for NameIndex.check
+def rename_moves(albums):
+  moves = []
+  for album in albums:
+    for c in album:
+      if isinstance(c, (Removal, DirectoryRemoval)):
+        moves.append((c, album, c.path, None))
+      elif isinstance(c, (ChapterChange, Rename)) and c.new_path is not None:
+        moves.append((c, album, c.path, c.new_path))
+  return moves
+
+
+# checks the renames of `changes` for collisions and cycles. Returns the
+# changes grouped by album, ordered so that nothing is renamed onto a name
+# before it is vacated, or None after logging the conflicts.
+def check_renames(changes, names):
+  albums = [[e for e in (c if isinstance(c, list) else [c]) if e is not None] for c in changes]
+  with stats.phase("rename-check"):
+    problems, first = names.check(rename_moves(albums))
+  if problems:
+    for problem in problems:
+      log.error(problem)
+    return None
+  if first:
+    albums = [renames.ordered(album, first) for album in albums]
+  return albums
+
+
+def execute_confirmed_changes(changes, args, names=None, resuming=False):
+  if args.journal is not None and args.plan_out is None and not resuming and journal.unfinished(args.journal):
+    log.error(f"the journal `{args.journal}` holds changes of an interrupted commit, finish them with `kaudiobooks resume` or remove the journal")
+    sys.exit(1)
+  # consuming the changes runs the scan, whose previews are logged meanwhile
+  changes = [c for c in changes if c]
+  if names is not None:
+    changes = check_renames(changes, names)
+    if changes is None:
+      log.error("nothing was changed, resolve the conflicting renames first")
+      sys.exit(1)
+
+  count = 0
+  saves = 0
+  rewrites = 0
+  unknown_rewrites = 0
+  for c in iter_changes(changes):
+    count += 1
+    if isinstance(c, ChapterChange) and c.fields:
+      saves += 1
+      if c.rewrite is None:
+        unknown_rewrites += 1
+      elif c.rewrite:
+        rewrites += 1
+  if count > 0:
+    if saves > 0:
+      log.info(f"{rewrites} of {saves} tag saves will rewrite the whole file")
+      if unknown_rewrites > 0:
+        log.info(f"{unknown_rewrites} tag saves are done by eyed3 and might rewrite the whole file")
+    if args.plan_out is not None:
+      write_plan(args, changes)
+      log.info(f"plan of {count} changes written to `{args.plan_out}`, apply it with `kaudiobooks apply {args.plan_out}`")
+      return
+    from kpyutils.cli import confirm
+    with stats.phase("confirm"):
+      confirmed = confirm("if these changes should be commited type yes: ")
+    if confirmed:
+      j = None
+      if args.journal is not None:
+        j = journal.Journal(args.journal, replace=resuming)
+      execute_changes(changes, open_tag_index(args), args.commit_jobs, j)
+  else:
+    log.info("nothing to change")
 
-   
+
+def resume(args):
+  if args.journal is None or not os.path.exists(args.journal):
+    log.info(f"no journal found at {args.journal}")
+    return
+  albums = journal.read_remaining(args.journal)
+  if not albums:
+    log.info("the journal has no remaining changes")
+    return
+  changes = []
+  for album in albums:
+    changes.append([change_from_json(c).resumed() for c in album])
+  remaining = 0
+  for c in iter_changes(changes):
+    log.info(f"remaining change: {c.to_json()}")
+    remaining += 1
+  if remaining == 0:
+    log.info("all changes of the journal are applied")
+    journal.finish(args.journal)
+    return
+  execute_confirmed_changes(changes, args, resuming=True)
+
+
+# applies a plan written by --plan-out. Albums with a change whose file or
+# directory was modified since the plan was made are skipped as a whole.
+def apply_plan(args):
+  from . import plan
+  header, entries = plan.read(args.plan)
+  log.info(f"plan made {header['created']} by `{' '.join(header['command'])}`")
+  changes = []
+  stale = 0
+  for album in entries:
+    outdated = [entry for entry in album if not plan.is_current(entry)]
+    if outdated:
+      for entry in outdated:
+        log.warning(f"`{entry['change']['path']}` was modified since the plan was made, skipping its album")
+      stale += len(album)
+      continue
+    changes.append([change_from_json(entry["change"]) for entry in album])
+  for c in iter_changes(changes):
+    log.info(f"planned change: {c.to_json()}")
+  if stale:
+    log.warning(f"{stale} changes are skipped because their albums changed")
+  # the directories are listed as needed, the plan knows nothing about the
+  # names that appeared since
+  execute_confirmed_changes(changes, args, renames.NameIndex(name_key))
+
+
+class ChapterModel:
+
+  def __init__(self, name, tag):
+    self.name = name
+    self.new_name = name
+    self.tag = tag
+    self.fields = {}
+
+  def value(self, name):
+    if name in self.fields:
+      return self.fields[name]
+    return tag_value(self.tag, name)
+
+  def set(self, name, value):
+    if tag_value(self.tag, name) == value:
+      self.fields.pop(name, None)
+    else:
+      self.fields[name] = value
+
+
+# the state of an album after the operations of a pipeline applied so far
+class AlbumModel:
+
+  def __init__(self, path, files, chapters):
+    self.path = path
+    self.new_name = os.path.basename(path)
+    self.files = files
+    self.chapters = chapters
+    self.removed = []
+
+
+def pipeline_purge(args, album):
+  for f in album.files:
+    if (f.endswith(".jpg") or f.endswith(".m3u")) and f not in album.removed:
+      album.removed.append(f)
+
+
+def pipeline_sanitize_dirnames(args, album):
+  album.new_name = sanitize_filename(album.new_name)
+
+
+def pipeline_dirname_to_tag(args, album):
+  match = re.match(dir_pattern, album.new_name)
+  if not match:
+    log.info(f"directory name does not match pattern: {album.new_name}")
+    return
+  for index, chapter in enumerate(album.chapters, 1):
+    chapter.set("album", unsanitize_filename(match.group(1)))
+    chapter.set("artist", unsanitize_filename(match.group(2)))
+    if args.renumber:
+      chapter.set("track_num", (index, len(album.chapters)))
+
+
+def pipeline_tag_to_dirname(args, album):
+  chapter = album.chapters[0]
+  album.new_name = sanitize_filename(f"{chapter.value('album')} -- {chapter.value('artist')}")
+
+
+def pipeline_tag_to_name(args, album):
+  digits = len(str(len(album.chapters)))
+  for index, chapter in enumerate(album.chapters, 1):
+    if args.renumber:
+      chapter.set("track_num", (index, len(album.chapters)))
+    chapter.new_name = chapter_filename(digits, chapter.value("title"), chapter.value("album"), chapter.value("track_num"))
+
+
+PIPELINE_OPERATIONS = {
+  "purge": pipeline_purge,
+  "sanitize-dirnames": pipeline_sanitize_dirnames,
+  "dirname-to-tag": pipeline_dirname_to_tag,
+  "tag-to-dirname": pipeline_tag_to_dirname,
+  "tag-to-name": pipeline_tag_to_name,
+}
+
+
+def pipeline_album(args, listing):
+  log.debug(f"handling album: {listing.path}")
+  if not listing.is_audiobook:
+    return
+  album_path = listing.path
+  chapters = [ChapterModel(f, load_tag(args, listing, f)) for f in listing.chapters]
+  album = AlbumModel(album_path, listing.files, chapters)
+  for operation in args.operations:
+    PIPELINE_OPERATIONS[operation](args, album)
+
+  r = []
+  for f in album.removed:
+    log.info(f"deleting file: {album_path}/{f}")
+    r.append(Removal(f"{album_path}/{f}"))
+  for chapter in album.chapters:
+    path = f"{album_path}/{chapter.name}"
+    for name, value in chapter.fields.items():
+      log.info(f"`{chapter.name}`: updating {name}: `{tag_value(chapter.tag, name)}`\n--> `{value}`")
+    new_path = None
+    if chapter.new_name != chapter.name:
+      log.info(f"rename: `{chapter.name}`\n--> `{chapter.new_name}`")
+      new_path = f"{album_path}/{chapter.new_name}"
+    if chapter.fields or new_path is not None:
+      r.append(chapter_change(args, path, chapter.tag, chapter.fields, new_path))
+  if album.new_name != os.path.basename(album_path):
+    log.info(f"renaming directory: `{album_path}`\n--> {album.new_name}")
+    r.append(Rename(album_path, f"{os.path.dirname(album_path)}/{album.new_name}"))
+  return r
+
+
+def pipeline(args):
+  names = renames.NameIndex(name_key)
+  changes = map_albums(args, pipeline_album, listed_albums(args, names))
+  execute_confirmed_changes(changes, args, names)
+
+
+# applies the watched operations to one settled directory, without asking
+def process_watched_album(args, path, audit, journal_path):
+  try:
+    listing, _ = scan(path)
+  except FileNotFoundError:
+    return
+  if not listing.is_audiobook:
+    return
+  log.info(f"processing `{path}`")
+  try:
+    changes = list(iter_changes([handle_indexed_album(pipeline_album, args, listing)]))
+  except Exception as e:
+    log.error(f"cannot plan the changes of `{path}`: {e!r}")
+    return
+  if not changes:
+    log.info("nothing to change")
+    return
+  names = renames.NameIndex(name_key)
+  names.add_listing(path, listing.files + listing.dirs)
+  checked = check_renames([changes], names)
+  if checked is None:
+    log.error(f"not changing `{path}`, resolve the conflicting renames first")
+    return
+  changes = checked[0]
+  j = None
+  if journal_path is not None:
+    if journal.unfinished(journal_path):
+      log.warning(f"replacing the unfinished journal `{journal_path}`, its failed changes are in the audit log")
+    j = journal.Journal(journal_path, replace=True)
+  failures = dict((id(c), error) for c, error in execute_changes([changes], open_tag_index(args), 1, j))
+  for c in changes:
+    audit.record(path, c, failures.get(id(c)))
+
+
+def open_file_cache(args):
+  from . import filecache
+  if args.file_cache is not None:
+    return filecache.open_cache(args.file_cache)
+
+
+# runs `compute(path)` for every (path, stat) not in the file cache yet, on
+# `jobs` threads (hashing and mmap reads release the gil), and returns the
+# results by path
+def cached_file_results(args, kind, compute, files, jobs):
+  import concurrent.futures
+  cache = open_file_cache(args)
+  results = {}
+  missing = []
+  for path, st in files:
+    value = cache.get(kind, path, st) if cache is not None else None
+    if value is None:
+      missing.append((path, st))
+    else:
+      results[path] = value
+  log.info(f"{len(results)} of {len(files)} files cached, reading {len(missing)}")
+  progress = Progress(len(missing), interval=5, what="files")
+  with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+    for (path, st), value in zip(missing, executor.map(compute, (path for path, _ in missing))):
+      results[path] = value
+      if cache is not None:
+        cache.put(kind, path, st, value)
+      progress.advance()
+  if cache is not None:
+    cache.commit()
+  return results
+
+
+HASH_CHUNK = 1024 * 1024
+
+
+# hashes the mpeg audio of a chapter, leaving out its id3 tags so that retagged
+# copies hash the same
+def payload_hash(path):
+  import mmap
+  import hashlib
+  digest = hashlib.blake2b(digest_size=20)
+  with stats.phase("hash", path), open(path, "rb") as f:
+    if os.fstat(f.fileno()).st_size == 0:
+      return {"hash": digest.hexdigest(), "audio_size": 0}
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+      start, end = mpeg.audio_range(mm)
+      with memoryview(mm) as view:
+        for pos in range(start, end, HASH_CHUNK):
+          digest.update(view[pos:min(pos + HASH_CHUNK, end)])
+  stats.add_bytes("hash", read=end - start)
+  return {"hash": digest.hexdigest(), "audio_size": end - start}
+
+
+def album_removal(album):
+  r = [Removal(f"{album.path}/{f}") for f in album.files]
+  if not album.dirs:
+    r.append(DirectoryRemoval(album.path))
+  return r
+
+
+def dedupe(args):
+  albums = [album for album in walk_albums(args.root) if album.is_audiobook]
+  files = [(f"{album.path}/{name}", album.stat(name)) for album in albums for name in album.chapters]
+  hashes = cached_file_results(args, "payload-hash", payload_hash, files, args.jobs)
+
+  # albums holding the same audio, whatever their chapters are called
+  groups = collections.defaultdict(list)
+  for album in albums:
+    key = tuple(sorted(hashes[f"{album.path}/{name}"]["hash"] for name in album.chapters))
+    groups[key].append(album)
+
+  changes = []
+  reclaimable = 0
+  duplicates = 0
+  for group in groups.values():
+    if len(group) < 2:
+      continue
+    keep = min(group, key=lambda album: album.stat(album.chapters[0]).st_mtime if args.keep == "oldest" else album.path)
+    log.info(f"same audio in {len(group)} albums, keeping `{keep.path}`")
+    for album in group:
+      if album is keep:
+        continue
+      size = sum(album.stat(name).st_size for name in album.files)
+      log.info(f"duplicate: `{album.path}` ({size} bytes)")
+      duplicates += 1
+      reclaimable += size
+      changes.append(album_removal(album))
+  log.info(f"{duplicates} duplicate albums, {reclaimable} bytes ({reclaimable / 2**30:.2f} GiB) reclaimable")
+  execute_confirmed_changes(changes, args)
+
+
+# bumped whenever scan_frames changes, to invalidate cached results
+VERIFY_VERSION = 1
+
+
+def verify_chapter(path, max_gap):
+  import mmap
+  with stats.phase("verify", path), open(path, "rb") as f:
+    if os.fstat(f.fileno()).st_size == 0:
+      result = {"problems": ["empty file"]}
+    else:
+      with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        result = mpeg.scan_frames(mm, max_gap)
+      stats.add_bytes("verify", read=result["audio_bytes"])
+  result["version"] = VERIFY_VERSION
+  result["max_gap"] = max_gap
+  return result
+
+
+def verify_album(args, album):
+  cache = open_file_cache(args)
+  r = []
+  for name in album.chapters:
+    path = f"{album.path}/{name}"
+    st = album.stat(name)
+    result = cache.get("verify", path, st) if cache is not None else None
+    if result is None or result["version"] != VERIFY_VERSION or result["max_gap"] != args.max_gap:
+      try:
+        result = verify_chapter(path, args.max_gap)
+      except OSError as e:
+        r.append((path, {"problems": [f"unreadable: {e}"]}))
+        continue
+      if cache is not None:
+        cache.put("verify", path, st, result)
+    r.append((path, result))
+  if cache is not None:
+    cache.commit()
+  return r
+
+
+def verify(args):
+  chapters = 0
+  broken = 0
+  duration = 0.0
+  for results in map_albums(args, verify_album):
+    for path, result in results:
+      chapters += 1
+      duration += result.get("duration", 0)
+      if result["problems"]:
+        broken += 1
+        for problem in result["problems"]:
+          log.error(f"`{path}`: {problem}")
+  log.info(f"verified {chapters} chapters ({duration / 3600:.1f} hours of audio), {broken} broken")
+  if broken:
+    sys.exit(1)
+
+
+CATALOG_FIELDS = ["path", "album", "author", "chapters", "duration", "bytes", "bitrate", "signature"]
+
+
+# changes whenever a chapter of the album is added, removed or modified
+def album_signature(album):
+  sts = [album.stat(name) for name in album.chapters]
+  return f"{len(sts)}:{sum(st.st_size for st in sts)}:{max(st.st_mtime_ns for st in sts)}"
+
+
+def chapter_stream_info(cache, path, st):
+  import mmap
+  info = cache.get("stream-info", path, st) if cache is not None else None
+  if info is None:
+    with stats.phase("stream-info", path), open(path, "rb") as f:
+      if st.st_size == 0:
+        info = {"duration": 0, "audio_bytes": 0, "source": "empty"}
+      else:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+          info = mpeg.stream_info(mm)
+    if cache is not None:
+      cache.put("stream-info", path, st, info)
+  return info
+
+
+def catalog_album(args, album):
+  if not album.is_audiobook:
+    return
+  cache = open_file_cache(args)
+  tag = load_tag(args, album, album.chapters[0])
+  duration = 0.0
+  audio_bytes = 0
+  size = 0
+  for name in album.chapters:
+    st = album.stat(name)
+    info = chapter_stream_info(cache, f"{album.path}/{name}", st)
+    duration += info["duration"]
+    audio_bytes += info["audio_bytes"]
+    size += st.st_size
+  if cache is not None:
+    cache.commit()
+  return {
+    "path": album.path,
+    "album": tag.album,
+    "author": tag.artist,
+    "chapters": len(album.chapters),
+    "duration": round(duration, 3),
+    "bytes": size,
+    "bitrate": round(audio_bytes * 8 / duration / 1000) if duration else None,
+    "signature": album_signature(album),
+  }
+
+
+def read_catalog(path, catalog_format):
+  import csv
+  with open(path, newline="", encoding="utf-8") as f:
+    if catalog_format == "csv":
+      return {row["path"]: row for row in csv.DictReader(f)}
+    return {row["path"]: row for row in map(json.loads, f)}
+
+
+# writes the catalog to a temporary file that replaces `path` once complete,
+# or to stdout
+@contextlib.contextmanager
+def catalog_writer(path, catalog_format):
+  import tempfile
+  import csv
+  if path is None:
+    f = sys.stdout
+  else:
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".kaudiobooks-catalog-")
+    f = os.fdopen(fd, "w", newline="", encoding="utf-8")
+  try:
+    if catalog_format == "csv":
+      writer = csv.DictWriter(f, fieldnames=CATALOG_FIELDS)
+      writer.writeheader()
+      yield writer.writerow
+    else:
+      yield lambda row: f.write(json.dumps(row, ensure_ascii=False) + "\n")
+    if path is not None:
+      f.close()
+      os.replace(tmp_path, path)
+  finally:
+    if path is not None and not f.closed:
+      f.close()
+      os.remove(tmp_path)
+
+
+def catalog(args):
+  catalog_format = args.format or ("csv" if args.output is not None and args.output.endswith(".csv") else "jsonl")
+  old = {}
+  if args.refresh and args.output is not None and os.path.exists(args.output):
+    old = read_catalog(args.output, catalog_format)
+  rows = 0
+  reused = 0
+  with catalog_writer(args.output, catalog_format) as write:
+    # unchanged albums are copied from the old catalog right away, only the
+    # others are handed to map_albums
+    def changed_albums():
+      nonlocal rows, reused
+      for album in walk_albums(args.root):
+        if not album.is_audiobook:
+          continue
+        row = old.get(album.path)
+        if row is not None and row["signature"] == album_signature(album):
+          write(row)
+          rows += 1
+          reused += 1
+        else:
+          yield album
+    for row in map_albums(args, catalog_album, changed_albums()):
+      if row is not None:
+        write(row)
+        rows += 1
+  log.info(f"catalog of {rows} albums written, {reused} unchanged ones taken from the old catalog")
+
+
+class MergeError(Exception):
+  pass
+
+
+MERGE_COPY_SIZE = 1024 * 1024
+
+
+def copy_range(src, out, start, end):
+  src.seek(start)
+  remaining = end - start
+  while remaining > 0:
+    data = src.read(min(remaining, MERGE_COPY_SIZE))
+    if not data:
+      raise MergeError(f"`{src.name}` shrank while merging")
+    out.write(data)
+    remaining -= len(data)
+
+
+# the frames of a chapter without its tags, leading garbage, header frame and
+# truncated last frame
+def merge_source(path):
+  import mmap
+  with open(path, "rb") as f:
+    if os.fstat(f.fileno()).st_size == 0:
+      raise MergeError(f"`{path}` is empty")
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+      info = mpeg.scan_frames(mm)
+      if info["first_frame"] is None:
+        raise MergeError(f"`{path}` holds no mpeg frames")
+      header = mm[info["first_frame"]:info["first_frame"] + 4]
+  return info, header
+
+
+# the merged file of `album` mirrors its path below --root, so that albums of
+# the same name in different directories don't overwrite each other
+def merge_target(args, album):
+  relative = os.path.relpath(album.path, args.root or ".")
+  if relative == ".":
+    relative = os.path.basename(os.path.abspath(album.path))
+  return os.path.normpath(f"{args.output_dir}/{relative}.mp3")
+
+
+# joins the frames of the chapters of `album` into one file under
+# args.output_dir, with a CHAP frame per chapter
+def merge_album(args, album):
+  import tempfile
+  if not album.is_audiobook:
+    return None
+  target = merge_target(args, album)
+  newest = max(album.stat(name).st_mtime_ns for name in album.chapters)
+  if not args.force and os.path.exists(target) and os.stat(target).st_mtime_ns >= newest:
+    log.debug(f"`{target}` is up to date")
+    return None
+  try:
+    with stats.phase("merge", album.path):
+      sources = []
+      toc = []
+      position = 0.0
+      frames = 0
+      size = 0
+      first = load_tag(args, album, album.chapters[0])
+      for name in album.chapters:
+        path = f"{album.path}/{name}"
+        info, header = merge_source(path)
+        if sources and mpeg.stream_format(header, 0) != mpeg.stream_format(sources[0][1], 0):
+          raise MergeError(f"`{path}` differs in sample rate or channels from the first chapter")
+        tag = load_tag(args, album, name)
+        title = tag_value(tag, "title") or os.path.splitext(name)[0]
+        toc.append((title, round(position * 1000), round((position + info["duration"]) * 1000)))
+        sources.append((path, header, info["first_frame"], info["frames_end"]))
+        position += info["duration"]
+        frames += info["frames"]
+        size += info["frames_end"] - info["first_frame"]
+
+      album_title = tag_value(first, "album") or os.path.basename(os.path.abspath(album.path))
+      fields = {"title": album_title, "album": album_title, "artist": tag_value(first, "artist")}
+      os.makedirs(os.path.dirname(target), exist_ok=True)
+      fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target), prefix=".kaudiobooks-merge-", suffix=".mp3")
+      try:
+        with os.fdopen(fd, "wb") as out:
+          out.write(id3.render_tag(fields, id3.render_chapter_frames(toc), args.padding))
+          info_frame = mpeg.xing_frame(sources[0][1], frames, size)
+          if info_frame is not None:
+            out.write(info_frame)
+          for path, header, start, end in sources:
+            with open(path, "rb") as src:
+              copy_range(src, out, start, end)
+          stats.add_bytes("merge", read=size, written=out.tell())
+        # mkstemp creates the file readable by us only
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, target)
+      except:
+        os.remove(tmp_path)
+        raise
+  except (MergeError, OSError) as e:
+    log.error(f"cannot merge `{album.path}`: {e}")
+    return False
+  log.info(f"merged {len(sources)} chapters ({position / 3600:.1f} hours) into `{target}`")
+  return True
+
+
+def merge(args):
+  os.makedirs(args.output_dir, exist_ok=True)
+  results = collections.Counter(map_albums(args, merge_album))
+  log.info(f"merged {results[True]} albums, {results[None]} up to date or no audiobooks, {results[False]} failed")
+  if results[False]:
+    sys.exit(1)
+
+
+# the chapters of every album under args.root whose transcoded file in the
+# mirror tree is missing or older, largest albums first
+def plan_transcodes(args):
+  from . import transcoder
+  _, extension, _ = transcoder.CODECS[args.codec]
+  root = args.root or "."
+  albums = []
+  skipped = 0
+  for album in walk_albums(root):
+    if not album.is_audiobook:
+      continue
+    target_dir = os.path.normpath(f"{args.output_dir}/{os.path.relpath(album.path, root)}")
+    size = 0
+    tasks = []
+    for name in album.chapters:
+      st = album.stat(name)
+      target = f"{target_dir}/{os.path.splitext(name)[0]}{extension}"
+      try:
+        if not args.force and os.stat(target).st_mtime_ns >= st.st_mtime_ns:
+          skipped += 1
+          continue
+      except FileNotFoundError:
+        pass
+      size += st.st_size
+      tasks.append((f"{album.path}/{name}", target))
+    if tasks:
+      albums.append((size, album.path, tasks))
+  albums.sort(key=lambda entry: entry[0], reverse=True)
+  return [task for _, _, tasks in albums for task in tasks], skipped
+
+
+def transcode(args):
+  from . import transcoder
+  import concurrent.futures
+  tasks, skipped = plan_transcodes(args)
+  log.info(f"transcoding {len(tasks)} chapters to {args.codec} {args.bitrate} with {args.jobs} processes, {skipped} are up to date")
+  progress = Progress(len(tasks), interval=5, what="chapters")
+  audio = 0.0
+  cpu = 0.0
+  failures = 0
+  start = time.monotonic()
+  with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+    futures = {executor.submit(transcoder.transcode_chapter, source, target, args.codec, args.bitrate, args.padding): source for source, target in tasks}
+    for future in concurrent.futures.as_completed(futures):
+      source = futures[future]
+      try:
+        seconds, cpu_seconds = future.result()
+      except (transcoder.TranscodeError, OSError) as e:
+        log.error(f"cannot transcode `{source}`: {e}")
+        failures += 1
+      else:
+        audio += seconds
+        cpu += cpu_seconds
+      progress.advance()
+  elapsed = time.monotonic() - start
+  if tasks and elapsed > 0:
+    log.info(f"transcoded {audio / 3600:.1f} hours of audio in {elapsed:.1f}s: {audio / elapsed:.1f}x realtime on {args.jobs} processes, "
+             f"{audio / elapsed / args.jobs:.1f}x realtime per core" + (f", {audio / cpu:.1f}x per cpu second of ffmpeg" if cpu > 0 else ""))
+  if failures:
+    log.error(f"{failures} chapters failed")
+    sys.exit(1)
+
+
+def watch(args):
+  # inotify (and with it ctypes) is only needed here
+  from . import watcher
+  root = args.root or "."
+  w = watcher.Watcher(root, args.settle)
+  audit_path = args.audit_log or paths.audit_log()
+  audit = watcher.AuditLog(audit_path)
+  journal_path = None
+  if args.journal is not None:
+    journal_path = args.watch_journal or watcher.journal_path(audit_path)
+  if args.existing:
+    w.mark_all()
+  log.info(f"watching `{root}` ({len(w.wds)} directories), applying {' '.join(args.operations)} {args.settle}s after the last change")
+  try:
+    while True:
+      for path in w.wait():
+        process_watched_album(args, path, audit, journal_path)
+        w.skip_pending()
+  except KeyboardInterrupt:
+    log.info("stopped watching")
+  finally:
+    w.close()
+    audit.close()
+
+
+# a command of the submodule `module`, which is imported only when the command
+# runs (see library.py)
+def lazy_command(module, name):
+  def run(args):
+    return getattr(importlib.import_module(f".{module}", __package__), name)(args)
+  return run
 
 
 def run_command():
+  parser = build_parser()
+  args = parser.parse_args()
+
+  # a catalog streamed to stdout must not be interleaved with the log
+  log_stream = sys.stderr if args.func is catalog and args.output is None else sys.stdout
   logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s %(name)s.%(levelname)s: %(message)s',
     handlers=[
         # logging.FileHandler(logfile_path + datetime.now().strftime("%d-%m-%Y_%H:%M:%S.%f") ),  # File handler
-        logging.StreamHandler(sys.stdout)   # Stream handler for stdout
+        logging.StreamHandler(log_stream)   # Stream handler for stdout (stderr while stdout carries data)
     ]
   )
 
+  logging.getLogger("eyed3").setLevel(logging.CRITICAL)
+  if args.verbose:
+    logging.getLogger().setLevel(logging.DEBUG)
+
+  if args.stats or args.stats_json is not None:
+    stats.enable()
+  profile = None
+  if args.profile is not None:
+    import cProfile
+    profile = cProfile.Profile()
+    profile.enable()
+  start = time.perf_counter()
+  try:
+    args.func(args)
+  finally:
+    total = time.perf_counter() - start
+    if profile is not None:
+      profile.disable()
+      profile.dump_stats(args.profile)
+      log.info(f"profile written to {args.profile} (read it with `python -m pstats {args.profile}`)")
+    if args.stats:
+      stats.report(total)
+    if args.stats_json is not None:
+      stats.write_json(args.stats_json, total, sys.argv[1:])
+
+
+def build_parser():
   parser = argparse.ArgumentParser(description=
 '''audiobooks manager. The directory structure used/applied by this software is `title -- author/title -- lpadded_track_num -- chapter title`. All problematic characters in title, author and chapter will be converted into lookalike characters from the unicode character set when applied to the filename. All tag or filename changes are presented to the user beforehand and require manual confirmation.
 ''')
@@ -543,14 +1525,37 @@ def run_command():
 
   global_parser = argparse.ArgumentParser(add_help=False)
   global_parser.add_argument("--verbose", action='store_true', help="log debugging stuff")
+  global_parser.add_argument("--tag-index", type=str, help="the sqlite file caching parsed tags by path, size and mtime", default=os.getenv("KAUDIOBOOKS_TAG_INDEX", paths.tag_index()))
+  global_parser.add_argument("--commit-jobs", type=int, help="the number of albums whose confirmed changes are applied concurrently", default=1)
+  global_parser.add_argument("--journal", type=str, help="the file that journals the changes of a commit, so that an interrupted commit can be finished with `resume`", default=os.getenv("KAUDIOBOOKS_JOURNAL", paths.journal()))
+  global_parser.add_argument("--no-journal", dest="journal", action='store_const', const=None, help="don't journal commits")
+  global_parser.add_argument("--no-tag-index", dest="tag_index", action='store_const', const=None, help="neither use nor update the tag index")
+  global_parser.add_argument("--stats", action='store_true', help="report the time, calls, bytes and slowest files of every phase (listing, sorting, tag reads, saves, renames, ...) at the end")
+  global_parser.add_argument("--stats-json", type=str, help="write the --stats figures as json to this file", default=None)
+  global_parser.add_argument("--profile", type=str, help="profile the main process with cProfile and write the stats to this file (scan workers of --jobs are not included)", default=None)
+
+  scan_parser = argparse.ArgumentParser(add_help=False)
+  scan_parser.add_argument("--jobs", type=int, help="the number of processes scanning albums in parallel", default=1)
+
+  # for the commands whose changes are confirmed
+  plan_parser = argparse.ArgumentParser(add_help=False)
+  plan_parser.add_argument("--plan-out", type=str, help="write the planned changes with the size and mtime of their files to this file instead of asking to commit them, see `apply`", default=None)
+
+  padding_parser = argparse.ArgumentParser(add_help=False)
+  padding_parser.add_argument("--padding", type=int, help="the padding in bytes reserved when a tag outgrows its space and the file has to be rewritten. Tags that fit are always written in place", default=id3.DEFAULT_PADDING)
+
+  write_parser = argparse.ArgumentParser(add_help=False, parents=[scan_parser, padding_parser])
 
   audible_parser = argparse.ArgumentParser(add_help=False, parents=[global_parser])
   audible_parser.add_argument("--audible-dir", type=str, help="the path to the audible directory", default=os.getenv("KAUDIOBOOKS_AUDIBLE_DIR"))
+  audible_parser.add_argument("--library-snapshot", type=str, help="the local snapshot of the audible library", default=os.getenv("KAUDIOBOOKS_LIBRARY_SNAPSHOT", paths.library_snapshot()))
+  audible_parser.add_argument("--snapshot-max-age", type=float, help="the age in hours up to which the library snapshot is used without fetching new purchases", default=24)
+  audible_parser.add_argument("--refresh-library", action='store_true', help="fetch the whole library again instead of only the latest purchases")
 
 
   
 
-  purge_parser = subparser.add_parser('purge', parents=[global_parser], help= 'purges .jpg and .m3u from audiobook directories. This gets rid of m3u and cover.jpg for example. Will only delete files from directories that actually contain audiobook files (mp3 files)')
+  purge_parser = subparser.add_parser('purge', parents=[global_parser, scan_parser, plan_parser], help= 'purges .jpg and .m3u from audiobook directories. This gets rid of m3u and cover.jpg for example. Will only delete files from directories that actually contain audiobook files (mp3 files)')
   purge_parser.add_argument("--root", type=str, help="the directory under which the files lay (or just a single file)", default=None)
   purge_parser.set_defaults(func=purge)
 
@@ -564,43 +1569,55 @@ def run_command():
 
 
 
-  download_parser = subparser.add_parser('download', parents=[audible_parser, dated_parser], help= 'downloads all audiobooks (that are not already present in the audible directory)')
-  download_parser.set_defaults(func=download)
+  conversion_parser = argparse.ArgumentParser(add_help=False)
+  conversion_parser.add_argument("--metadata-jobs", type=int, help="the number of concurrent codec lookups", default=8)
+  conversion_parser.add_argument("--output-dir", type=str, help="the directory the converted audiobooks are put into", default=os.getenv("KAUDIOBOOKS_OUTPUT_DIR", "."))
+  conversion_parser.add_argument("--force", action='store_true', help="also convert audiobooks that were converted completely before")
+  conversion_parser.add_argument("--backend", choices=["aaxtomp3", "ffmpeg"], help="convert with aaxtomp3, or with ffmpeg directly, encoding the chapters in parallel straight into kaudiobooks' own layout and tags", default="aaxtomp3")
+  conversion_parser.add_argument("--bitrate", type=str, help="the mp3 bitrate of the ffmpeg backend, 128k by default")
+  conversion_parser.add_argument("--activation-bytes", type=str, help="the activation bytes the ffmpeg backend decrypts aax files with (aaxc files use their voucher)", default=os.getenv("KAUDIOBOOKS_ACTIVATION_BYTES"))
 
+  download_parser = subparser.add_parser('download', parents=[audible_parser, dated_parser, conversion_parser], help= 'downloads all audiobooks (that are not already present in the audible directory). Interrupted downloads are resumed')
+  download_parser.add_argument("--jobs", type=int, help="the number of concurrent downloads", default=4)
+  download_parser.add_argument("--convert", action='store_true', help="convert each audiobook (like `convert`) as soon as its download is done")
+  download_parser.add_argument("--convert-jobs", type=int, help="the number of concurrent conversions with --convert (defaults to the number of cpus)", default=os.cpu_count() or 1)
+  download_parser.set_defaults(func=lazy_command("library", "download"))
 
-  convert_parser = subparser.add_parser('convert', parents=[audible_parser, dated_parser], help= 'converts audiobooks from aac or aacx to mp3s using aaxtomp3 (this will not apply the directory structure used by kaudiobooks. You then manually check/change the id3 tags (with kid3 for example) and use kaudiobooks to apply various mass operations.)')
-  convert_parser.add_argument("--jobs", type=int, help="the number of jobs", default=2)
 
+  convert_parser = subparser.add_parser('convert', parents=[audible_parser, dated_parser, conversion_parser], help= 'converts audiobooks from aac or aacx to mp3s using aaxtomp3 (this will not apply the directory structure used by kaudiobooks. You then manually check/change the id3 tags (with kid3 for example) and use kaudiobooks to apply various mass operations.)')
+  convert_parser.add_argument("--jobs", type=int, help="the number of concurrent conversions (defaults to the number of cpus)", default=os.cpu_count() or 1)
+  convert_parser.add_argument("--largest-first", action='store_true', help="start the conversions of the largest files first, so that long books don't straggle at the end of a batch")
 
-  tag_to_name_parser = subparser.add_parser('tag-to-name', parents=[global_parser], help= 'renames audiobook files from mp3 tags (only using tag version 2) replacing problematic characters with unicode lookalikes')
+
+  tag_to_name_parser = subparser.add_parser('tag-to-name', parents=[global_parser, write_parser, plan_parser], help= 'renames audiobook files from mp3 tags (only using tag version 2) replacing problematic characters with unicode lookalikes')
   tag_to_name_parser.add_argument("--root", type=str, help="the directory under which the files lay (or just a single file)", default=None)
   tag_to_name_parser.add_argument("--renumber", action='store_true', help="whether the track number should be updated according to sort order of the original files in the directory")
   tag_to_name_parser.set_defaults(func=tag_to_name)
 
 
-  name_to_tag_parser = subparser.add_parser('name-to-tag', parents=[global_parser], help= 'updates id3 tag v2 from filename (according to kaudiobooks own filename pattern)')
+  name_to_tag_parser = subparser.add_parser('name-to-tag', parents=[global_parser, write_parser, plan_parser], help= 'updates id3 tag v2 from filename (according to kaudiobooks own filename pattern)')
   name_to_tag_parser.add_argument("--root", type=str, help="the directory under which the files lay (or just a single file)", default=None)
   name_to_tag_parser.add_argument("--renumber", action='store_true', help="whether the track number should be updated according to sort order of the original files in the directory")
   name_to_tag_parser.add_argument("--pattern", type=str, help='''the regex pattern to apply to the filename. The named groups `book`, `track` and `chapter` will be used if present.''', default=filename_pattern)
   name_to_tag_parser.set_defaults(func=name_to_tag)
 
 
-  tag_to_dirname_parser = subparser.add_parser('tag-to-dirname', parents=[global_parser], help= 'renames directories from the tags of the chapter mp3s inside it')
+  tag_to_dirname_parser = subparser.add_parser('tag-to-dirname', parents=[global_parser, scan_parser, plan_parser], help= 'renames directories from the tags of the chapter mp3s inside it')
   tag_to_dirname_parser.add_argument("--root", type=str, help="the directory under which the audiobook directories lay (or just a single directories)", default=None)
   tag_to_dirname_parser.set_defaults(func=tag_to_dirname)
 
-  dirname_to_tag_parser = subparser.add_parser('dirname-to-tag', parents=[global_parser], help= 'updates mp3 tags from parent directory name (using kaudiobook\' own filename pattern)')
+  dirname_to_tag_parser = subparser.add_parser('dirname-to-tag', parents=[global_parser, write_parser, plan_parser], help= 'updates mp3 tags from parent directory name (using kaudiobook\' own filename pattern)')
   dirname_to_tag_parser.add_argument("--rename", action='store_true', help="whether to also rename the chapter files if the tag changed")
   dirname_to_tag_parser.add_argument("--renumber", action='store_true', help="whether the track number should be updated according to sort order of the original files in the directory")
   dirname_to_tag_parser.add_argument("--root", type=str, help="the directory under which the audiobook directories lay (or just a single directories)", default=None)
   dirname_to_tag_parser.set_defaults(func=dirname_to_tag)
 
 
-  sanitize_dir_names_parser = subparser.add_parser('sanitize-dirnames', parents=[global_parser], help= 'renames audiobook directories replacing problematic characters with unicode lookalikes (ignores directories that don\'t contain audiobook chapters [mp3 files])')
+  sanitize_dir_names_parser = subparser.add_parser('sanitize-dirnames', parents=[global_parser, scan_parser, plan_parser], help= 'renames audiobook directories replacing problematic characters with unicode lookalikes (ignores directories that don\'t contain audiobook chapters [mp3 files])')
   sanitize_dir_names_parser.add_argument("--root", type=str, help="the directory under which the audiobook directories lay (or just a single directories)", default=None)
   sanitize_dir_names_parser.set_defaults(func=sanitize_dir_names)
 
-  overwrite_title_from_track_parser = subparser.add_parser('overwrite-title-from-track', parents=[global_parser], help= 'sets the track number as title in the format: [ 1 ]')
+  overwrite_title_from_track_parser = subparser.add_parser('overwrite-title-from-track', parents=[global_parser, write_parser, plan_parser], help= 'sets the track number as title in the format: [ 1 ]')
   overwrite_title_from_track_parser.add_argument("--root", type=str, help="the directory under which the audiobook directories lay (or just a single directories)", default=None)
   overwrite_title_from_track_parser.add_argument("--renumber", action='store_true', help="whether the track number should be updated according to sort order of the original files in the directory")
   overwrite_title_from_track_parser.add_argument("--intro", type=str, default=None, help="assume the first track to be an introduction of some sorts, so that counting starts with the second chapter")
@@ -609,20 +1626,83 @@ def run_command():
 
 
 
-  convert_parser.set_defaults(func=convert)
+  pipeline_parser = subparser.add_parser('pipeline', parents=[global_parser, write_parser, plan_parser], help= 'applies several operations in one pass: every album is listed and every tag is read once, all operations are applied in the given order and the combined changes are confirmed once')
+  pipeline_parser.add_argument("operations", nargs='+', choices=list(PIPELINE_OPERATIONS), help="the operations in the order they are applied")
+  pipeline_parser.add_argument("--root", type=str, help="the directory under which the audiobook directories lay (or just a single directories)", default=None)
+  pipeline_parser.add_argument("--renumber", action='store_true', help="whether dirname-to-tag and tag-to-name should update the track number according to sort order of the original files in the directory")
+  pipeline_parser.set_defaults(func=pipeline)
 
-  parser.parse_args()
-  
-  args = parser.parse_args()
 
-  logging.getLogger("eyed3").setLevel(logging.CRITICAL)
-  if args.verbose:
-    logging.getLogger().setLevel(logging.DEBUG)
+  cache_parser = argparse.ArgumentParser(add_help=False)
+  cache_parser.add_argument("--file-cache", type=str, help="the sqlite file caching results computed from whole files by path, size and mtime", default=os.getenv("KAUDIOBOOKS_FILE_CACHE", paths.file_cache()))
+  cache_parser.add_argument("--no-file-cache", dest="file_cache", action='store_const', const=None, help="neither use nor update the file cache")
+
+  dedupe_parser = subparser.add_parser('dedupe', parents=[global_parser, cache_parser, plan_parser], help= 'finds albums holding the same audio (ignoring tags and names) and removes all but one of each after confirmation')
+  dedupe_parser.add_argument("--root", type=str, help="the directory under which the audiobook directories lay", default=None)
+  dedupe_parser.add_argument("--jobs", type=int, help="the number of files hashed in parallel", default=os.cpu_count() or 1)
+  dedupe_parser.add_argument("--keep", choices=["first", "oldest"], help="which album of duplicates to keep: the first by path or the one converted first", default="first")
+  dedupe_parser.set_defaults(func=dedupe)
+
+
+  verify_parser = subparser.add_parser('verify', parents=[global_parser, scan_parser, cache_parser], help= 'checks every chapter for truncation, garbage between frames and frame counts differing from the Xing/VBRI header by walking the mpeg frame headers (without decoding). Exits with 1 if a chapter is broken')
+  verify_parser.add_argument("--root", type=str, help="the directory under which the audiobook directories lay", default=None)
+  verify_parser.add_argument("--max-gap", type=int, help="the largest run of bytes between frames (or after the last) that is tolerated", default=4096)
+  verify_parser.set_defaults(func=verify)
+
+
+  catalog_parser = subparser.add_parser('catalog', parents=[global_parser, scan_parser, cache_parser], help= 'writes a catalog of all albums (album, author, chapters, duration, bytes, bitrate) as json lines or csv, streamed while the library is walked. Durations come from the Xing/Info/VBRI headers, or from counting the frames, nothing is decoded')
+  catalog_parser.add_argument("--root", type=str, help="the directory under which the audiobook directories lay", default=None)
+  catalog_parser.add_argument("--output", type=str, help="the catalog file (stdout by default, the log then goes to stderr)", default=None)
+  catalog_parser.add_argument("--format", choices=["jsonl", "csv"], help="the format of the catalog (by default csv for .csv files and json lines otherwise)", default=None)
+  catalog_parser.add_argument("--refresh", action='store_true', help="take the rows of unchanged albums from the existing --output instead of reading their chapters again")
+  catalog_parser.set_defaults(func=catalog)
+
+
+  merge_parser = subparser.add_parser('merge', parents=[global_parser, write_parser], help= 'joins the mpeg frames of the chapters of every album (in chapter order, without re-encoding) into one file with a CHAP frame per chapter. Albums whose merged file is newer than their chapters are skipped')
+  merge_parser.add_argument("--root", type=str, help="the directory under which the audiobook directories lay", default=None)
+  merge_parser.add_argument("--output-dir", type=str, help="the directory the merged files are written to, named after the album directories and in the same tree as below --root", required=True)
+  merge_parser.add_argument("--force", action='store_true', help="merge albums again even if their merged file is up to date")
+  merge_parser.set_defaults(func=merge)
+
+
+  transcode_parser = subparser.add_parser('transcode', parents=[global_parser, padding_parser], help= 'encodes every chapter again with another codec or bitrate into a mirror of the library, keeping the names and tags. Chapters whose output is newer than them are skipped, the largest albums go first')
+  transcode_parser.add_argument("--root", type=str, help="the directory under which the audiobook directories lay", default=None)
+  transcode_parser.add_argument("--output-dir", type=str, help="the root of the mirror tree the transcoded albums are written to", required=True)
+  # the keys of transcoder.CODECS
+  transcode_parser.add_argument("--codec", choices=["mp3", "opus", "aac"], help="the codec of the transcoded chapters", default="mp3")
+  transcode_parser.add_argument("--bitrate", type=str, help="the bitrate of the transcoded chapters (ffmpeg syntax)", default="64k")
+  transcode_parser.add_argument("--force", action='store_true', help="transcode chapters again even if their output is up to date")
+  transcode_parser.add_argument("--jobs", type=int, help="the number of chapters transcoded in parallel (defaults to the number of cpus)", default=os.cpu_count() or 1)
+  transcode_parser.set_defaults(func=transcode)
+
+
+  watch_parser = subparser.add_parser('watch', parents=[global_parser, write_parser], help= 'watches the library with inotify and applies the given pipeline operations to every album directory that was added or changed, once its files stopped changing. Changes are applied without confirmation and recorded in an audit log')
+  watch_parser.add_argument("operations", nargs='+', choices=list(PIPELINE_OPERATIONS), help="the operations in the order they are applied")
+  watch_parser.add_argument("--root", type=str, help="the directory under which the audiobook directories lay", default=None)
+  watch_parser.add_argument("--renumber", action='store_true', help="whether dirname-to-tag and tag-to-name should update the track number according to sort order of the original files in the directory")
+  watch_parser.add_argument("--settle", type=float, help="the seconds an album must be left alone before it is processed", default=10)
+  watch_parser.add_argument("--existing", action='store_true', help="also process the albums that exist when watching starts")
+  watch_parser.add_argument("--audit-log", type=str, help="the jsonl file every applied change is appended to (by default watch.jsonl in $XDG_STATE_HOME/kaudiobooks)", default=os.getenv("KAUDIOBOOKS_AUDIT_LOG"))
+  watch_parser.add_argument("--watch-journal", type=str, help="the journal of the changes watch applies, resumable with `resume --journal` (by default next to the audit log, --journal is left to interactive commits)", default=None)
+  watch_parser.set_defaults(func=watch)
+
+
+  apply_parser = subparser.add_parser('apply', parents=[global_parser], help= 'applies a change plan written by --plan-out, without scanning again. Albums whose files or directories were modified since the plan was made are skipped')
+  apply_parser.add_argument("plan", type=str, help="the plan file")
+  apply_parser.set_defaults(func=apply_plan, plan_out=None)
+
+
+  resume_parser = subparser.add_parser('resume', parents=[global_parser], help= 'finishes an interrupted commit from the journal without rescanning. Changes that are already applied are skipped')
+  resume_parser.set_defaults(func=resume, plan_out=None)
+
+
+  convert_parser.set_defaults(func=lazy_command("library", "convert"))
 
-  args.func(args)
+  return parser
 
 
 def date_or_datetime(value):
+    from datetime import datetime
     for fmt in ('%Y-%m-%d', '%Y-%m-%dT%H:%M:%S'):
         try:
             return datetime.strptime(value, fmt)
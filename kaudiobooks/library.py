@@ -0,0 +1,301 @@
+
+# The commands backed by the audible library: download and convert. They are
+# imported only when one of them runs, audible_cli and asyncio take longer to
+# import than most other commands take to run.
+
+import os
+import json
+import asyncio
+import logging
+import shutil
+import tempfile
+import contextlib
+import concurrent.futures
+from datetime import timedelta
+from audible_cli.models import Library
+from audible_cli.config import Session
+from audible.aescipher import decrypt_voucher_from_licenserequest
+from . import stats
+from . import snapshot
+from . import downloads
+from . import conversions
+from . import splitter
+from .walk import walk_albums
+from .kaudiobooks import sanitize_filename, chapter_filename
+
+log = logging.getLogger(__name__)
+
+
+def ensure_audible_dir(args):
+   if args.audible_dir is None:
+      raise ValueError("either --audible-dir or KAUDIOBOOKS_AUDIBLE_DIR must be set")
+
+# returns the library snapshot and its items selected by date as a Library.
+# The api is only asked if the snapshot is stale or codecs have to be looked up.
+async def load_library(args, client):
+  snap = snapshot.LibrarySnapshot(args.library_snapshot)
+  if args.refresh_library or not snap.is_fresh(timedelta(hours=args.snapshot_max_age)):
+    await snap.refresh(client, full=args.refresh_library)
+  else:
+    log.info(f"using library snapshot from {snap.fetched} (UTC)")
+  items = snap.select(args.start_date, args.end_date)
+  return snap, Library({"items": items, "response_groups": snap.response_groups}, api_client=client)
+
+
+def convert(args):
+  return asyncio.run(do_convert(args))
+
+class ConversionError(Exception):
+  pass
+
+
+CONVERSION_PREFIX = ".kaudiobooks-convert-"
+
+
+# finds the downloaded file of an item, the codec lookups may hit the api
+async def find_source(args, index, item, metadata_semaphore, snap):
+  base_filename = item.create_base_filename("ascii")
+  aaxcodec = snap.codecs.get(item.asin)
+  if aaxcodec is None:
+    async with metadata_semaphore:
+      try:
+        _, aaxcodec = await item.get_aax_url_old("best")
+        snap.codecs[item.asin] = aaxcodec
+      except:
+        aaxcodec = ""
+  aaxccodec, _ = item._get_codec("best")
+
+  aaxcpath = f"{args.audible_dir}/{base_filename}-{aaxccodec}.aax"
+  aaxpath = f"{args.audible_dir}/{base_filename}-{aaxcodec}.aaxc"
+  if os.path.isfile(aaxcpath):
+    return aaxcpath
+  elif os.path.isfile(aaxpath):
+    return aaxpath
+  else:
+     raise ConversionError(f"audiobook `{base_filename}` does not exist. Download it first.")
+
+
+# moves the book converted into `target_dir` into the output directory,
+# replacing an earlier (partial or forced) conversion of the same item
+def install_conversion(args, item, target_dir, outputs):
+  album = next((a for a in walk_albums(target_dir) if a.is_audiobook), None)
+  if album is None:
+    raise ConversionError(f"aaxtomp3 produced no chapters for `{item.create_base_filename('ascii')}`")
+  old_name = outputs.dir(item.asin)
+  if old_name is not None:
+    log.info(f"replacing earlier conversion: {old_name}")
+    shutil.rmtree(f"{args.output_dir}/{old_name}")
+  new_path = f"{args.output_dir}/{album.name}"
+  if os.path.exists(new_path):
+    raise ConversionError(f"path already exists: {new_path}")
+  os.rename(album.path, new_path)
+  return album.name
+
+
+# the ffmpeg backend: encodes the chapters of `source` on `encoder` (a process
+# pool) straight into the kaudiobooks layout and tags
+async def split_book(args, source, target_dir, encoder):
+  decryption = splitter.decryption_args(source, args.activation_bytes)
+  book = await asyncio.to_thread(splitter.read_book, source, decryption)
+  album_dir = f"{target_dir}/{sanitize_filename(f'{book.title} -- {book.author}')}"
+  os.makedirs(album_dir)
+  total = len(book.chapters)
+  digits = len(str(total))
+  loop = asyncio.get_running_loop()
+  encodes = []
+  for track, chapter in enumerate(book.chapters, 1):
+    path = f"{album_dir}/{chapter_filename(digits, chapter.title, book.title, (track, total))}"
+    fields = {"title": chapter.title, "album": book.title, "artist": book.author, "track_num": (track, total)}
+    encodes.append(loop.run_in_executor(encoder, splitter.encode_chapter, source, decryption, book, chapter, path, fields, args.bitrate or splitter.DEFAULT_BITRATE))
+  await asyncio.gather(*encodes)
+
+
+async def execute_conversion(args, index, item, path, semaphore, outputs, encoder=None):
+  base_filename = item.create_base_filename("ascii")
+  async with semaphore:
+    log.info(f"converting {index}: {base_filename}")
+    # books are converted next to the output and only moved there when done
+    target_dir = tempfile.mkdtemp(dir=args.output_dir, prefix=CONVERSION_PREFIX)
+    try:
+      with stats.phase("convert", path):
+        if encoder is not None:
+          await split_book(args, path, target_dir, encoder)
+        else:
+          process = await asyncio.create_subprocess_exec("aaxtomp3", "--target_dir", target_dir, "--dir-naming-scheme", "$title -- $artist", path)
+          returncode = await process.wait()
+          if returncode != 0:
+            raise ConversionError(f"aaxtomp3 exited with {returncode} converting `{base_filename}`")
+      stats.add_bytes("convert", read=os.path.getsize(path))
+      name = install_conversion(args, item, target_dir, outputs)
+    finally:
+      shutil.rmtree(target_dir, ignore_errors=True)
+  expected = conversions.expected_chapters(path, base_filename)
+  chapters, size = outputs.record(item.asin, name, path, expected)
+  log.info(f"conversion {index} finished: {name} ({chapters} chapters, {size} bytes)")
+  if expected is not None and chapters < expected:
+    log.warning(f"`{name}` has {chapters} of {expected} chapters, it will be converted again next time")
+
+
+def remove_stale_conversions(args):
+  for name in os.listdir(args.output_dir):
+    if name.startswith(CONVERSION_PREFIX):
+      log.info(f"removing interrupted conversion: {name}")
+      shutil.rmtree(f"{args.output_dir}/{name}", ignore_errors=True)
+
+
+# the process pool encoding chapters for the ffmpeg backend, None for aaxtomp3
+@contextlib.contextmanager
+def encoder_pool(args, jobs):
+  if args.backend != "ffmpeg":
+    yield None
+    return
+  with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as encoder:
+    yield encoder
+
+
+async def do_convert(args):
+  ensure_audible_dir(args)
+  log.info("loading library")
+  snap, lib = await load_library(args, Session().get_client())
+  log.info("items to convert:")
+  os.makedirs(args.output_dir, exist_ok=True)
+  remove_stale_conversions(args)
+  outputs = conversions.ConversionIndex(args.output_dir)
+  items = []
+  for index, item in enumerate(lib):
+    status = outputs.status(item.asin)
+    if status == "complete" and not args.force:
+      log.debug(f"skipping converted: {item.create_base_filename('ascii')}")
+      continue
+    if status == "partial":
+      log.info(f"converting again (partial output): {item.create_base_filename('ascii')}")
+    log.info(f"{item.create_base_filename("ascii")}")
+    items.append((index, item))
+  log.info(f"{len(items)} items to convert, {len(lib) - len(items)} already converted")
+
+  metadata_semaphore = asyncio.Semaphore(args.metadata_jobs)
+  sources = await asyncio.gather(*(find_source(args, index, item, metadata_semaphore, snap) for index, item in items), return_exceptions=True)
+  snap.save()
+
+  failures = []
+  queue = []
+  for (index, item), source in zip(items, sources):
+    if isinstance(source, Exception):
+      failures.append((item, source))
+    else:
+      queue.append((index, item, source))
+  if args.largest_first:
+    # long books are started first, so they don't straggle at the end
+    queue.sort(key=lambda entry: os.path.getsize(entry[2]), reverse=True)
+
+  log.info(f"starting conversion of {len(queue)} audiobooks with {args.jobs} jobs")
+  semaphore = asyncio.Semaphore(args.jobs)
+  with encoder_pool(args, args.jobs) as encoder:
+    results = await asyncio.gather(*(execute_conversion(args, index, item, path, semaphore, outputs, encoder) for index, item, path in queue), return_exceptions=True)
+  for (index, item, path), result in zip(queue, results):
+    if isinstance(result, Exception):
+      failures.append((item, result))
+
+  if failures:
+    log.error(f"{len(failures)} audiobooks were not converted:")
+    for item, error in failures:
+      log.error(f"{item.create_base_filename('ascii')}: {error}")
+
+
+def download(args):
+  return asyncio.run(do_download(args))
+
+
+def write_json(path, data):
+  with open(path, "w") as f:
+    json.dump(data, f, indent=4)
+
+
+# cover, pdf and annotations are nice to have, failing them fails no download
+async def download_extras(args, item, base_filename):
+  try:
+    url = item.get_cover_url(500)
+    if url is not None:
+      path = f"{args.audible_dir}/{base_filename}_(500).jpg"
+      if not os.path.isfile(path):
+        await asyncio.to_thread(downloads.fetch, str(url), path)
+  except Exception as e:
+    log.warning(f"cannot download the cover of `{base_filename}`: {e}")
+  try:
+    path = f"{args.audible_dir}/{base_filename}.pdf"
+    if not os.path.isfile(path):
+      url = await item.get_pdf_url()
+      if url is not None:
+        await asyncio.to_thread(downloads.fetch, str(url), path)
+  except Exception as e:
+    log.debug(f"no pdf for `{base_filename}`: {e}")
+  try:
+    path = f"{args.audible_dir}/{base_filename}-annotations.json"
+    if not os.path.isfile(path):
+      write_json(path, await item.get_annotations())
+  except Exception as e:
+    log.debug(f"no annotations for `{base_filename}`: {e}")
+
+
+# downloads the aaxc of an item along with its voucher and chapters (which
+# aaxtomp3 needs), named like `audible download --aaxc --chapter-type Flat`
+# does
+async def download_item(args, client, index, item, semaphore, snap):
+  base_filename = item.create_base_filename("ascii")
+  async with semaphore:
+    log.info(f"downloading {index}: {base_filename}")
+    url, codec, license = await item.get_aaxc_url("best")
+    license["content_license"]["license_response"] = decrypt_voucher_from_licenserequest(client.auth, license)
+    write_json(f"{args.audible_dir}/{base_filename}-{codec}.voucher", license)
+    write_json(f"{args.audible_dir}/{base_filename}-chapters.json", await item.get_content_metadata("best", chapter_type="Flat"))
+    reference = license["content_license"]["content_metadata"]["content_reference"]
+    path = f"{args.audible_dir}/{base_filename}-{codec}.aaxc"
+    with stats.phase("download", path):
+      await asyncio.to_thread(downloads.fetch, str(url), path, size=reference.get("content_size_in_bytes"))
+    stats.add_bytes("download", written=os.path.getsize(path))
+    await download_extras(args, item, base_filename)
+  # find_source looks for the aaxc by this codec
+  snap.codecs[item.asin] = codec
+  log.info(f"download {index} finished: {os.path.basename(path)} ({os.path.getsize(path)} bytes)")
+  return path
+
+
+async def download_and_convert(args, client, index, item, semaphores, snap, outputs, encoder):
+  semaphore, metadata_semaphore, convert_semaphore = semaphores
+  try:
+    path = await find_source(args, index, item, metadata_semaphore, snap)
+    log.debug(f"already downloaded: {path}")
+  except ConversionError:
+    path = await download_item(args, client, index, item, semaphore, snap)
+  if outputs is None:
+    return
+  if outputs.status(item.asin) == "complete" and not args.force:
+    log.debug(f"skipping converted: {item.create_base_filename('ascii')}")
+    return
+  # converting starts as soon as this download is done, while others go on
+  await execute_conversion(args, index, item, path, convert_semaphore, outputs, encoder)
+
+
+async def do_download(args):
+  ensure_audible_dir(args)
+  os.makedirs(args.audible_dir, exist_ok=True)
+  client = Session().get_client()
+  snap, lib = await load_library(args, client)
+  outputs = None
+  if args.convert:
+    os.makedirs(args.output_dir, exist_ok=True)
+    remove_stale_conversions(args)
+    outputs = conversions.ConversionIndex(args.output_dir)
+  semaphores = (asyncio.Semaphore(args.jobs), asyncio.Semaphore(args.metadata_jobs), asyncio.Semaphore(args.convert_jobs))
+  log.info(f"downloading up to {len(lib)} audiobooks with {args.jobs} jobs")
+  with encoder_pool(args, args.convert_jobs) as encoder:
+    results = await asyncio.gather(*(download_and_convert(args, client, index, item, semaphores, snap, outputs, encoder) for index, item in enumerate(lib)), return_exceptions=True)
+  snap.save()
+
+  failures = [(item, result) for item, result in zip(lib, results) if isinstance(result, Exception)]
+  if failures:
+    log.error(f"{len(failures)} audiobooks failed:")
+    for item, error in failures:
+      log.error(f"{item.create_base_filename('ascii')}: {error}")
+
+
@@ -0,0 +1,301 @@
+
+# Helpers for the layout of mp3 files: where the tags end and the mpeg audio
+# starts and ends.
+
+ID3V2_HEADER_SIZE = 10
+ID3V1_SIZE = 128
+
+
+def synchsafe(data):
+  return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+
+# the size of the id3v2 tag at the start of `header` (including its header and
+# footer), 0 if there is none
+def id3v2_size(header):
+  if len(header) < ID3V2_HEADER_SIZE or header[:3] != b"ID3" or header[3] == 0xff:
+    return 0
+  footer = ID3V2_HEADER_SIZE if header[5] & 0x10 else 0
+  return ID3V2_HEADER_SIZE + synchsafe(header[6:10]) + footer
+
+
+# the range of `buf` (bytes or mmap) holding the audio, without the id3v2 tags
+# in front and an id3v1 tag at the end
+def audio_range(buf):
+  end = len(buf)
+  start = 0
+  # some encoders leave more than one id3v2 tag in a row
+  while True:
+    size = id3v2_size(buf[start:start + ID3V2_HEADER_SIZE])
+    if size == 0:
+      break
+    start += size
+  start = min(start, end)
+  if end - start >= ID3V1_SIZE and buf[end - ID3V1_SIZE:end - ID3V1_SIZE + 3] == b"TAG":
+    end -= ID3V1_SIZE
+  return start, end
+
+
+# Frame scanning for `verify`. The length of a frame only depends on the
+# second and third header byte, so both are looked up in tables indexed by
+# those two bytes (0 for anything that is no valid header).
+
+# numpy makes resyncing after garbage much faster, but it takes longer to
+# import than most files take to scan, so it is imported with the first resync
+numpy = None
+numpy_checked = False
+
+BITRATES = {
+  (3, 3): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+  (3, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+  (3, 1): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+  (2, 3): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+  (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+  (2, 1): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+XING_OFFSETS = {(3, False): 36, (3, True): 21, (2, False): 21, (2, True): 13, (0, False): 21, (0, True): 13}
+VBRI_OFFSET = 36
+
+
+def frame_info(b1, b2):
+  if b1 & 0xe0 != 0xe0:
+    return 0, 0
+  version = (b1 >> 3) & 3
+  layer = (b1 >> 1) & 3
+  bitrate_index = b2 >> 4
+  rate_index = (b2 >> 2) & 3
+  if version == 1 or layer == 0 or bitrate_index in (0, 15) or rate_index == 3:
+    return 0, 0
+  # mpeg 2.5 uses the bitrates of mpeg 2
+  bitrate = BITRATES[(3 if version == 3 else 2, layer)][bitrate_index] * 1000
+  sample_rate = SAMPLE_RATES[version][rate_index]
+  padding = (b2 >> 1) & 1
+  if layer == 3:
+    return (12 * bitrate // sample_rate + padding) * 4, 384 / sample_rate
+  if layer == 2 or version == 3:
+    return 144 * bitrate // sample_rate + padding, 1152 / sample_rate
+  return 72 * bitrate // sample_rate + padding, 576 / sample_rate
+
+
+# filled by `build_tables` on first use, so commands that never look at frames
+# don't pay for it on startup
+FRAME_LENGTHS = [0] * 65536
+FRAME_DURATIONS = [0.0] * 65536
+tables_built = False
+
+
+def build_tables():
+  global tables_built
+  if tables_built:
+    return
+  for key in range(0xe000, 0x10000):
+    FRAME_LENGTHS[key], FRAME_DURATIONS[key] = frame_info(key >> 8, key & 0xff)
+  tables_built = True
+
+FRAME_LENGTH_ARRAY = None
+
+# resyncing after garbage looks at this many bytes at once
+RESYNC_WINDOW = 64 * 1024
+
+
+def frame_length(buf, pos):
+  if buf[pos] != 0xff:
+    return 0
+  return FRAME_LENGTHS[(buf[pos + 1] << 8) | buf[pos + 2]]
+
+
+# whether a frame at `pos` is followed by another one (or the end), which
+# rules out most sync words that are just audio data
+def confirmed_frame(buf, pos, end):
+  n = frame_length(buf, pos)
+  if n == 0:
+    return False
+  following = pos + n
+  return following + 4 > end or frame_length(buf, following) != 0
+
+
+def resync_numpy(buf, pos, end):
+  while pos + 4 <= end:
+    count = min(RESYNC_WINDOW, end - pos)
+    window = numpy.frombuffer(buf, dtype=numpy.uint8, count=count, offset=pos)
+    candidates = numpy.flatnonzero(window[:-2] == 0xff)
+    if len(candidates):
+      keys = (window[candidates + 1].astype(numpy.int64) << 8) | window[candidates + 2]
+      for candidate in candidates[FRAME_LENGTH_ARRAY[keys] != 0]:
+        if confirmed_frame(buf, pos + int(candidate), end):
+          return pos + int(candidate)
+    pos += max(count - 3, 1)
+  return end
+
+
+def resync_find(buf, pos, end):
+  while True:
+    pos = buf.find(b"\xff", pos, end - 3)
+    if pos < 0:
+      return end
+    if confirmed_frame(buf, pos, end):
+      return pos
+    pos += 1
+
+
+def load_numpy():
+  global numpy, numpy_checked, FRAME_LENGTH_ARRAY
+  if not numpy_checked:
+    numpy_checked = True
+    try:
+      import numpy
+    except ImportError:
+      return None
+    FRAME_LENGTH_ARRAY = numpy.array(FRAME_LENGTHS, dtype=numpy.int64)
+  return numpy
+
+
+# the position of the next frame at or after `pos`, `end` if there is none
+def resync(buf, pos, end):
+  if load_numpy() is not None:
+    return resync_numpy(buf, pos, end)
+  return resync_find(buf, pos, end)
+
+
+# the frame count of a Xing/Info or VBRI header in the first frame, None if
+# there is none
+def header_frames(buf, pos):
+  b1 = buf[pos + 1]
+  version = (b1 >> 3) & 3
+  mono = buf[pos + 3] >> 6 == 3
+  offset = pos + XING_OFFSETS[(version, mono)]
+  if buf[offset:offset + 4] in (b"Xing", b"Info"):
+    flags = int.from_bytes(buf[offset + 4:offset + 8], "big")
+    if flags & 1:
+      return int.from_bytes(buf[offset + 8:offset + 12], "big")
+  offset = pos + VBRI_OFFSET
+  if buf[offset:offset + 4] == b"VBRI":
+    return int.from_bytes(buf[offset + 14:offset + 18], "big")
+  return None
+
+
+# walks the frames of the audio in `buf` and reports what is wrong with it:
+# no frames at all, a last frame cut off, gaps (garbage between frames) larger
+# than `max_gap` bytes and a frame count differing from the Xing/VBRI header
+def scan_frames(buf, max_gap=4096):
+  build_tables()
+  start, end = audio_range(buf)
+  pos = start
+  frames = 0
+  duration = 0.0
+  gaps = 0
+  gap_bytes = 0
+  largest_gap = 0
+  largest_gap_at = None
+  truncated = 0
+  declared = None
+  first = True
+  # the first audio frame and the end of the last complete one
+  first_frame = None
+  frames_end = start
+  while pos + 4 <= end:
+    key = (buf[pos + 1] << 8) | buf[pos + 2]
+    n = FRAME_LENGTHS[key] if buf[pos] == 0xff else 0
+    if n == 0 or (frames == 0 and not confirmed_frame(buf, pos, end)):
+      following = resync(buf, pos + 1, end)
+      gap = following - pos
+      gaps += 1
+      gap_bytes += gap
+      if gap > largest_gap:
+        largest_gap = gap
+        largest_gap_at = pos
+      pos = following
+      continue
+    if pos + n > end:
+      truncated = pos + n - end
+      pos = end
+      break
+    if first:
+      first = False
+      declared = header_frames(buf, pos)
+      if declared is not None:
+        # the header frame carries no audio
+        pos += n
+        continue
+    if first_frame is None:
+      first_frame = pos
+    frames += 1
+    duration += FRAME_DURATIONS[key]
+    pos += n
+    frames_end = pos
+  trailing = end - pos
+  if trailing > 0:
+    gaps += 1
+    gap_bytes += trailing
+    if trailing > largest_gap:
+      largest_gap = trailing
+      largest_gap_at = pos
+
+  problems = []
+  if frames == 0:
+    problems.append("no mpeg frames")
+  if truncated:
+    problems.append(f"truncated: the last frame misses {truncated} bytes")
+  if largest_gap > max_gap:
+    problems.append(f"gap of {largest_gap} bytes at offset {largest_gap_at}")
+  if declared is not None and declared != frames:
+    problems.append(f"the header declares {declared} frames, found {frames}")
+  return {
+    "frames": frames,
+    "duration": duration,
+    "audio_bytes": end - start,
+    "first_frame": first_frame,
+    "frames_end": frames_end,
+    "gaps": gaps,
+    "gap_bytes": gap_bytes,
+    "largest_gap": largest_gap,
+    "truncated": truncated,
+    "declared_frames": declared,
+    "problems": problems,
+  }
+
+
+# the duration and audio size of `buf`, from the Xing/Info or VBRI header if
+# there is one, by counting the frames otherwise
+def stream_info(buf):
+  build_tables()
+  start, end = audio_range(buf)
+  pos = start
+  if pos + 4 <= end and not confirmed_frame(buf, pos, end):
+    pos = resync(buf, pos, end)
+  if pos + 4 <= end:
+    declared = header_frames(buf, pos)
+    if declared:
+      duration = declared * FRAME_DURATIONS[(buf[pos + 1] << 8) | buf[pos + 2]]
+      return {"duration": duration, "audio_bytes": end - start, "source": "header"}
+  info = scan_frames(buf)
+  return {"duration": info["duration"], "audio_bytes": info["audio_bytes"], "source": "frames"}
+
+
+# the stream format (version, layer, sample rate, channel mode) of the frame
+# header at `pos`, frames of different formats cannot be joined
+def stream_format(buf, pos):
+  return (buf[pos + 1] & 0xfe, buf[pos + 2] & 0x0c, buf[pos + 3] & 0xc0)
+
+
+# an Info frame in the format of the frame header `header` declaring `frames`
+# frames and `size` bytes (including itself), None if that frame is too small
+def xing_frame(header, frames, size):
+  build_tables()
+  header = bytearray(header[:4])
+  # no crc, no padding
+  header[1] |= 0x01
+  header[2] &= 0xfd
+  n = FRAME_LENGTHS[(header[1] << 8) | header[2]]
+  offset = XING_OFFSETS[((header[1] >> 3) & 3, header[3] >> 6 == 3)]
+  if n < offset + 16:
+    return None
+  frame = bytearray(n)
+  frame[:4] = header
+  frame[offset:offset + 4] = b"Info"
+  frame[offset + 4:offset + 8] = (3).to_bytes(4, "big")
+  frame[offset + 8:offset + 12] = frames.to_bytes(4, "big")
+  frame[offset + 12:offset + 16] = (size + n).to_bytes(4, "big")
+  return bytes(frame)
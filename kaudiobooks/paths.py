@@ -0,0 +1,36 @@
+
+# The default locations of the files kaudiobooks keeps between runs. They are
+# kept apart from the modules using the files, so that the cli can offer them
+# as defaults without importing those modules (and sqlite3) on every start.
+
+import os
+
+
+def cache_path(name):
+  cache_dir = os.getenv("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+  return f"{cache_dir}/kaudiobooks/{name}"
+
+
+def state_path(name):
+  state_dir = os.getenv("XDG_STATE_HOME") or os.path.expanduser("~/.local/state")
+  return f"{state_dir}/kaudiobooks/{name}"
+
+
+def tag_index():
+  return cache_path("tags.sqlite")
+
+
+def file_cache():
+  return cache_path("files.sqlite")
+
+
+def library_snapshot():
+  return cache_path("library.json")
+
+
+def journal():
+  return state_path("journal.jsonl")
+
+
+def audit_log():
+  return state_path("watch.jsonl")
@@ -0,0 +1,67 @@
+
+# A change plan: the changes of a scan written to a file (--plan-out) instead
+# of being applied, so that `apply` can commit them later without scanning
+# again. Every change carries the size and mtime of the file or directory it
+# was planned for, albums with a change whose source was modified since are
+# not applied. Chapter changes also record the old and new tag fields for
+# whoever reviews the plan.
+#
+#   {"plan": 1, "created": "...", "command": ["tag-to-name", ...]}
+#   {"album": 0, "change": {...}, "source": {"size": 123, "mtime_ns": 456}, "diff": {"title": ["old", "new"]}}
+
+import os
+import json
+import logging
+import tempfile
+from datetime import datetime, timezone
+
+log = logging.getLogger(__name__)
+
+VERSION = 1
+
+
+def source_stat(path):
+  try:
+    st = os.stat(path)
+  except FileNotFoundError:
+    return None
+  return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+# `albums` is a list of lists of (change as json, diff or None)
+def write(path, command, albums):
+  directory = os.path.dirname(os.path.abspath(path))
+  os.makedirs(directory, exist_ok=True)
+  fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".kaudiobooks-plan-")
+  try:
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+      header = {"plan": VERSION, "created": datetime.now(timezone.utc).isoformat(timespec="seconds"), "command": command}
+      f.write(json.dumps(header, ensure_ascii=False) + "\n")
+      for album_id, album in enumerate(albums):
+        for change, diff in album:
+          entry = {"album": album_id, "change": change, "source": source_stat(change["path"])}
+          if diff:
+            entry["diff"] = diff
+          f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, path)
+  except:
+    os.remove(tmp_path)
+    raise
+
+
+# returns the header and the entries of a plan, grouped by album
+def read(path):
+  albums = {}
+  with open(path, encoding="utf-8") as f:
+    header = json.loads(f.readline() or "{}")
+    if header.get("plan") != VERSION:
+      raise ValueError(f"`{path}` is no change plan of version {VERSION}")
+    for line in f:
+      entry = json.loads(line)
+      albums.setdefault(entry["album"], []).append(entry)
+  return header, list(albums.values())
+
+
+# whether the source of an entry is unchanged since it was planned
+def is_current(entry):
+  return source_stat(entry["change"]["path"]) == entry["source"]
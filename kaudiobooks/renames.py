@@ -0,0 +1,118 @@
+
+# Checks the renames of a commit before it is confirmed: entries renamed to
+# the same name, renames onto entries that stay where they are and rename
+# cycles. Names are compared by a key (sanitized and unicode normalized, see
+# `name_key` in kaudiobooks.py), so names that only differ in spelling count as
+# the same. The existing names come from the listings of the walk, every check
+# is a dict lookup and costs no stat call.
+#
+# A rename onto an entry that is renamed or removed itself is fine if that
+# happens first. Within an album the changes are applied in order, so they are
+# reordered; across albums they run concurrently, which is reported instead.
+
+import os
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class NameIndex:
+
+  def __init__(self, key):
+    self.key = key
+    # directory -> {key: [names]} of its entries
+    self.listings = {}
+
+  def add_listing(self, directory, names):
+    listing = {}
+    for name in names:
+      listing.setdefault(self.key(name), []).append(name)
+    self.listings[directory] = listing
+
+  def existing(self, directory):
+    listing = self.listings.get(directory)
+    if listing is None:
+      # a directory outside the walk, e.g. the parent of --root
+      try:
+        names = os.listdir(directory)
+      except OSError:
+        names = []
+      self.add_listing(directory, names)
+      listing = self.listings[directory]
+    return listing
+
+  def slot(self, path):
+    return os.path.dirname(path), self.key(os.path.basename(path))
+
+  # `moves` is a list of (item, group, source, target), target None for
+  # removals. Returns the problems and, for every item that must wait for
+  # another item of its group, that item.
+  def check(self, moves):
+    problems = []
+    vacated = {source: (item, group) for item, group, source, target in moves}
+    claimed = {}
+    first = {}
+    for item, group, source, target in moves:
+      if target is None:
+        continue
+      directory, key = slot = self.slot(target)
+      other = claimed.get(slot)
+      if other is not None:
+        problems.append(f"`{other}` and `{source}` would both be renamed to `{target}`")
+        continue
+      claimed[slot] = source
+      occupants = [os.path.join(directory, name) for name in self.existing(directory).get(key, ())]
+      occupants = [path for path in occupants if path != source]
+      if not occupants:
+        continue
+      if len(occupants) > 1:
+        problems.append(f"`{source}` would be renamed onto {' and '.join(f'`{path}`' for path in occupants)}")
+        continue
+      occupant = vacated.get(occupants[0])
+      if occupant is None:
+        problems.append(f"`{source}` would be renamed onto the existing `{occupants[0]}`")
+      elif occupant[1] is not group:
+        problems.append(f"`{source}` would be renamed onto `{occupants[0]}`, which is renamed itself in the same commit")
+      else:
+        first[item] = occupant[0]
+    problems += self.cycles(first, moves)
+    return problems, first
+
+  # follows the chains of `first`, every item is visited once
+  def cycles(self, first, moves):
+    sources = {id(item): source for item, _, source, _ in moves}
+    problems = []
+    done = set()
+    for start in first:
+      chain = []
+      seen = set()
+      item = start
+      while item is not None and id(item) not in done:
+        if id(item) in seen:
+          cycle = chain[chain.index(item):]
+          problems.append("rename cycle: " + " --> ".join(f"`{sources[id(i)]}`" for i in cycle + [item]))
+          break
+        seen.add(id(item))
+        chain.append(item)
+        item = first.get(item)
+      done.update(seen)
+    return problems
+
+
+# `items` with every item of `first` moved behind the one it waits for
+def ordered(items, first):
+  r = []
+  placed = set()
+
+  def place(item):
+    if id(item) in placed:
+      return
+    placed.add(id(item))
+    before = first.get(item)
+    if before is not None:
+      place(before)
+    r.append(item)
+
+  for item in items:
+    place(item)
+  return r
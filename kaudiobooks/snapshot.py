@@ -0,0 +1,114 @@
+
+# A local snapshot of the audible library. It is refreshed incrementally by
+# purchase date, so most runs only fetch the latest purchases (or nothing at
+# all while the snapshot is fresh). Codec lookups are cached per asin as well.
+# Items are kept as the json the library api returned them in, together with
+# the response groups they were requested with.
+
+import os
+import json
+import logging
+import tempfile
+from datetime import datetime, timedelta, timezone
+
+log = logging.getLogger(__name__)
+
+# purchases are fetched again from a day before the latest known one, in case
+# the api lags behind
+REFRESH_OVERLAP = timedelta(days=1)
+
+PAGE_SIZE = 1000
+
+# the response groups audible-cli asks for by default
+RESPONSE_GROUPS = (
+  "contributors, customer_rights, media, price, product_attrs, product_desc, "
+  "product_extended_attrs, product_plan_details, product_plans, rating, sample, "
+  "sku, series, reviews, ws4v, origin, relationships, review_attrs, categories, "
+  "badge_types, category_ladders, claim_code_url, is_downloaded, is_finished, "
+  "is_returnable, origin_asin, pdf_url, percent_complete, provided_review"
+)
+
+
+def parse_date(value):
+  if value is None:
+    return None
+  return datetime.fromisoformat(value).replace(tzinfo=None)
+
+
+# returns the items (as json) purchased on or after `start_date` (all items if
+# it is None) and the response groups of the api response. `client` is an
+# audible.AsyncClient.
+async def fetch_library(client, start_date=None, response_groups=RESPONSE_GROUPS):
+  params = {"response_groups": response_groups, "num_results": PAGE_SIZE}
+  if start_date is not None:
+    params["purchased_after"] = start_date.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+  items = []
+  page = 1
+  while True:
+    response = await client.get("library", page=page, **params)
+    items += response["items"]
+    if len(response["items"]) < PAGE_SIZE:
+      return items, response.get("response_groups")
+    page += 1
+
+
+class LibrarySnapshot:
+
+  def __init__(self, path):
+    self.path = path
+    try:
+      with open(path) as f:
+        data = json.load(f)
+      self.fetched = parse_date(data["fetched"])
+      self.items = {item["asin"]: item for item in data["items"]}
+      self.codecs = data["codecs"]
+      self.response_groups = data.get("response_groups")
+    except FileNotFoundError:
+      self.fetched = None
+      self.items = {}
+      self.codecs = {}
+      self.response_groups = None
+
+  def save(self):
+    directory = os.path.dirname(os.path.abspath(self.path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".library-")
+    with os.fdopen(fd, "w") as f:
+      json.dump({"fetched": self.fetched.isoformat(), "response_groups": self.response_groups, "items": list(self.items.values()), "codecs": self.codecs}, f, ensure_ascii=False)
+    os.replace(tmp_path, self.path)
+
+  def is_fresh(self, max_age):
+    return self.fetched is not None and datetime.now(timezone.utc).replace(tzinfo=None) - self.fetched <= max_age
+
+  def latest_purchase(self):
+    dates = [parse_date(item.get("purchase_date")) for item in self.items.values()]
+    dates = [date for date in dates if date is not None]
+    return max(dates) if dates else None
+
+  async def refresh(self, client, full=False):
+    # snapshots without response groups are fetched again as a whole
+    start_date = None if full or self.response_groups is None else self.latest_purchase()
+    if start_date is not None:
+      start_date -= REFRESH_OVERLAP
+    log.info(f"fetching library purchases since {start_date}" if start_date is not None else "fetching the whole library")
+    fetched = datetime.now(timezone.utc).replace(tzinfo=None)
+    items, response_groups = await fetch_library(client, start_date)
+    if start_date is None:
+      self.items = {}
+    self.response_groups = response_groups
+    for item in items:
+      self.items[item["asin"]] = item
+    self.fetched = fetched
+    self.save()
+    log.info(f"library snapshot has {len(self.items)} items ({len(items)} fetched)")
+
+  def select(self, start_date=None, end_date=None):
+    items = []
+    for item in self.items.values():
+      date = parse_date(item.get("purchase_date"))
+      if start_date is not None and (date is None or date < start_date):
+        continue
+      if end_date is not None and (date is None or date > end_date):
+        continue
+      items.append(item)
+    return items
@@ -0,0 +1,115 @@
+# A conversion backend without aaxtomp3. Every chapter is one ffmpeg run (in a
+# process pool, see `encode_chapter`) that seeks to the chapter in the source,
+# decodes and encodes it in one pipeline and writes the tag along with the
+# audio, so nothing but the chapter files is written. The cuts are sample
+# exact, so consecutive chapters neither overlap nor leave gaps.
+
+import os
+import json
+import logging
+import subprocess
+from . import id3
+
+log = logging.getLogger(__name__)
+
+FFMPEG = "ffmpeg"
+FFPROBE = "ffprobe"
+DEFAULT_BITRATE = "128k"
+
+
+class SplitError(Exception):
+  pass
+
+
+class Chapter:
+  __slots__ = ("title", "start", "end")
+
+  def __init__(self, title, start, end):
+    self.title = title
+    self.start = start
+    self.end = end
+
+
+class Book:
+  __slots__ = ("title", "author", "chapters", "sample_rate")
+
+  def __init__(self, title, author, chapters, sample_rate):
+    self.title = title
+    self.author = author
+    self.chapters = chapters
+    self.sample_rate = sample_rate
+
+
+# the ffmpeg options decrypting `source`. aaxc files are decrypted with the key
+# from the voucher `audible download` puts next to them, aax files need the
+# activation bytes of the account, anything else is read as is.
+def decryption_args(source, activation_bytes=None):
+  stem, ext = os.path.splitext(source)
+  if ext == ".aaxc":
+    try:
+      with open(f"{stem}.voucher") as f:
+        voucher = json.load(f)["content_license"]["license_response"]
+    except (OSError, ValueError, KeyError) as e:
+      raise SplitError(f"no usable voucher for `{source}`: {e}")
+    return ["-audible_key", voucher["key"], "-audible_iv", voucher["iv"]]
+  if ext == ".aax":
+    if activation_bytes is None:
+      raise SplitError(f"activation bytes are required to convert `{source}`")
+    return ["-activation_bytes", activation_bytes]
+  return []
+
+
+def run(command):
+  result = subprocess.run(command, stdin=subprocess.DEVNULL, capture_output=True)
+  if result.returncode != 0:
+    raise SplitError(f"{command[0]} exited with {result.returncode}: {result.stderr.decode(errors='replace').strip()}")
+  return result.stdout
+
+
+def read_book(source, decryption):
+  info = json.loads(run([FFPROBE, "-v", "error", *decryption, "-i", source, "-select_streams", "a:0", "-show_streams", "-show_format", "-show_chapters", "-of", "json"]))
+  if not info.get("streams"):
+    raise SplitError(f"`{source}` has no audio stream")
+  tags = {name.lower(): value for name, value in info["format"].get("tags", {}).items()}
+  title = tags.get("title") or tags.get("album") or os.path.splitext(os.path.basename(source))[0]
+  author = tags.get("artist") or tags.get("album_artist") or "Unknown"
+  chapters = []
+  for n, chapter in enumerate(info.get("chapters", []), 1):
+    chapter_title = chapter.get("tags", {}).get("title") or f"Chapter {n}"
+    chapters.append(Chapter(chapter_title, float(chapter["start_time"]), float(chapter["end_time"])))
+  if not chapters:
+    chapters.append(Chapter(title, 0.0, float(info["format"]["duration"])))
+  return Book(title, author, chapters, int(info["streams"][0]["sample_rate"]))
+
+
+# the ffmpeg metadata options of the id3 tag holding `fields`
+def metadata_args(fields):
+  r = []
+  for name, value in fields.items():
+    if name == "track_num":
+      num, total = value
+      name, value = "track", str(num) if total is None else f"{num}/{total}"
+    r += ["-metadata", f"{name}={value}"]
+  return r
+
+
+# the start and duration of a chapter as ffmpeg reads them, counted in whole
+# samples so that a chapter ends at the sample the next one starts at
+def chapter_times(book, chapter):
+  start = round(chapter.start * book.sample_rate)
+  end = round(chapter.end * book.sample_rate)
+  return f"{start / book.sample_rate:.6f}", f"{(end - start) / book.sample_rate:.6f}"
+
+
+# encodes one chapter of `source` into `path`, tagged with `fields` and with
+# `padding` bytes left in the tag for later changes. Runs in a worker process.
+def encode_chapter(source, decryption, book, chapter, path, fields, bitrate=DEFAULT_BITRATE, padding=id3.DEFAULT_PADDING):
+  start, duration = chapter_times(book, chapter)
+  command = [FFMPEG, "-v", "error", "-nostdin", "-y", *decryption, "-ss", start, "-i", source, "-t", duration, "-map", "0:a:0",
+    "-map_metadata", "-1", "-map_chapters", "-1", *metadata_args(fields), "-id3v2_version", "4", "-metadata_header_padding", str(padding),
+    "-codec:a", "libmp3lame", "-b:a", bitrate, "-f", "mp3", path]
+  try:
+    run(command)
+  except SplitError as e:
+    raise SplitError(f"encoding `{os.path.basename(path)}` failed: {e}")
+  return path
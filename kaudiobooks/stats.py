@@ -0,0 +1,152 @@
+
+# Instrumentation behind --stats: the wall time, calls, bytes read and written
+# and the slowest items of every phase of a run. Recording is off unless
+# `enable()` was called, `phase()` then returns a shared no-op timer. Scan
+# workers record their own stats, which `collect` hands back to the main
+# process to be merged.
+
+import time
+import json
+import heapq
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+SLOWEST = 5
+
+enabled = False
+phases = {}
+lock = threading.Lock()
+
+
+class Phase:
+  __slots__ = ("seconds", "calls", "bytes_read", "bytes_written", "slowest")
+
+  def __init__(self):
+    self.seconds = 0.0
+    self.calls = 0
+    self.bytes_read = 0
+    self.bytes_written = 0
+    # a min-heap of (seconds, item), the fastest of the slowest on top
+    self.slowest = []
+
+  def add(self, seconds, item):
+    self.seconds += seconds
+    self.calls += 1
+    if item is not None:
+      if len(self.slowest) < SLOWEST:
+        heapq.heappush(self.slowest, (seconds, item))
+      elif seconds > self.slowest[0][0]:
+        heapq.heapreplace(self.slowest, (seconds, item))
+
+  def to_json(self):
+    return {
+      "seconds": self.seconds,
+      "calls": self.calls,
+      "bytes_read": self.bytes_read,
+      "bytes_written": self.bytes_written,
+      "slowest": [{"seconds": seconds, "item": item} for seconds, item in sorted(self.slowest, reverse=True)],
+    }
+
+
+def get(name):
+  p = phases.get(name)
+  if p is None:
+    p = phases[name] = Phase()
+  return p
+
+
+class Timer:
+  __slots__ = ("name", "item", "start")
+
+  def __init__(self, name, item):
+    self.name = name
+    self.item = item
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, *exc):
+    seconds = time.perf_counter() - self.start
+    with lock:
+      get(self.name).add(seconds, self.item)
+
+
+class NoTimer:
+  __slots__ = ()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    pass
+
+
+NO_TIMER = NoTimer()
+
+
+def enable():
+  global enabled
+  enabled = True
+
+
+# times the block as one call of `name`, `item` (e.g. a path) is remembered if
+# it is among the slowest
+def phase(name, item=None):
+  if not enabled:
+    return NO_TIMER
+  return Timer(name, item)
+
+
+def add_bytes(name, read=0, written=0):
+  if not enabled:
+    return
+  with lock:
+    p = get(name)
+    p.bytes_read += read
+    p.bytes_written += written
+
+
+def snapshot():
+  with lock:
+    return {name: p.to_json() for name, p in phases.items()}
+
+
+def merge(data):
+  with lock:
+    for name, other in data.items():
+      p = get(name)
+      p.seconds += other["seconds"]
+      p.calls += other["calls"]
+      p.bytes_read += other["bytes_read"]
+      p.bytes_written += other["bytes_written"]
+      for entry in other["slowest"]:
+        heapq.heappush(p.slowest, (entry["seconds"], entry["item"]))
+        if len(p.slowest) > SLOWEST:
+          heapq.heappop(p.slowest)
+
+
+# runs `fn(*args)` in a worker process and returns its result with the stats
+# it recorded, for `merge` in the main process
+def collect(fn, *args):
+  enable()
+  with lock:
+    phases.clear()
+  return fn(*args), snapshot()
+
+
+def report(total):
+  log.info(f"stats for {total:.3f}s:")
+  log.info(f"{'phase':<14} {'calls':>8} {'seconds':>10} {'ms/call':>9} {'read':>12} {'written':>12}")
+  for name, p in sorted(phases.items(), key=lambda entry: entry[1].seconds, reverse=True):
+    per_call = p.seconds / p.calls * 1000 if p.calls else 0
+    log.info(f"{name:<14} {p.calls:>8} {p.seconds:>10.3f} {per_call:>9.3f} {p.bytes_read:>12} {p.bytes_written:>12}")
+    for seconds, item in sorted(p.slowest, reverse=True):
+      log.info(f"{'':<14} {seconds * 1000:>10.1f}ms {item}")
+
+
+def write_json(path, total, command):
+  with open(path, "w") as f:
+    json.dump({"command": command, "seconds": total, "phases": snapshot()}, f, indent=2, ensure_ascii=False)
@@ -0,0 +1,128 @@
+
+# An on-disk cache of the parsed tags of chapter files. Entries are keyed by
+# absolute path and only used while size and mtime of the file still match.
+
+import os
+import time
+import sqlite3
+import logging
+from . import id3
+
+log = logging.getLogger(__name__)
+
+SCHEMA_VERSION = 2
+
+# parsed tags are written in batches of this many rows, each in a short
+# transaction of its own, so that worker processes scanning a cold index
+# don't wait on each other's write lock while they parse
+BATCH_SIZE = 64
+
+
+# switches `db` to wal. Connections switching a new database at the same time
+# can get busy back without the busy timeout being waited for, so this retries
+# until `timeout` seconds have passed.
+def set_wal(db, timeout=60):
+  deadline = time.monotonic() + timeout
+  while True:
+    try:
+      db.execute("pragma journal_mode=wal")
+      return
+    except sqlite3.OperationalError as e:
+      if e.sqlite_errorname != "SQLITE_BUSY" or time.monotonic() > deadline:
+        raise
+    time.sleep(0.01)
+
+
+class TagIndex:
+
+  def __init__(self, path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    self.db = sqlite3.connect(path, timeout=60)
+    set_wal(self.db)
+    self.db.execute("pragma synchronous=normal")
+    # worker processes may open the index at the same time
+    self.db.execute("begin immediate")
+    version = self.db.execute("pragma user_version").fetchone()[0]
+    if version != SCHEMA_VERSION:
+      log.debug(f"recreating tag index {path} (schema {version})")
+      self.db.execute("drop table if exists tags")
+      self.db.execute('''create table tags (
+        path text primary key,
+        size integer not null,
+        mtime integer not null,
+        title text,
+        album text,
+        artist text,
+        track integer,
+        total integer,
+        version integer,
+        tag_size integer,
+        other_size integer
+      )''')
+      self.db.execute(f"pragma user_version={SCHEMA_VERSION}")
+    self.db.commit()
+    self.pending = []
+
+  def load(self, path, st=None):
+    path = os.path.abspath(path)
+    if st is None:
+      st = os.stat(path)
+    row = self.db.execute(
+      "select title, album, artist, track, total, version, tag_size, other_size from tags where path = ? and size = ? and mtime = ?",
+      (path, st.st_size, st.st_mtime_ns)).fetchone()
+    if row is not None:
+      tag = id3.Tag(*row[5:])
+      tag.title, tag.album, tag.artist = row[:3]
+      tag.track_num = (row[3], row[4])
+      return tag
+    tag = id3.load(path)
+    if tag is not None:
+      self.store(path, st, tag)
+    return tag
+
+  def store(self, path, st, tag):
+    track_num = tuple(tag.track_num)
+    # tags read by eyed3 have no layout info, they are stored without it
+    layout = (tag.version, tag.size, tag.other_size) if isinstance(tag, id3.Tag) else (None, None, None)
+    self.pending.append((path, st.st_size, st.st_mtime_ns, tag.title, tag.album, tag.artist, track_num[0], track_num[1], *layout))
+    if len(self.pending) >= BATCH_SIZE:
+      self.commit()
+
+  def write_pending(self):
+    if self.pending:
+      self.db.executemany("insert or replace into tags values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", self.pending)
+      self.pending = []
+
+  def forget(self, path):
+    self.write_pending()
+    self.db.execute("delete from tags where path = ?", (os.path.abspath(path),))
+
+  # re-reads a chapter after it was saved and/or renamed
+  def refresh(self, path, new_path):
+    self.forget(path)
+    self.load(new_path)
+
+  def rename_tree(self, path, new_path):
+    path = os.path.abspath(path)
+    new_path = os.path.abspath(new_path)
+    self.write_pending()
+    self.db.execute(
+      "update or replace tags set path = ? || substr(path, ?) where substr(path, 1, ?) = ?",
+      (new_path, len(path) + 1, len(path) + 1, path + "/"))
+
+  def commit(self):
+    self.write_pending()
+    self.db.commit()
+
+
+# one connection per process and database, worker processes open their own
+connections = {}
+
+
+def open_index(path):
+  key = (os.getpid(), path)
+  index = connections.get(key)
+  if index is None:
+    index = TagIndex(path)
+    connections[key] = index
+  return index
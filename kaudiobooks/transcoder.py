@@ -0,0 +1,75 @@
+
+# Re-encodes chapters into smaller files for devices that cannot hold the
+# converted library. Every chapter is one ffmpeg run in a worker process, the
+# output keeps the name (up to the extension) and the tag of its source.
+
+import os
+import mmap
+import logging
+import resource
+import subprocess
+from . import id3
+from . import mpeg
+from .splitter import FFMPEG
+
+log = logging.getLogger(__name__)
+
+# codec -> (ffmpeg encoder, file extension, ffmpeg format)
+CODECS = {
+  "mp3": ("libmp3lame", ".mp3", "mp3"),
+  "opus": ("libopus", ".opus", "ogg"),
+  "aac": ("aac", ".m4a", "ipod"),
+}
+
+TAG_FIELDS = ("title", "album", "artist", "track_num")
+
+
+class TranscodeError(Exception):
+  pass
+
+
+def source_duration(path):
+  with open(path, "rb") as f:
+    if os.fstat(f.fileno()).st_size == 0:
+      return 0.0
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+      return mpeg.stream_info(mm)["duration"]
+
+
+def children_cpu():
+  usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+  return usage.ru_utime + usage.ru_stime
+
+
+# encodes `source` into `path` and returns the seconds of audio and the cpu
+# seconds ffmpeg took. Runs in a worker process.
+def transcode_chapter(source, path, codec, bitrate, padding=id3.DEFAULT_PADDING):
+  encoder, _, output_format = CODECS[codec]
+  tag = id3.load(source)
+  fields = {}
+  if tag is not None:
+    for name in TAG_FIELDS:
+      value = getattr(tag, name, None)
+      fields[name] = tuple(value) if name == "track_num" and value is not None else value
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  tmp_path = f"{os.path.dirname(path)}/.kaudiobooks-transcode-{os.path.basename(path)}"
+  command = [FFMPEG, "-v", "error", "-y", "-i", source, "-map", "0:a:0", "-codec:a", encoder, "-b:a", bitrate]
+  if codec == "mp3":
+    # the tag is written by id3.create, like the one of converted chapters
+    command += ["-map_metadata", "-1", "-write_id3v2", "0"]
+  else:
+    command += ["-map_metadata", "0"]
+  command += ["-f", output_format, tmp_path]
+  cpu = children_cpu()
+  try:
+    result = subprocess.run(command, stdin=subprocess.DEVNULL, capture_output=True)
+    if result.returncode != 0:
+      raise TranscodeError(f"encoding `{os.path.basename(path)}` failed: {result.stderr.decode(errors='replace').strip()}")
+    if codec == "mp3":
+      id3.create(tmp_path, {name: value for name, value in fields.items() if value is not None}, padding)
+    os.replace(tmp_path, path)
+  except:
+    if os.path.exists(tmp_path):
+      os.remove(tmp_path)
+    raise
+  return source_duration(source), children_cpu() - cpu
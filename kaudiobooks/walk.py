@@ -0,0 +1,80 @@
+
+# Walks a library with os.scandir and lazily yields one Album per directory,
+# top-down. The file type comes from the directory entry, so listing an album
+# costs no extra stat calls.
+
+import os
+import logging
+from natsort import natsorted
+from . import stats
+
+log = logging.getLogger(__name__)
+
+
+def is_chapter_file(path):
+  return path.endswith(".mp3")
+
+
+class Album:
+  __slots__ = ("path", "files", "dirs", "chapters", "stats")
+
+  def __init__(self, path, files, dirs):
+    self.path = path
+    # natsorted names of the files and subdirectories
+    self.files = files
+    self.dirs = dirs
+    self.chapters = [f for f in files if is_chapter_file(f)]
+    self.stats = {}
+
+  @property
+  def is_audiobook(self):
+    return len(self.chapters) > 0
+
+  @property
+  def name(self):
+    return os.path.basename(self.path)
+
+  # the stat of a file in the album, cached for later calls
+  def stat(self, name):
+    st = self.stats.get(name)
+    if st is None:
+      st = os.stat(f"{self.path}/{name}")
+      self.stats[name] = st
+    return st
+
+
+def scan(path):
+  files = []
+  dirs = []
+  subdirs = []
+  with stats.phase("list", path), os.scandir(path) as it:
+    for entry in it:
+      if entry.is_dir():
+        dirs.append(entry.name)
+        # like os.walk, symlinked directories are listed but not entered
+        if not entry.is_symlink():
+          subdirs.append(entry.name)
+      else:
+        files.append(entry.name)
+  with stats.phase("sort", path):
+    return Album(path, natsorted(files), natsorted(dirs)), natsorted(subdirs)
+
+
+def walk_albums(root):
+  root = "." if root is None else root
+  if root != "/":
+    root = root.rstrip("/")
+  if not os.path.isdir(root):
+    log.info(f"not a directory: {root}")
+    return
+  stack = [root]
+  while stack:
+    path = stack.pop()
+    try:
+      album, subdirs = scan(path)
+    except OSError as e:
+      log.error(f"cannot list `{path}`: {e}")
+      continue
+    yield album
+    prefix = "" if path == "/" else path
+    stack.extend(f"{prefix}/{name}" for name in reversed(subdirs))
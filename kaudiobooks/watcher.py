@@ -0,0 +1,154 @@
+
+# Watches a library with inotify and reports the directories whose contents
+# changed, once no more events arrived for them for `settle` seconds (so books
+# that are still being copied or converted are left alone). New directories
+# are watched as they appear, moved ones are followed.
+
+import os
+import json
+import time
+import logging
+from datetime import datetime, timezone
+from . import inotify
+
+log = logging.getLogger(__name__)
+
+WATCH_MASK = (inotify.IN_MODIFY | inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO
+  | inotify.IN_CREATE | inotify.IN_DELETE | inotify.IN_ONLYDIR)
+
+
+# watch journals its changes next to its audit log, apart from the journal of
+# interactive commits
+def journal_path(audit_path):
+  return f"{os.path.splitext(audit_path)[0]}-journal.jsonl"
+
+
+def subtree(paths, path):
+  prefix = path.rstrip("/") + "/"
+  return [p for p in paths if p == path or p.startswith(prefix)]
+
+
+class Watcher:
+
+  def __init__(self, root, settle):
+    self.root = root.rstrip("/") or "/"
+    self.settle = settle
+    self.inotify = inotify.Inotify()
+    self.paths = {}
+    self.wds = {}
+    # directory -> time of its last event
+    self.dirty = {}
+    self.add_tree(self.root)
+
+  # watches `path` and all directories below it, returns them
+  def add_tree(self, path):
+    added = []
+    stack = [path]
+    while stack:
+      directory = stack.pop()
+      try:
+        wd = self.inotify.add_watch(directory, WATCH_MASK)
+      except OSError as e:
+        # gone again or not a directory
+        log.debug(f"cannot watch `{directory}`: {e}")
+        continue
+      old = self.paths.get(wd)
+      if old is not None and old != directory:
+        self.wds.pop(old, None)
+      self.paths[wd] = directory
+      self.wds[directory] = wd
+      added.append(directory)
+      try:
+        with os.scandir(directory) as it:
+          stack.extend(entry.path for entry in it if entry.is_dir(follow_symlinks=False))
+      except OSError:
+        pass
+    return added
+
+  def remove_tree(self, path):
+    for directory in subtree(list(self.wds), path):
+      wd = self.wds.pop(directory)
+      self.paths.pop(wd, None)
+      self.inotify.rm_watch(wd)
+    for directory in subtree(list(self.dirty), path):
+      del self.dirty[directory]
+
+  def mark(self, path):
+    self.dirty[path] = time.monotonic()
+
+  def mark_all(self):
+    for directory in self.wds:
+      self.mark(directory)
+
+  def handle(self, event, mark=True):
+    if event.mask & inotify.IN_Q_OVERFLOW:
+      log.warning("inotify queue overflowed, rescanning the whole library")
+      self.add_tree(self.root)
+      if mark:
+        self.mark_all()
+      return
+    directory = self.paths.get(event.wd)
+    if directory is None:
+      return
+    if event.mask & inotify.IN_IGNORED:
+      # the directory was deleted (or unwatched)
+      if self.wds.get(directory) == event.wd:
+        del self.wds[directory]
+      del self.paths[event.wd]
+      self.dirty.pop(directory, None)
+      return
+    path = f"{directory}/{event.name}" if directory != "/" else f"/{event.name}"
+    if event.is_dir and event.mask & (inotify.IN_MOVED_FROM | inotify.IN_DELETE):
+      self.remove_tree(path)
+    elif event.is_dir and event.mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+      added = self.add_tree(path)
+      if mark:
+        for d in added:
+          self.mark(d)
+    if mark:
+      self.mark(directory)
+
+  # blocks until directories settled and returns them
+  def wait(self):
+    while True:
+      now = time.monotonic()
+      due = [path for path, last in self.dirty.items() if now - last >= self.settle]
+      if due:
+        for path in due:
+          del self.dirty[path]
+        return sorted(due)
+      timeout = None
+      if self.dirty:
+        timeout = min(self.settle - (now - last) for last in self.dirty.values())
+      for event in self.inotify.read(timeout):
+        self.handle(event)
+
+  # follows the events caused by our own changes (e.g. renamed directories)
+  # without marking anything dirty. The kernel queues the events of a change
+  # before the syscall returns, so all of them are pending already.
+  def skip_pending(self):
+    for event in self.inotify.read(0):
+      self.handle(event, mark=False)
+
+  def close(self):
+    self.inotify.close()
+
+
+class AuditLog:
+
+  def __init__(self, path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    self.f = open(path, "a", encoding="utf-8")
+
+  def record(self, album, change, error=None):
+    entry = {
+      "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+      "album": album,
+      "change": change.to_json(),
+      "error": None if error is None else repr(error),
+    }
+    self.f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    self.f.flush()
+
+  def close(self):
+    self.f.close()
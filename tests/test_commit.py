@@ -0,0 +1,117 @@
+import os
+import argparse
+import pytest
+from kaudiobooks import id3
+from kaudiobooks import journal
+from kaudiobooks import kaudiobooks
+
+AUDIO = b"\xff\xfb\x90\x00" + bytes(413)
+
+
+def chapter(path, title):
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  with open(path, "wb") as f:
+    f.write(AUDIO)
+  id3.create(path, {"title": title})
+  return path
+
+
+def commit_args(journal_path):
+  return argparse.Namespace(journal=journal_path, commit_jobs=1, tag_index=None, plan_out=None)
+
+
+def test_resumed_rename_done_and_fields_match(tmp_path):
+  old = str(tmp_path / "1.mp3")
+  new = str(tmp_path / "01.mp3")
+  chapter(new, "One")
+  assert kaudiobooks.ChapterChange(old, {"title": "One"}, new).resumed() is None
+
+
+def test_resumed_rename_done_and_fields_differ(tmp_path):
+  old = str(tmp_path / "1.mp3")
+  new = str(tmp_path / "01.mp3")
+  chapter(new, "Old")
+  c = kaudiobooks.ChapterChange(old, {"title": "One"}, new, padding=64).resumed()
+  assert (c.path, c.fields, c.new_path, c.padding) == (new, {"title": "One"}, None, 64)
+
+
+def test_resumed_fields_done_and_rename_left(tmp_path):
+  old = chapter(str(tmp_path / "1.mp3"), "One")
+  new = str(tmp_path / "01.mp3")
+  c = kaudiobooks.ChapterChange(old, {"title": "One"}, new, rewrite=True).resumed()
+  assert (c.path, c.fields, c.new_path, c.rewrite) == (old, None, new, False)
+
+
+def test_resumed_directory_rename(tmp_path):
+  (tmp_path / "new").mkdir()
+  assert kaudiobooks.Rename(str(tmp_path / "old"), str(tmp_path / "new")).resumed() is None
+  (tmp_path / "old").mkdir()
+  r = kaudiobooks.Rename(str(tmp_path / "old"), str(tmp_path / "other"))
+  assert r.resumed() is r
+
+
+@pytest.fixture
+def failing_rename(monkeypatch):
+  failing = set()
+  rename = os.rename
+
+  def fake_rename(src, dst):
+    if src in failing:
+      raise OSError(f"cannot rename {src}")
+    rename(src, dst)
+
+  monkeypatch.setattr(os, "rename", fake_rename)
+  return failing
+
+
+def test_failed_change_keeps_its_directories_and_is_resumed(tmp_path, failing_rename):
+  series = tmp_path / "series"
+  album = series / "album"
+  one = chapter(str(album / "1.mp3"), "Old")
+  two = chapter(str(album / "2.mp3"), "Old")
+  other = chapter(str(series / "other" / "1.mp3"), "Old")
+  changes = [
+    [kaudiobooks.ChapterChange(one, {"title": "One"}, str(album / "01.mp3")), kaudiobooks.ChapterChange(two, {"title": "Two"}, str(album / "02.mp3"))],
+    [kaudiobooks.ChapterChange(other, {"title": "Other"})],
+    kaudiobooks.Rename(str(album), str(series / "Album")),
+    kaudiobooks.Rename(str(series / "other"), str(series / "Other")),
+    kaudiobooks.Rename(str(series), str(tmp_path / "Series")),
+  ]
+  path = str(tmp_path / "journal.jsonl")
+  failing_rename.add(two)
+  failures = kaudiobooks.execute_changes(changes, journal=journal.Journal(path))
+
+  # the album and the series hold the failed change and keep their names, the
+  # other album is renamed
+  assert [(c.path, type(error)) for c, error in failures] == [(two, OSError), (str(album), kaudiobooks.SkippedRename), (str(series), kaudiobooks.SkippedRename)]
+  assert sorted(os.listdir(album)) == ["01.mp3", "2.mp3"]
+  assert sorted(os.listdir(series)) == ["Other", "album"]
+  assert id3.load(two).title == "Two"
+  assert journal.unfinished(path)
+
+  # what resume does after the confirmation
+  failing_rename.clear()
+  remaining = [[kaudiobooks.change_from_json(c).resumed() for c in group] for group in journal.read_remaining(path)]
+  assert [[c.to_json() for c in group if c is not None] for group in remaining] == [
+    [{"type": "chapter", "path": two, "fields": None, "new_path": str(album / "02.mp3"), "rewrite": False, "padding": id3.DEFAULT_PADDING}],
+    [{"type": "rename", "path": str(album), "new_path": str(series / "Album")}],
+    [{"type": "rename", "path": str(series), "new_path": str(tmp_path / "Series")}],
+  ]
+  assert kaudiobooks.execute_changes(remaining, journal=journal.Journal(path, replace=True)) == []
+  assert sorted(os.listdir(tmp_path / "Series" / "Album")) == ["01.mp3", "02.mp3"]
+  assert id3.load(str(tmp_path / "Series" / "Album" / "02.mp3")).title == "Two"
+  assert not journal.unfinished(path)
+
+
+def test_resume_of_applied_changes_finishes_the_journal(tmp_path):
+  old = str(tmp_path / "1.mp3")
+  new = str(tmp_path / "01.mp3")
+  c = kaudiobooks.ChapterChange(old, {"title": "One"}, new)
+  path = str(tmp_path / "journal.jsonl")
+  j = journal.Journal(path)
+  j.plan([[c]])
+  j.close()
+  # applied, but the crash came before it was journaled as done
+  chapter(new, "One")
+  kaudiobooks.resume(commit_args(path))
+  assert not journal.unfinished(path)
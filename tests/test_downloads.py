@@ -0,0 +1,145 @@
+import hashlib
+import threading
+import http.server
+import pytest
+from kaudiobooks import downloads
+
+DATA = bytes(range(256)) * 40
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+
+  def do_GET(self):
+    server = self.server
+    server.requests.append(self.headers.get("Range"))
+    if server.errors:
+      self.send_error(server.errors.pop(0))
+      return
+    data = server.data
+    start = 0
+    requested = self.headers.get("Range")
+    if requested is not None and server.ranges:
+      start = int(requested[len("bytes="):-1])
+      if start >= len(data):
+        self.send_response(416)
+        self.send_header("Content-Range", f"bytes */{len(data)}")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        return
+      self.send_response(206)
+      self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+    else:
+      self.send_response(200)
+    body = data[start:]
+    if server.cuts:
+      # the connection closes after the next cut, the length is not announced
+      body = body[:server.cuts.pop(0)]
+    else:
+      self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+
+@pytest.fixture
+def server(monkeypatch):
+  monkeypatch.setattr(downloads, "RETRY_DELAY", 0)
+  server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+  server.data = DATA
+  server.ranges = True
+  server.errors = []
+  server.cuts = []
+  server.requests = []
+  server.url = f"http://127.0.0.1:{server.server_address[1]}/book.aaxc"
+  thread = threading.Thread(target=server.serve_forever, args=(0.01,), daemon=True)
+  thread.start()
+  yield server
+  server.shutdown()
+  server.server_close()
+
+
+def fetch(server, tmp_path, **kwargs):
+  path = str(tmp_path / "book.aaxc")
+  return downloads.fetch(server.url, path, timeout=5, **kwargs)
+
+
+def test_download(server, tmp_path):
+  checksum = "sha256:" + hashlib.sha256(DATA).hexdigest()
+  fetch(server, tmp_path, size=len(DATA), checksum=checksum)
+  assert (tmp_path / "book.aaxc").read_bytes() == DATA
+  assert not (tmp_path / "book.aaxc.part").exists()
+  assert server.requests == [None]
+
+
+def test_resume_with_range(server, tmp_path):
+  (tmp_path / "book.aaxc.part").write_bytes(DATA[:1000])
+  fetch(server, tmp_path, size=len(DATA))
+  assert server.requests == ["bytes=1000-"]
+  assert (tmp_path / "book.aaxc").read_bytes() == DATA
+
+
+def test_server_ignoring_range(server, tmp_path):
+  server.ranges = False
+  (tmp_path / "book.aaxc.part").write_bytes(b"x" * 1000)
+  fetch(server, tmp_path, size=len(DATA))
+  assert server.requests == ["bytes=1000-"]
+  assert (tmp_path / "book.aaxc").read_bytes() == DATA
+
+
+def test_complete_part(server, tmp_path):
+  (tmp_path / "book.aaxc.part").write_bytes(DATA)
+  fetch(server, tmp_path)
+  assert server.requests == [f"bytes={len(DATA)}-"]
+  assert (tmp_path / "book.aaxc").read_bytes() == DATA
+
+
+def test_size_mismatch(server, tmp_path):
+  with pytest.raises(downloads.DownloadError, match="got"):
+    fetch(server, tmp_path, size=len(DATA) - 1)
+  assert not (tmp_path / "book.aaxc").exists()
+  assert not (tmp_path / "book.aaxc.part").exists()
+
+
+def test_checksum_mismatch(server, tmp_path):
+  with pytest.raises(downloads.DownloadError, match="checksum"):
+    fetch(server, tmp_path, checksum="sha256:" + "0" * 64)
+  assert not (tmp_path / "book.aaxc.part").exists()
+
+
+def test_retries_server_errors(server, tmp_path):
+  server.errors = [503, 502]
+  fetch(server, tmp_path, size=len(DATA))
+  assert server.requests == [None, None, None]
+  assert (tmp_path / "book.aaxc").read_bytes() == DATA
+
+
+def test_gives_up_after_retries(server, tmp_path):
+  server.errors = [503] * (downloads.RETRIES + 1)
+  with pytest.raises(downloads.DownloadError, match="giving up"):
+    fetch(server, tmp_path)
+  assert len(server.requests) == downloads.RETRIES + 1
+
+
+def test_client_error_is_not_retried(server, tmp_path):
+  server.errors = [404, 404]
+  with pytest.raises(downloads.DownloadError, match="404"):
+    fetch(server, tmp_path)
+  assert server.requests == [None]
+
+
+def test_early_close_without_length_is_resumed(server, tmp_path):
+  server.cuts = [1000]
+  fetch(server, tmp_path, size=len(DATA))
+  assert server.requests == [None, "bytes=1000-"]
+  assert (tmp_path / "book.aaxc").read_bytes() == DATA
+
+
+def test_short_part_is_kept(server, tmp_path):
+  server.cuts = [1000] * (downloads.RETRIES + 1)
+  with pytest.raises(downloads.DownloadError, match="giving up"):
+    fetch(server, tmp_path, size=len(DATA))
+  assert (tmp_path / "book.aaxc.part").read_bytes() == DATA[:1000 * (downloads.RETRIES + 1)]
+  fetch(server, tmp_path, size=len(DATA))
+  assert (tmp_path / "book.aaxc").read_bytes() == DATA
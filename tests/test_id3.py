@@ -0,0 +1,193 @@
+import io
+import sys
+import types
+import struct
+import pytest
+from kaudiobooks import id3
+
+AUDIO = b"\xff\xfb\x90\x00" + bytes(range(256)) * 4
+
+
+def synchsafe(n):
+  return bytes([(n >> 21) & 0x7f, (n >> 14) & 0x7f, (n >> 7) & 0x7f, n & 0x7f])
+
+
+def frame(version, frame_id, body, flags=0):
+  size = synchsafe(len(body)) if version == 4 else struct.pack(">I", len(body))
+  return frame_id + size + struct.pack(">H", flags) + body
+
+
+def text(version, frame_id, value, encoding=None):
+  if encoding is None:
+    encoding = 3 if version == 4 else 0
+  return frame(version, frame_id, bytes([encoding]) + value.encode(id3.ENCODINGS[encoding]))
+
+
+def tag(version, frames, padding=0, flags=0, extended=b""):
+  body = extended + b"".join(frames) + b"\0" * padding
+  return b"ID3" + bytes([version, 0, flags]) + synchsafe(len(body)) + body
+
+
+def write(tmp_path, data, name="chapter.mp3"):
+  path = tmp_path / name
+  path.write_bytes(data + AUDIO)
+  return str(path)
+
+
+def read(path):
+  with open(path, "rb") as f:
+    return id3.read(f)
+
+
+def frames_of(path):
+  with open(path, "rb") as f:
+    reader = id3.Reader(f)
+    version, end, pos = id3.read_header(reader)
+    return {frame_id: reader.get(pos + id3.HEADER_SIZE, size) for frame_id, _, pos, size in id3.iter_frames(reader, version, pos, end)}
+
+
+def test_read():
+  data = tag(4, [text(4, b"TIT2", "Title"), text(4, b"TALB", "Album"), text(4, b"TPE1", "Artist"), text(4, b"TRCK", "3/12"), frame(4, b"TXXX", b"\x03a\0b")], padding=32)
+  t = id3.read(io.BytesIO(data + AUDIO))
+  assert (t.title, t.album, t.artist, t.track_num) == ("Title", "Album", "Artist", (3, 12))
+  assert t.version == 4
+  assert t.size == len(data) - id3.HEADER_SIZE
+  assert t.other_size == id3.HEADER_SIZE + 4
+
+
+def test_save_in_place(tmp_path):
+  path = write(tmp_path, tag(4, [text(4, b"TIT2", "Old"), frame(4, b"TXXX", b"\x03a\0b")], padding=64))
+  size = (tmp_path / "chapter.mp3").stat().st_size
+  assert id3.save(path, {"title": "A new title", "track_num": (1, 2)}) is False
+  assert (tmp_path / "chapter.mp3").stat().st_size == size
+  t = read(path)
+  assert (t.title, t.track_num) == ("A new title", (1, 2))
+  assert frames_of(path)[b"TXXX"] == b"\x03a\0b"
+  assert (tmp_path / "chapter.mp3").read_bytes().endswith(AUDIO)
+
+
+def test_save_rewrites_with_padding(tmp_path):
+  path = write(tmp_path, tag(4, [text(4, b"TIT2", "Old"), frame(4, b"TXXX", b"\x03a\0b")]))
+  assert id3.save(path, {"title": "A title that does not fit"}, padding=512) is True
+  t = read(path)
+  assert t.title == "A title that does not fit"
+  assert t.size - t.other_size - len(id3.render_text_frames(t, {})) == 512
+  assert frames_of(path)[b"TXXX"] == b"\x03a\0b"
+  assert (tmp_path / "chapter.mp3").read_bytes()[id3.HEADER_SIZE + t.size:] == AUDIO
+
+
+def test_v23_latin1_with_utf16_fallback(tmp_path):
+  path = write(tmp_path, tag(3, [text(3, b"TIT2", "Old")], padding=256))
+  id3.save(path, {"title": "Café", "artist": "Ωmega"})
+  t = read(path)
+  assert (t.version, t.title, t.artist) == (3, "Café", "Ωmega")
+  frames = frames_of(path)
+  assert frames[b"TIT2"] == b"\x00" + "Café".encode("latin-1")
+  # UTF-16 with a byte order mark, v2.3 has no other unicode encoding
+  assert frames[b"TPE1"][0] == 1
+  assert frames[b"TPE1"][1:3] in (b"\xff\xfe", b"\xfe\xff")
+
+
+def test_v24_utf8(tmp_path):
+  path = write(tmp_path, tag(4, [text(4, b"TIT2", "Old")], padding=256))
+  id3.save(path, {"title": "Ωmega"})
+  assert read(path).title == "Ωmega"
+  assert frames_of(path)[b"TIT2"] == b"\x03" + "Ωmega".encode("utf-8")
+
+
+@pytest.mark.parametrize("encoding", [1, 2])
+def test_read_utf16(tmp_path, encoding):
+  path = write(tmp_path, tag(3, [text(3, b"TIT2", "Ωmega", encoding)]))
+  assert read(path).title == "Ωmega"
+
+
+@pytest.mark.parametrize("version", [3, 4])
+def test_extended_header_dropped(tmp_path, version):
+  if version == 3:
+    extended = struct.pack(">I", 6) + b"\0" * 6
+  else:
+    extended = synchsafe(6) + b"\x01\0"
+  path = write(tmp_path, tag(version, [text(version, b"TIT2", "Old"), frame(version, b"TXXX", b"\x00a\0b")], padding=64, flags=0x40, extended=extended))
+  assert read(path).title == "Old"
+  assert id3.save(path, {"title": "New"}) is False
+  data = (tmp_path / "chapter.mp3").read_bytes()
+  assert data[5] == 0
+  assert read(path).title == "New"
+  assert frames_of(path)[b"TXXX"] == b"\x00a\0b"
+  assert data.endswith(AUDIO)
+
+
+@pytest.mark.parametrize("version, flag", [(3, 0x0020), (4, 0x0040)])
+def test_grouping_flagged_frame(tmp_path, version, flag):
+  body = b"\x07" + bytes([3 if version == 4 else 0]) + b"Grouped"
+  path = write(tmp_path, tag(version, [frame(version, b"TIT2", body, flag)], padding=64))
+  assert read(path).title == "Grouped"
+  id3.save(path, {"album": "Album"})
+  t = read(path)
+  assert (t.title, t.album) == ("Grouped", "Album")
+
+
+class FakeTag:
+  def __init__(self, path, saved):
+    self.path = path
+    self.saved = saved
+    self.title = "from eyed3"
+
+  def save(self):
+    self.saved.append((self.path, self.title))
+
+
+@pytest.fixture
+def eyed3(monkeypatch):
+  module = types.ModuleType("eyed3")
+  module.loaded = []
+  module.saved = []
+
+  def load(path):
+    module.loaded.append(path)
+    return types.SimpleNamespace(tag=FakeTag(path, module.saved))
+
+  module.load = load
+  monkeypatch.setitem(sys.modules, "eyed3", module)
+  return module
+
+
+UNSUPPORTED = {
+  "unsynchronisation": tag(4, [text(4, b"TIT2", "Old")], padding=64, flags=0x80),
+  "footer": tag(4, [text(4, b"TIT2", "Old")], padding=64, flags=0x10),
+  "compressed frame": tag(3, [frame(3, b"TIT2", b"\0\0\0\x04x\x9c", 0x0080)], padding=64),
+  "encrypted frame": tag(4, [frame(4, b"TIT2", b"\x01\x03Old", 0x0004)], padding=64),
+  "v2.2": b"ID32\0\0" + synchsafe(16) + b"\0" * 16,
+}
+
+
+@pytest.mark.parametrize("name", UNSUPPORTED)
+def test_unsupported_falls_back_to_eyed3(tmp_path, eyed3, name):
+  path = write(tmp_path, UNSUPPORTED[name])
+  t = id3.load(path)
+  assert t.title == "from eyed3"
+  assert eyed3.loaded == [path]
+  assert id3.rewrite_required(t, {"title": "New"}) is None
+  assert id3.save(path, {"title": "New"}) is None
+  assert eyed3.saved == [(path, "New")]
+
+
+@pytest.mark.parametrize("title", ["Old", "A bit longer", "x" * 43, "x" * 44, "x" * 200])
+@pytest.mark.parametrize("version", [3, 4])
+def test_rewrite_required_agrees_with_save(tmp_path, version, title):
+  # 69 bytes of frames and padding, titles of up to 43 characters fit
+  path = write(tmp_path, tag(version, [text(version, b"TIT2", "Old"), frame(version, b"TXXX", b"\x00a\0b")], padding=40))
+  fields = {"title": title}
+  expected = id3.rewrite_required(id3.load(path), fields)
+  assert expected is (len(title) > 43)
+  assert id3.save(path, fields) is expected
+  assert read(path).title == title
+
+
+def test_create(tmp_path):
+  path = tmp_path / "chapter.mp3"
+  path.write_bytes(AUDIO)
+  id3.create(str(path), {"title": "Title", "track_num": (2, None)}, padding=100)
+  t = read(str(path))
+  assert (t.title, t.track_num) == ("Title", (2, None))
+  assert path.read_bytes().endswith(b"\0" * 100 + AUDIO)
@@ -0,0 +1,78 @@
+import os
+import json
+import pytest
+from kaudiobooks import journal
+
+
+class Change:
+  def __init__(self, path, new_path=None):
+    self.path = path
+    self.new_path = new_path
+
+  def to_json(self):
+    return {"type": "rename", "path": self.path, "new_path": self.new_path}
+
+
+def planned(path, albums):
+  j = journal.Journal(path)
+  j.plan(albums)
+  return j
+
+
+def test_remaining_changes(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  a, b, c = Change("a", "a2"), Change("b", "b2"), Change("c")
+  j = planned("journal.jsonl", [[a, b], [c]])
+  j.done(a)
+  j.done(c, OSError("no space left"))
+  j.close()
+  # failed changes count as not applied, paths are absolute
+  assert journal.read_remaining("journal.jsonl") == [
+    [{"type": "rename", "path": f"{tmp_path}/b", "new_path": f"{tmp_path}/b2"}],
+    [{"type": "rename", "path": f"{tmp_path}/c", "new_path": None}],
+  ]
+  assert journal.unfinished("journal.jsonl")
+
+
+def test_ended_journal(tmp_path):
+  path = str(tmp_path / "journal.jsonl")
+  a = Change("/a", "/a2")
+  j = planned(path, [[a]])
+  j.done(a)
+  j.end()
+  assert journal.read_remaining(path) == []
+  assert not journal.unfinished(path)
+  assert not journal.unfinished(str(tmp_path / "missing.jsonl"))
+
+
+def test_truncated_last_line(tmp_path):
+  path = str(tmp_path / "journal.jsonl")
+  a, b = Change("/a", "/a2"), Change("/b", "/b2")
+  j = planned(path, [[a, b]])
+  j.done(a)
+  j.close()
+  # a crash in the middle of writing the done entry of b
+  with open(path, "a") as f:
+    f.write(json.dumps({"op": "done", "id": 1})[:-4])
+  assert journal.read_remaining(path) == [[{"type": "rename", "path": "/b", "new_path": "/b2"}]]
+
+
+def test_unfinished_journal_is_not_overwritten(tmp_path):
+  path = str(tmp_path / "state" / "journal.jsonl")
+  planned(path, [[Change("/a", "/a2")]]).close()
+  before = open(path).read()
+  with pytest.raises(journal.UnfinishedJournal):
+    journal.Journal(path)
+  assert open(path).read() == before
+  # resuming replaces it
+  journal.Journal(path, replace=True).end()
+  assert not journal.unfinished(path)
+  journal.Journal(path).close()
+
+
+def test_finish(tmp_path):
+  path = str(tmp_path / "journal.jsonl")
+  planned(path, [[Change("/a", "/a2")]]).close()
+  journal.finish(path)
+  assert not journal.unfinished(path)
+  assert os.path.exists(path)
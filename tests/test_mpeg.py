@@ -0,0 +1,76 @@
+import random
+import pytest
+from kaudiobooks import mpeg
+
+# MPEG-1 layer III, 128 kbit/s, 44.1 kHz: 417 bytes, 418 with padding
+FRAME = b"\xff\xfb\x90\x64" + b"\x55" * 413
+PADDED_FRAME = b"\xff\xfb\x92\x64" + b"\x55" * 414
+
+
+def info_frame(frames):
+  body = bytearray(FRAME)
+  body[4:36] = b"\0" * 32
+  body[36:48] = b"Info" + (1).to_bytes(4, "big") + frames.to_bytes(4, "big")
+  return bytes(body)
+
+
+# garbage full of sync bytes and headers that are not followed by a frame
+def garbage(rng, size):
+  data = bytearray(rng.choice(b"\xff\xfb\x90\x64\x00\x12") for _ in range(size))
+  return bytes(data)
+
+
+def corrupted(seed):
+  rng = random.Random(seed)
+  parts = []
+  if rng.random() < 0.5:
+    parts.append(info_frame(rng.randrange(10, 40)))
+  if rng.random() < 0.3:
+    parts.append(garbage(rng, rng.randrange(1, 300)))
+  for _ in range(rng.randrange(5, 40)):
+    parts.append(rng.choice([FRAME, PADDED_FRAME]))
+    if rng.random() < 0.2:
+      parts.append(garbage(rng, rng.randrange(1, 6000)))
+  data = b"".join(parts)
+  if rng.random() < 0.5:
+    data = data[:len(data) - rng.randrange(1, 400)]
+  return data
+
+
+CASES = [corrupted(seed) for seed in range(40)] + [
+  b"",
+  b"\xff" * 5000,
+  FRAME * 3 + b"\xff\xfb" + FRAME * 2,
+  b"\0" * 100 + FRAME * 4 + FRAME[:200],
+  info_frame(7) + FRAME * 5,
+]
+
+
+def scan_pure(monkeypatch, data):
+  with monkeypatch.context() as m:
+    m.setattr(mpeg, "load_numpy", lambda: None)
+    return mpeg.scan_frames(data)
+
+
+def test_scan_frames():
+  info = mpeg.scan_frames(b"\0" * 10 + FRAME * 3 + PADDED_FRAME + b"\0" * 5000 + FRAME * 2 + FRAME[:100])
+  assert info["frames"] == 6
+  assert info["first_frame"] == 10
+  assert info["truncated"] == len(FRAME) - 100
+  assert info["largest_gap"] == 5000
+  assert len(info["problems"]) == 2
+
+
+def test_declared_frames(monkeypatch):
+  assert scan_pure(monkeypatch, info_frame(5) + FRAME * 5)["problems"] == []
+  assert scan_pure(monkeypatch, info_frame(7) + FRAME * 5)["problems"] == ["the header declares 7 frames, found 5"]
+
+
+@pytest.mark.parametrize("window", [mpeg.RESYNC_WINDOW, 64])
+def test_numpy_and_pure_python_agree(monkeypatch, window):
+  pytest.importorskip("numpy")
+  monkeypatch.setattr(mpeg, "RESYNC_WINDOW", window)
+  for data in CASES:
+    expected = scan_pure(monkeypatch, data)
+    assert mpeg.load_numpy() is not None
+    assert mpeg.scan_frames(data) == expected
@@ -0,0 +1,86 @@
+import pytest
+from kaudiobooks import renames
+
+
+class Item:
+  def __init__(self, source):
+    self.source = source
+
+  def __repr__(self):
+    return f"Item({self.source!r})"
+
+
+# names that differ in case count as the same, like with name_key
+def index(**listings):
+  names = renames.NameIndex(str.lower)
+  for directory, entries in listings.items():
+    names.add_listing(f"/{directory}", entries)
+  return names
+
+
+def moves(group, *pairs):
+  return [(Item(source), group, source, target) for source, target in pairs]
+
+
+def test_no_problems():
+  names = index(album=["a.mp3", "b.mp3"])
+  problems, first = names.check(moves([], ("/album/a.mp3", "/album/c.mp3"), ("/album/b.mp3", "/album/d.mp3")))
+  assert (problems, first) == ([], {})
+
+
+def test_case_only_rename():
+  names = index(album=["a.mp3"])
+  assert names.check(moves([], ("/album/a.mp3", "/album/A.mp3"))) == ([], {})
+
+
+def test_collision():
+  names = index(album=["a.mp3", "b.mp3"])
+  problems, _ = names.check(moves([], ("/album/a.mp3", "/album/c.mp3"), ("/album/b.mp3", "/album/C.mp3")))
+  assert problems == ["`/album/a.mp3` and `/album/b.mp3` would both be renamed to `/album/C.mp3`"]
+
+
+def test_rename_onto_existing():
+  names = index(album=["a.mp3", "B.mp3"])
+  problems, _ = names.check(moves([], ("/album/a.mp3", "/album/b.mp3")))
+  assert problems == ["`/album/a.mp3` would be renamed onto the existing `/album/B.mp3`"]
+
+
+def test_rename_onto_entry_renamed_by_another_album():
+  names = index(library=["x", "y"])
+  problems, _ = names.check(moves([], ("/library/x", "/library/z")) + moves([], ("/library/y", "/library/x")))
+  assert problems == ["`/library/y` would be renamed onto `/library/x`, which is renamed itself in the same commit"]
+
+
+def test_rename_outside_the_walk(tmp_path):
+  (tmp_path / "taken").mkdir()
+  names = renames.NameIndex(str.lower)
+  problems, _ = names.check(moves([], (f"{tmp_path}/album", f"{tmp_path}/Taken")))
+  assert problems == [f"`{tmp_path}/album` would be renamed onto the existing `{tmp_path}/taken`"]
+
+
+def test_cycle():
+  names = index(album=["a.mp3", "b.mp3"])
+  problems, _ = names.check(moves([], ("/album/a.mp3", "/album/b.mp3"), ("/album/b.mp3", "/album/a.mp3")))
+  assert problems == ["rename cycle: `/album/a.mp3` --> `/album/b.mp3` --> `/album/a.mp3`"]
+
+
+@pytest.mark.parametrize("order", [[0, 1, 2], [2, 1, 0], [1, 0, 2]])
+def test_chain_is_ordered(order):
+  # 1.mp3 becomes 2.mp3, which moves on to 3.mp3 and so on
+  names = index(album=["1.mp3", "2.mp3", "3.mp3"])
+  chain = moves([], ("/album/1.mp3", "/album/2.mp3"), ("/album/2.mp3", "/album/3.mp3"), ("/album/3.mp3", "/album/4.mp3"))
+  chain = [chain[i] for i in order]
+  problems, first = names.check(chain)
+  assert problems == []
+  items = [item for item, _, _, _ in chain]
+  assert [item.source for item in renames.ordered(items, first)] == ["/album/3.mp3", "/album/2.mp3", "/album/1.mp3"]
+
+
+def test_rename_onto_removed_entry_waits_for_the_removal():
+  names = index(album=["a.mp3", "b.mp3"])
+  group = []
+  removal = (Item("/album/b.mp3"), group, "/album/b.mp3", None)
+  rename = (Item("/album/a.mp3"), group, "/album/a.mp3", "/album/b.mp3")
+  problems, first = names.check([rename, removal])
+  assert problems == []
+  assert renames.ordered([rename[0], removal[0]], first) == [removal[0], rename[0]]
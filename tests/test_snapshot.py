@@ -0,0 +1,88 @@
+import json
+import asyncio
+from datetime import datetime, timedelta
+from kaudiobooks import snapshot
+
+GROUPS = ["always-returned", "media", "product_attrs"]
+
+
+def item(asin, purchase_date):
+  return {"asin": asin, "title": f"Title {asin}", "purchase_date": purchase_date}
+
+
+# answers library requests like the api: newest purchases first, paged
+class StubClient:
+
+  def __init__(self, items):
+    self.items = items
+    self.requests = []
+
+  async def get(self, path, **params):
+    self.requests.append((path, params))
+    assert path == "library"
+    items = sorted(self.items, key=lambda i: i["purchase_date"], reverse=True)
+    after = params.get("purchased_after")
+    if after is not None:
+      after = datetime.strptime(after, "%Y-%m-%dT%H:%M:%S.%fZ")
+      items = [i for i in items if snapshot.parse_date(i["purchase_date"]) >= after]
+    size = params["num_results"]
+    start = (params["page"] - 1) * size
+    return {"items": items[start:start + size], "response_groups": GROUPS}
+
+
+def refresh(snap, client, full=False):
+  asyncio.run(snap.refresh(client, full))
+
+
+def test_full_refresh(tmp_path, monkeypatch):
+  monkeypatch.setattr(snapshot, "PAGE_SIZE", 2)
+  client = StubClient([item(f"A{i}", f"2024-01-0{i + 1}T10:00:00Z") for i in range(5)])
+  path = str(tmp_path / "library.json")
+  snap = snapshot.LibrarySnapshot(path)
+  refresh(snap, client)
+  assert sorted(snap.items) == ["A0", "A1", "A2", "A3", "A4"]
+  assert [params["page"] for _, params in client.requests] == [1, 2, 3]
+  assert all(params["response_groups"] == snapshot.RESPONSE_GROUPS for _, params in client.requests)
+  assert all("purchased_after" not in params for _, params in client.requests)
+
+  loaded = snapshot.LibrarySnapshot(path)
+  assert loaded.items == snap.items
+  assert loaded.response_groups == GROUPS
+  assert loaded.is_fresh(timedelta(hours=1))
+  assert json.loads((tmp_path / "library.json").read_text())["response_groups"] == GROUPS
+
+
+def test_incremental_refresh(tmp_path):
+  client = StubClient([item("A0", "2024-01-01T10:00:00Z"), item("A1", "2024-03-01T10:00:00Z")])
+  snap = snapshot.LibrarySnapshot(str(tmp_path / "library.json"))
+  refresh(snap, client)
+  client.items.append(item("A2", "2024-03-05T10:00:00Z"))
+  client.requests = []
+  refresh(snap, client)
+  # from a day before the latest known purchase
+  assert client.requests[0][1]["purchased_after"] == "2024-02-29T10:00:00.000000Z"
+  assert sorted(snap.items) == ["A0", "A1", "A2"]
+
+  client.items = [item("A2", "2024-03-05T10:00:00Z")]
+  refresh(snap, client, full=True)
+  assert sorted(snap.items) == ["A2"]
+
+
+def test_snapshot_without_response_groups_is_fetched_again(tmp_path):
+  path = tmp_path / "library.json"
+  path.write_text(json.dumps({"fetched": "2024-03-01T00:00:00", "items": [item("A0", "2024-01-01T10:00:00Z")], "codecs": {"A0": "LC_128"}}))
+  snap = snapshot.LibrarySnapshot(str(path))
+  assert snap.response_groups is None
+  client = StubClient([item("A1", "2024-02-01T10:00:00Z")])
+  refresh(snap, client)
+  assert "purchased_after" not in client.requests[0][1]
+  assert sorted(snap.items) == ["A1"]
+  assert snap.codecs == {"A0": "LC_128"}
+
+
+def test_select(tmp_path):
+  snap = snapshot.LibrarySnapshot(str(tmp_path / "library.json"))
+  refresh(snap, StubClient([item("A0", "2024-01-01T10:00:00Z"), item("A1", "2024-02-01T10:00:00Z"), item("A2", "2024-03-01T10:00:00Z")]))
+  selected = snap.select(datetime(2024, 1, 15), datetime(2024, 2, 15))
+  assert [i["asin"] for i in selected] == ["A1"]
+  assert len(snap.select()) == 3
@@ -0,0 +1,91 @@
+import os
+import json
+import shutil
+import subprocess
+import pytest
+from kaudiobooks import id3
+from kaudiobooks import mpeg
+from kaudiobooks import splitter
+
+CHAPTERS = [("Opening", 0, 2500), ("The Middle", 2500, 4000), ("The End", 4000, 7000)]
+
+needs_ffmpeg = pytest.mark.skipif(shutil.which(splitter.FFMPEG) is None or shutil.which(splitter.FFPROBE) is None, reason="ffmpeg is not installed")
+
+
+def make_book(path):
+  metadata = f"{path}.txt"
+  with open(metadata, "w") as f:
+    f.write(";FFMETADATA1\ntitle=The Book\nartist=The Author\n")
+    for title, start, end in CHAPTERS:
+      f.write(f"\n[CHAPTER]\nTIMEBASE=1/1000\nSTART={start}\nEND={end}\ntitle={title}\n")
+  subprocess.run([splitter.FFMPEG, "-v", "error", "-nostdin", "-y", "-f", "lavfi", "-i", f"sine=frequency=440:sample_rate=44100:duration={CHAPTERS[-1][2] / 1000}",
+    "-i", metadata, "-map", "0:a", "-map_metadata", "1", "-map_chapters", "1", "-codec:a", "aac", "-b:a", "64k", "-f", "ipod", path], check=True)
+  os.remove(metadata)
+
+
+@pytest.fixture(params=[".m4b", ".m4a"])
+def book(request, tmp_path):
+  path = str(tmp_path / f"book{request.param}")
+  make_book(path)
+  return path
+
+
+@needs_ffmpeg
+def test_read_book(book):
+  b = splitter.read_book(book, splitter.decryption_args(book))
+  assert (b.title, b.author, b.sample_rate) == ("The Book", "The Author", 44100)
+  assert [(c.title, round(c.start * 1000), round(c.end * 1000)) for c in b.chapters] == CHAPTERS
+
+
+@needs_ffmpeg
+def test_encode_chapters(book, tmp_path):
+  b = splitter.read_book(book, [])
+  album_dir = tmp_path / "album"
+  album_dir.mkdir()
+  for track, chapter in enumerate(b.chapters, 1):
+    fields = {"title": chapter.title, "album": b.title, "artist": b.author, "track_num": (track, len(b.chapters))}
+    path = str(album_dir / f"{track}.mp3")
+    splitter.encode_chapter(book, [], b, chapter, path, fields, "64k", padding=2048)
+    tag = id3.load(path)
+    assert (tag.title, tag.album, tag.artist, tuple(tag.track_num)) == (chapter.title, "The Book", "The Author", (track, 3))
+    # the tag has room for changes without rewriting the file
+    assert id3.rewrite_required(tag, {"title": "x" * 1000}) is False
+    with open(path, "rb") as f:
+      info = mpeg.stream_info(f.read())
+    # the encoder delay and padding add a few frames
+    assert abs(info["duration"] - (chapter.end - chapter.start)) < 0.1
+  # nothing but the chapters is written
+  assert sorted(os.listdir(album_dir)) == ["1.mp3", "2.mp3", "3.mp3"]
+
+
+@needs_ffmpeg
+def test_encode_failure(book, tmp_path):
+  b = splitter.read_book(book, [])
+  with pytest.raises(splitter.SplitError, match="1.mp3"):
+    splitter.encode_chapter(book, [], b, b.chapters[0], str(tmp_path / "1.mp3"), {}, "not a bitrate")
+
+
+def test_chapter_times_are_contiguous():
+  b = splitter.Book("Book", "Author", [splitter.Chapter("a", 0.0, 1.23456789), splitter.Chapter("b", 1.23456789, 2.5)], 44100)
+  (start_a, duration_a), (start_b, duration_b) = [splitter.chapter_times(b, c) for c in b.chapters]
+  assert start_a == "0.000000"
+  assert round((float(start_a) + float(duration_a)) * 44100) == round(float(start_b) * 44100)
+  assert round((float(start_b) + float(duration_b)) * 44100) == round(2.5 * 44100)
+
+
+def test_metadata_args():
+  args = splitter.metadata_args({"title": "A = B", "track_num": (3, 12), "album": "Album"})
+  assert args == ["-metadata", "title=A = B", "-metadata", "track=3/12", "-metadata", "album=Album"]
+  assert splitter.metadata_args({"track_num": (3, None)}) == ["-metadata", "track=3"]
+
+
+def test_decryption_args(tmp_path):
+  voucher = {"content_license": {"license_response": {"key": "k", "iv": "i"}}}
+  (tmp_path / "book.voucher").write_text(json.dumps(voucher))
+  assert splitter.decryption_args(str(tmp_path / "book.aaxc")) == ["-audible_key", "k", "-audible_iv", "i"]
+  assert splitter.decryption_args(str(tmp_path / "book.aax"), "abcd") == ["-activation_bytes", "abcd"]
+  assert splitter.decryption_args(str(tmp_path / "book.m4b")) == []
+  with pytest.raises(splitter.SplitError):
+    splitter.decryption_args(str(tmp_path / "book.aax"))
+  with pytest.raises(splitter.SplitError):
+    splitter.decryption_args(str(tmp_path / "other.aaxc"))
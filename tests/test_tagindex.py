@@ -0,0 +1,43 @@
+import sqlite3
+import pytest
+from kaudiobooks import filecache
+from kaudiobooks import tagindex
+
+
+def error(name):
+  e = sqlite3.OperationalError("database is locked" if name == "SQLITE_BUSY" else "disk I/O error")
+  e.sqlite_errorname = name
+  return e
+
+
+# a connection whose pragmas fail with `errors` first
+class FailingConnection:
+
+  def __init__(self, *errors):
+    self.errors = list(errors)
+    self.statements = []
+
+  def execute(self, statement):
+    self.statements.append(statement)
+    if self.errors:
+      raise self.errors.pop(0)
+
+
+def test_set_wal_retries_while_busy():
+  db = FailingConnection(error("SQLITE_BUSY"), error("SQLITE_BUSY"))
+  tagindex.set_wal(db)
+  assert db.statements == ["pragma journal_mode=wal"] * 3
+
+
+def test_set_wal_gives_up():
+  with pytest.raises(sqlite3.OperationalError, match="locked"):
+    tagindex.set_wal(FailingConnection(*[error("SQLITE_BUSY")] * 100), timeout=0.05)
+  with pytest.raises(sqlite3.OperationalError, match="disk"):
+    tagindex.set_wal(FailingConnection(error("SQLITE_IOERR")))
+
+
+@pytest.mark.parametrize("open_db", [tagindex.TagIndex, filecache.FileCache])
+def test_new_database_is_wal(tmp_path, open_db):
+  path = str(tmp_path / "cache" / "db.sqlite")
+  open_db(path)
+  assert sqlite3.connect(path).execute("pragma journal_mode").fetchone()[0] == "wal"